@@ -0,0 +1,114 @@
+import os
+import json
+import struct
+
+import numpy as np
+
+EMBEDDINGS_FILE_EXTENSION = '.vme'
+EMBEDDINGS_FILE_MAGIC = b'VMEMBED\0'
+EMBEDDINGS_FILE_VERSION = 1
+# The float32 data starts at a multiple of this, so that the blocks are aligned
+EMBEDDINGS_FILE_ALIGNMENT = 64
+
+# Binary embeddings file layout:
+#   magic (8 bytes), version (uint32), header length (uint32), JSON header, padding, float32 data
+# The data holds one [count, dim] block per recognition model. The header lists the blocks and, for each embedding,
+# its name and its row in the block of each model.
+
+def is_binary_embeddings_file(file_path):
+    with open(file_path, 'rb') as embed_file:
+        return embed_file.read(len(EMBEDDINGS_FILE_MAGIC)) == EMBEDDINGS_FILE_MAGIC
+
+def load_embeddings_file(file_path):
+    # Returns a list of {'name': str, 'embedding_store': {recognition model: embedding}}
+    # Reads the binary format as well as the JSON files of previous versions and of tools/convert_old_rope_embeddings.py
+    if not is_binary_embeddings_file(file_path):
+        return load_json_embeddings_file(file_path)
+
+    with open(file_path, 'rb') as embed_file:
+        embed_file.seek(len(EMBEDDINGS_FILE_MAGIC))
+        version, header_length = struct.unpack('<II', embed_file.read(8))
+        if version > EMBEDDINGS_FILE_VERSION:
+            raise ValueError(f"Embeddings file version {version} is not supported")
+        header = json.loads(embed_file.read(header_length).decode('utf-8'))
+
+        # Each block is read at once straight into its array, the file is not kept open or mapped so that it can be saved again
+        data_offset = get_aligned_offset(len(EMBEDDINGS_FILE_MAGIC) + 8 + header_length)
+        blocks = {}
+        for recogn_model, block_data in header['models'].items():
+            if block_data['count'] == 0:
+                continue
+            embed_file.seek(data_offset + block_data['offset'])
+            block = np.fromfile(embed_file, dtype='<f4', count=block_data['count'] * block_data['dim'])
+            if block.size != block_data['count'] * block_data['dim']:
+                raise ValueError(f"Embeddings file is truncated, the block of {recogn_model} is incomplete")
+            blocks[recogn_model] = block.astype(np.float32, copy=False).reshape(block_data['count'], block_data['dim'])
+
+    embeddings_list = []
+    for embed_data in header['embeddings']:
+        embedding_store = {recogn_model: blocks[recogn_model][row] for recogn_model, row in embed_data['models'].items()}
+        embeddings_list.append({'name': embed_data['name'], 'embedding_store': embedding_store})
+    return embeddings_list
+
+def load_json_embeddings_file(file_path):
+    with open(file_path, 'r') as embed_file: #pylint: disable=unspecified-encoding
+        embeddings_list = json.load(embed_file)
+    for embed_data in embeddings_list:
+        embedding_store = embed_data.get('embedding_store', {})
+        embed_data['embedding_store'] = {recogn_model: np.array(embed, dtype=np.float32) for recogn_model, embed in embedding_store.items()}
+    return embeddings_list
+
+def save_embeddings_file(file_path, embeddings_list):
+    # Files with the .json extension are written in the previous JSON format, for compatibility with older versions
+    if os.path.splitext(file_path)[1].lower() == '.json':
+        save_json_embeddings_file(file_path, embeddings_list)
+        return
+
+    # Key: recognition model, Value: list of embeddings, one row of the block each
+    blocks_rows = {}
+    embeddings_header = []
+    for embed_data in embeddings_list:
+        rows = {}
+        for recogn_model, embedding in embed_data['embedding_store'].items():
+            embedding = np.asarray(embedding, dtype=np.float32).ravel()
+            block_rows = blocks_rows.setdefault(recogn_model, [])
+            if block_rows and block_rows[0].size != embedding.size:
+                raise ValueError(f"Embeddings of {recogn_model} don't have the same size")
+            rows[recogn_model] = len(block_rows)
+            block_rows.append(embedding)
+        embeddings_header.append({'name': embed_data['name'], 'models': rows})
+
+    models_header = {}
+    blocks = []
+    offset = 0
+    for recogn_model, block_rows in blocks_rows.items():
+        block = np.stack(block_rows).astype('<f4')
+        models_header[recogn_model] = {'count': block.shape[0], 'dim': block.shape[1], 'offset': offset}
+        blocks.append(block)
+        offset += block.nbytes
+    header = json.dumps({'embeddings': embeddings_header, 'models': models_header}).encode('utf-8')
+
+    # Written to a temporary file first, so that an error doesn't leave a truncated file
+    temp_file_path = file_path + '.tmp'
+    with open(temp_file_path, 'wb') as embed_file:
+        embed_file.write(EMBEDDINGS_FILE_MAGIC)
+        embed_file.write(struct.pack('<II', EMBEDDINGS_FILE_VERSION, len(header)))
+        embed_file.write(header)
+        embed_file.write(b'\0' * (get_aligned_offset(embed_file.tell()) - embed_file.tell()))
+        for block in blocks:
+            embed_file.write(block.tobytes())
+    os.replace(temp_file_path, file_path)
+
+def save_json_embeddings_file(file_path, embeddings_list):
+    embeddings_list = [
+        {
+            'name': embed_data['name'],
+            'embedding_store': {recogn_model: np.asarray(embedding).tolist() for recogn_model, embedding in embed_data['embedding_store'].items()}
+        }
+        for embed_data in embeddings_list
+    ]
+    with open(file_path, 'w') as embed_file: #pylint: disable=unspecified-encoding
+        json.dump(embeddings_list, embed_file, indent=4)
+
+def get_aligned_offset(offset):
+    return (offset + EMBEDDINGS_FILE_ALIGNMENT - 1) // EMBEDDINGS_FILE_ALIGNMENT * EMBEDDINGS_FILE_ALIGNMENT
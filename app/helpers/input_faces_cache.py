@@ -0,0 +1,208 @@
+import os
+import json
+import hashlib
+import threading
+import uuid
+
+import numpy as np
+
+from app.helpers.integrity_checker import get_file_hash
+
+INPUT_FACES_CACHE_DIR = os.path.join(os.getcwd(), '.input_faces_cache')
+INPUT_FACES_CACHE_VERSION = 2
+
+_input_faces_cache = None
+_input_faces_cache_lock = threading.Lock()
+
+def get_input_faces_cache():
+    # One cache per process, shared by all the loaders so that they share the index and the rows of the data files
+    global _input_faces_cache
+    with _input_faces_cache_lock:
+        if _input_faces_cache is None:
+            _input_faces_cache = InputFacesCache()
+        return _input_faces_cache
+
+class InputFacesCache:
+    """
+    Content addressed cache of the input faces, so that reloading a workspace or a folder doesn't decode the images
+    and run the detection and recognition models again.
+
+    Entries are keyed by the hash of the image file and of the detection settings. Each entry is a row of fixed size
+    records in raw binary files, one for the keypoints, one for the thumbnails and one per recognition model, which are
+    memory-mapped when read. index.json maps the entries to their shard and row.
+    Each instance of the app writes its own shard of data files, so that two instances never write the same row, and
+    merges the entries saved by the others into the index when saving it. Use get_input_faces_cache() rather than
+    creating an instance.
+    """
+    def __init__(self, cache_dir=INPUT_FACES_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock = threading.Lock()
+        # Key: data file name, Value: np.memmap of the file
+        self.memmaps = {}
+        self.is_modified = False
+        # Shard of the data files written by this instance, and its next free row
+        self.shard = uuid.uuid4().hex[:16]
+        self.num_rows = 0
+        self.load_index()
+
+    def get_empty_index(self):
+        return {
+            'version': INPUT_FACES_CACHE_VERSION,
+            # Key: record name, Value: [shape of a record, dtype]
+            'records': {},
+            # Key: absolute file path, Value: [size, mtime_ns, hash], avoids hashing files that didn't change
+            'files': {},
+            # Key: file hash + settings key, Value: {'shard': shard of the data files, 'row': row in the data files, 'models': recognition models with an embedding}
+            'entries': {},
+        }
+
+    def read_index_file(self):
+        # Returns the index saved in index.json, or None when there is none or it can't be used
+        if not os.path.exists(self.index_path):
+            return None
+        try:
+            with open(self.index_path, 'r') as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            print("Input faces cache index is not readable, the cache will be rebuilt.")
+            return None
+        if index.get('version') != INPUT_FACES_CACHE_VERSION:
+            return None
+        return index
+
+    def load_index(self):
+        # Entries whose rows are missing from the data files, when the app was closed while writing them, are not found by get()
+        index = self.read_index_file()
+        self.index = index if index is not None else self.get_empty_index()
+
+    def merge_index_file(self):
+        # Keeps the entries saved by the other instances of the app since the index was loaded,
+        # the rows of the entries written by this instance are in its own shard so they never collide with them
+        index = self.read_index_file()
+        if index is None:
+            return
+        for key, entry in index['entries'].items():
+            current = self.index['entries'].get(key)
+            if current is None or (current['shard'] != self.shard and len(entry['models']) > len(current['models'])):
+                self.index['entries'][key] = entry
+        for file_path, file_data in index['files'].items():
+            self.index['files'].setdefault(file_path, file_data)
+        for name, record_data in index['records'].items():
+            self.index['records'].setdefault(name, record_data)
+
+    def save(self):
+        with self.lock:
+            if not self.is_modified:
+                return
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.merge_index_file()
+            temp_index_path = f'{self.index_path}.{self.shard}.tmp'
+            with open(temp_index_path, 'w') as index_file:
+                json.dump(self.index, index_file)
+            os.replace(temp_index_path, self.index_path)
+            self.is_modified = False
+
+    @staticmethod
+    def get_settings_key(control: dict, input_size):
+        # Settings that change the detected keypoints, and so the crops and embeddings
+        settings = [
+            control['DetectorModelSelection'], control['DetectorScoreSlider'], str(input_size),
+            control['LandmarkDetectToggle'], control['LandmarkDetectModelSelection'], control['LandmarkDetectScoreSlider'],
+            control['DetectFromPointsToggle'], control['AutoRotationToggle'], control['SimilarityTypeSelection'],
+        ]
+        return hashlib.md5(json.dumps(settings).encode('utf-8')).hexdigest()
+
+    def get_file_hash(self, file_path):
+        file_path = os.path.abspath(file_path)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        with self.lock:
+            file_data = self.index['files'].get(file_path)
+        if file_data and file_data[0] == stat.st_size and file_data[1] == stat.st_mtime_ns:
+            return file_data[2]
+
+        file_hash = get_file_hash(file_path)
+        with self.lock:
+            self.index['files'][file_path] = [stat.st_size, stat.st_mtime_ns, file_hash]
+            self.is_modified = True
+        return file_hash
+
+    def get_record_file_name(self, name, shard):
+        return f'{name}_{shard}.bin'
+
+    def read_record(self, name, shard, row):
+        file_name = self.get_record_file_name(name, shard)
+        shape, dtype = self.index['records'][name]
+        memmap = self.memmaps.get(file_name)
+        if memmap is None or memmap.shape[0] <= row:
+            # Embedding files only go up to the last row with that embedding
+            file_path = os.path.join(self.cache_dir, file_name)
+            num_rows = os.path.getsize(file_path) // (int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            if num_rows <= row:
+                raise ValueError(f"Row {row} is not in {file_name}")
+            memmap = np.memmap(file_path, dtype=dtype, mode='r', shape=(num_rows, *shape))
+            self.memmaps[file_name] = memmap
+        # Copy the record so that the file is not kept mapped by the caller
+        return np.array(memmap[row])
+
+    def write_record(self, name, row, record: np.ndarray):
+        # Records are only written to the shard of this instance
+        record_data = self.index['records'].get(name)
+        if record_data is None:
+            record_data = [list(record.shape), record.dtype.str]
+            self.index['records'][name] = record_data
+        elif tuple(record_data[0]) != record.shape or np.dtype(record_data[1]) != record.dtype:
+            return False
+
+        file_name = self.get_record_file_name(name, self.shard)
+        # Mappings of the file must be released before writing to it
+        self.memmaps.pop(file_name, None)
+        file_path = os.path.join(self.cache_dir, file_name)
+        with open(file_path, 'r+b' if os.path.exists(file_path) else 'wb') as record_file:
+            record_file.seek(row * record.nbytes)
+            record_file.write(np.ascontiguousarray(record).tobytes())
+        return True
+
+    def get(self, file_hash, settings_key, recognition_models):
+        # Returns (kps, thumbnail, embedding_store) or None when the face or one of the embeddings is not cached
+        with self.lock:
+            entry = self.index['entries'].get(f'{file_hash}_{settings_key}')
+            if entry is None or any(recognition_model not in entry['models'] for recognition_model in recognition_models):
+                return None
+            try:
+                kps = self.read_record('kps', entry['shard'], entry['row'])
+                thumbnail = self.read_record('thumbnail', entry['shard'], entry['row'])
+                embedding_store = {recognition_model: self.read_record(f'embedding_{recognition_model}', entry['shard'], entry['row']) for recognition_model in entry['models']}
+            except (OSError, ValueError, KeyError):
+                return None
+        return kps, thumbnail, embedding_store
+
+    def put(self, file_hash, settings_key, kps, thumbnail, embedding_store):
+        key = f'{file_hash}_{settings_key}'
+        with self.lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entry = self.index['entries'].get(key)
+            if entry is not None and entry['shard'] != self.shard:
+                # The entry is moved to a row of this shard with its other embeddings, the shard of another instance is never written
+                embedding_store = dict(embedding_store)
+                for recognition_model in entry['models']:
+                    if recognition_model not in embedding_store:
+                        try:
+                            embedding_store[recognition_model] = self.read_record(f'embedding_{recognition_model}', entry['shard'], entry['row'])
+                        except (OSError, ValueError, KeyError):
+                            pass
+                entry = None
+            if entry is None:
+                entry = {'shard': self.shard, 'row': self.num_rows, 'models': []}
+                self.num_rows += 1
+            # Thumbnails have the size of the recognition crop, faces with another size are not cached
+            if not self.write_record('kps', entry['row'], np.asarray(kps, dtype=np.float32)) or not self.write_record('thumbnail', entry['row'], np.ascontiguousarray(thumbnail, dtype=np.uint8)):
+                return
+            for recognition_model, embedding in embedding_store.items():
+                if self.write_record(f'embedding_{recognition_model}', entry['row'], np.asarray(embedding, dtype=np.float32)) and recognition_model not in entry['models']:
+                    entry['models'].append(recognition_model)
+            self.index['entries'][key] = entry
+            self.is_modified = True
@@ -1,20 +1,131 @@
 from typing import TYPE_CHECKING
+import threading
+from collections import deque
 
 import torch
-from torchvision.transforms import v2
 import numpy as np
 
 if TYPE_CHECKING:
     from app.processors.models_processor import ModelsProcessor
 
 from app.processors.utils import faceutil
+from app.processors.utils.letterbox import LetterboxSpec, LetterboxBuffers, letterbox
+
+# Input sizes the 'Auto' detector input size chooses from
+DETECTOR_AUTO_INPUT_SIZES = [256, 320, 512, 640]
+# Default input size, used when there are no recent faces to base the choice on
+DETECTOR_DEFAULT_INPUT_SIZE = 512
+# Size in pixels that the smallest recent face should have at the detector input
+DETECTOR_AUTO_MIN_FACE_SIZE = 64
+
+# Key: detector model name, Value: LetterboxSpec arguments besides the input size
+DETECTOR_LETTERBOX_SPECS = {
+    'RetinaFace': {'mean': 127.5, 'std': 128.0, 'swap_rb': False, 'antialias': True},
+    'SCRFD2.5g': {'mean': 127.5, 'std': 128.0, 'swap_rb': False, 'antialias': True},
+    'YoloFace8n': {'mean': 0.0, 'std': 255.0, 'swap_rb': False, 'antialias': True},
+    'YunetN': {'mean': 0.0, 'std': 1.0, 'swap_rb': True, 'antialias': False},
+}
 
 class FaceDetectors:
     def __init__(self, models_processor: 'ModelsProcessor'):
         self.models_processor = models_processor
+        # Key: (model_name, height, width, stride, num_anchors), Value: anchor centers
+        self.anchor_centers_cache = {}
+        # Key: (model_name, input_size, device), Value: list of free LetterboxBuffers
+        self.input_buffers_pool = {}
+        self.input_buffers_lock = threading.Lock()
+        # Size of the smallest face of the recent frames, relative to the longest side of the frame
+        self.recent_face_sizes = deque(maxlen=30)
+        self.recent_face_sizes_frame_shape = None
+        self.recent_face_sizes_lock = threading.Lock()
+
+    def clear_cache(self):
+        with self.input_buffers_lock:
+            self.anchor_centers_cache.clear()
+            self.input_buffers_pool.clear()
+
+    def get_anchor_centers(self, model_name, height, width, stride, num_anchors=2):
+        key = (model_name, height, width, stride, num_anchors)
+        anchor_centers = self.anchor_centers_cache.get(key)
+        if anchor_centers is None:
+            anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+            anchor_centers = (anchor_centers * stride).reshape( (-1, 2) )
+            if num_anchors > 1:
+                anchor_centers = np.stack([anchor_centers]*num_anchors, axis=1).reshape( (-1,2) )
+            self.anchor_centers_cache[key] = anchor_centers
+        return anchor_centers
+
+    def acquire_input_buffers(self, model_name, input_size) -> LetterboxBuffers:
+        # Frame workers run detection concurrently, so each call takes its own set of buffers from the pool
+        key = (model_name, input_size, self.models_processor.device)
+        with self.input_buffers_lock:
+            pool = self.input_buffers_pool.setdefault(key, [])
+            if pool:
+                return pool.pop()
+        return LetterboxBuffers(LetterboxSpec(input_size, **DETECTOR_LETTERBOX_SPECS[model_name]), self.models_processor.device)
+
+    def release_input_buffers(self, model_name, input_size, buffers: LetterboxBuffers):
+        key = (model_name, input_size, self.models_processor.device)
+        # Drop buffers allocated before a device switch
+        if buffers.device != self.models_processor.device:
+            return
+        with self.input_buffers_lock:
+            self.input_buffers_pool.setdefault(key, []).append(buffers)
+
+    def get_input_size(self, img, input_size):
+        if input_size == 'Auto':
+            return self.get_auto_input_size(img)
+        if isinstance(input_size, str):
+            input_size = int(input_size)
+        if not isinstance(input_size, tuple):
+            input_size = (input_size, input_size)
+        return input_size
+
+    def get_auto_input_size(self, img):
+        frame_size = max(img.size(dim=1), img.size(dim=2))
+        # Don't go beyond the first size that already fits the whole frame
+        sizes = [size for size in DETECTOR_AUTO_INPUT_SIZES if size < frame_size]
+        sizes += [size for size in DETECTOR_AUTO_INPUT_SIZES if size >= frame_size][:1]
+
+        with self.recent_face_sizes_lock:
+            if self.recent_face_sizes_frame_shape != tuple(img.shape):
+                smallest_face_size = None
+            else:
+                smallest_face_size = min(self.recent_face_sizes, default=None)
+
+        if smallest_face_size is None:
+            input_size = max([size for size in sizes if size <= DETECTOR_DEFAULT_INPUT_SIZE], default=sizes[0])
+        else:
+            # Smallest size at which the recent faces are still large enough, close-ups end up on the small sizes
+            input_size = next((size for size in sizes if smallest_face_size * size >= DETECTOR_AUTO_MIN_FACE_SIZE), sizes[-1])
+
+        return (input_size, input_size)
+
+    def update_recent_face_sizes(self, img, bboxes):
+        frame_size = max(img.size(dim=1), img.size(dim=2))
+        with self.recent_face_sizes_lock:
+            # Start over when the media changes
+            if self.recent_face_sizes_frame_shape != tuple(img.shape):
+                self.recent_face_sizes.clear()
+                self.recent_face_sizes_frame_shape = tuple(img.shape)
+
+            if len(bboxes) == 0:
+                # Faces may have been missed because the input size was too small, go back to the default size
+                self.recent_face_sizes.clear()
+            else:
+                self.recent_face_sizes.append(min(max(bbox[2] - bbox[0], bbox[3] - bbox[1]) for bbox in bboxes) / frame_size)
+
+    def get_model_input_size(self, model_name, input_size):
+        # Models exported with a fixed input shape can only be run at that size
+        shape = self.models_processor.models[model_name].get_inputs()[0].shape
+        if isinstance(shape[2], int) and isinstance(shape[3], int):
+            return (shape[3], shape[2])
+        return input_size
 
     def run_detect(self, img, detect_mode='RetinaFace', max_num=1, score=0.5, input_size=(512, 512), use_landmark_detection=False, landmark_detect_mode='203', landmark_score=0.5, from_points=False, rotation_angles=None):
         rotation_angles = rotation_angles or [0]
+        auto_input_size = input_size == 'Auto'
+        input_size = self.get_input_size(img, input_size)
         bboxes = []
         kpss_5 = []
         kpss = []
@@ -35,191 +146,188 @@ class FaceDetectors:
             if not self.models_processor.models['YoloFace8n']:
                 self.models_processor.models['YoloFace8n'] = self.models_processor.load_model('YoloFace8n')
 
-            bboxes, kpss_5, kpss = self.detect_yoloface(img, max_num=max_num, score=score, use_landmark_detection=use_landmark_detection, landmark_detect_mode=landmark_detect_mode, landmark_score=landmark_score, from_points=from_points, rotation_angles=rotation_angles)
+            bboxes, kpss_5, kpss = self.detect_yoloface(img, max_num=max_num, score=score, input_size=input_size, use_landmark_detection=use_landmark_detection, landmark_detect_mode=landmark_detect_mode, landmark_score=landmark_score, from_points=from_points, rotation_angles=rotation_angles)
 
         elif detect_mode=='Yunet':
             if not self.models_processor.models['YunetN']:
                 self.models_processor.models['YunetN'] = self.models_processor.load_model('YunetN')
 
-            bboxes, kpss_5, kpss = self.detect_yunet(img, max_num=max_num, score=score, use_landmark_detection=use_landmark_detection, landmark_detect_mode=landmark_detect_mode, landmark_score=landmark_score, from_points=from_points, rotation_angles=rotation_angles)
+            bboxes, kpss_5, kpss = self.detect_yunet(img, max_num=max_num, score=score, input_size=input_size, use_landmark_detection=use_landmark_detection, landmark_detect_mode=landmark_detect_mode, landmark_score=landmark_score, from_points=from_points, rotation_angles=rotation_angles)
+
+        if auto_input_size:
+            self.update_recent_face_sizes(img, bboxes)
 
         return bboxes, kpss_5, kpss
 
+    def refine_landmarks(self, img_landmark, det, kpss_5, score_values, landmark_detect_mode, landmark_score, from_points):
+        # Detect the landmarks of all the faces at once
+        landmarks_kpss_5, landmarks_kpss, landmarks_scores = self.models_processor.run_detect_landmark_batch(img_landmark, det, kpss_5, landmark_detect_mode, landmark_score, from_points)
+
+        kpss = []
+        for i in range(kpss_5.shape[0]):
+            landmark_kpss_5, landmark_kpss, landmark_scores = landmarks_kpss_5[i], landmarks_kpss[i], landmarks_scores[i]
+            # Always add to kpss, regardless of the length of landmark_kpss.
+            kpss.append(landmark_kpss if len(landmark_kpss) > 0 else kpss_5[i])
+            if len(landmark_kpss_5) > 0:
+                if len(landmark_scores) > 0:
+                    if np.mean(landmark_scores) > np.mean(score_values[i]):
+                        kpss_5[i] = landmark_kpss_5
+                else:
+                    kpss_5[i] = landmark_kpss_5
+
+        return kpss_5, np.array(kpss, dtype=object)
+
     def detect_retinaface(self, img, max_num, score, input_size, use_landmark_detection, landmark_detect_mode, landmark_score, from_points, rotation_angles=None):
         rotation_angles = rotation_angles or [0]
-        img_landmark = None
-        if use_landmark_detection:
-            img_landmark = img.clone()
+        # The frame is not modified in place, so the landmark detection can use it as it is
+        img_landmark = img
+        # Frame size, used to favour the faces close to the center when max_num is set
+        img_height, img_width = (img.size()[1], img.size()[2])
 
         # Resize image to fit within the input_size
         if not isinstance(input_size, tuple):
             input_size = (input_size, input_size)
-        img_height, img_width = (img.size()[1], img.size()[2])
-        im_ratio = torch.div(img_height, img_width)
 
-        model_ratio = 1.0
-        if im_ratio > model_ratio:
-            new_height = input_size[1]
-            new_width = int(new_height / im_ratio)
-        else:
-            new_width = input_size[0]
-            new_height = int(new_width * im_ratio)
-        det_scale = torch.div(new_height,  img.size()[1])
-
-        resize = v2.Resize((new_height, new_width), antialias=True)
-        img = resize(img)
-        img = img.permute(1,2,0)
-
-        det_img = torch.zeros((input_size[1], input_size[0], 3), dtype=torch.float32, device=self.models_processor.device)
-        det_img[:new_height,:new_width,  :] = img
+        # Letterbox and normalize the image in a single pass into the pooled model input
+        input_buffers = self.acquire_input_buffers('RetinaFace', input_size)
+        try:
+            det_img, det_scale = letterbox(img, input_buffers)
+            det_img = det_img[0] #3,input_size[1],input_size[0]
 
-        # Switch to RGB and normalize
-        #det_img = det_img[:, :, [2,1,0]]
-        det_img = torch.sub(det_img, 127.5)
-        det_img = torch.div(det_img, 128.0)
-        det_img = det_img.permute(2, 0, 1) #3,128,128
+            scores_list = []
+            bboxes_list = []
+            kpss_list = []
 
-        scores_list = []
-        bboxes_list = []
-        kpss_list = []
+            cx = input_size[0] / 2  # image center x coordinate
+            cy = input_size[1] / 2  # image center y coordinate
 
-        cx = input_size[0] / 2  # image center x coordinate
-        cy = input_size[1] / 2  # image center y coordinate
-
-        if len(rotation_angles) > 1:
-            do_rotation = True
-        else:
-            do_rotation = False
-
-        for angle in rotation_angles:
-            # Prepare data and find model parameters
-            if angle != 0:
-                aimg, M = faceutil.transform(det_img, (cx, cy), 640, 1.0, angle)
-                IM = faceutil.invertAffineTransform(M)
-                aimg = torch.unsqueeze(aimg, 0).contiguous()
+            if len(rotation_angles) > 1:
+                do_rotation = True
             else:
-                IM = None
-                aimg = torch.unsqueeze(det_img, 0).contiguous()
-
-            io_binding = self.models_processor.models['RetinaFace'].io_binding()
-            io_binding.bind_input(name='input.1', device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
-
-            io_binding.bind_output('448', self.models_processor.device)
-            io_binding.bind_output('471', self.models_processor.device)
-            io_binding.bind_output('494', self.models_processor.device)
-            io_binding.bind_output('451', self.models_processor.device)
-            io_binding.bind_output('474', self.models_processor.device)
-            io_binding.bind_output('497', self.models_processor.device)
-            io_binding.bind_output('454', self.models_processor.device)
-            io_binding.bind_output('477', self.models_processor.device)
-            io_binding.bind_output('500', self.models_processor.device)
-
-            # Sync and run model
-            if self.models_processor.device == "cuda":
-                torch.cuda.synchronize()
-            elif self.models_processor.device != "cpu":
-                self.models_processor.syncvec.cpu()
-            self.models_processor.models['RetinaFace'].run_with_iobinding(io_binding)
-
-            net_outs = io_binding.copy_outputs_to_cpu()
-
-            input_height = aimg.shape[2]
-            input_width = aimg.shape[3]
-
-            fmc = 3
-            center_cache = {}
-            for idx, stride in enumerate([8, 16, 32]):
-                scores = net_outs[idx]
-                bbox_preds = net_outs[idx+fmc]
-                bbox_preds = bbox_preds * stride
-
-                kps_preds = net_outs[idx+fmc*2] * stride
-                height = input_height // stride
-                width = input_width // stride
-                key = (height, width, stride)
-                if key in center_cache:
-                    anchor_centers = center_cache[key]
-                else:
-                    anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
-                    anchor_centers = (anchor_centers * stride).reshape( (-1, 2) )
-                    anchor_centers = np.stack([anchor_centers]*2, axis=1).reshape( (-1,2) )
-                    if len(center_cache)<100:
-                        center_cache[key] = anchor_centers
-
-                pos_inds = np.where(scores>=score)[0]
-
-                x1 = anchor_centers[:, 0] - bbox_preds[:, 0]
-                y1 = anchor_centers[:, 1] - bbox_preds[:, 1]
-                x2 = anchor_centers[:, 0] + bbox_preds[:, 2]
-                y2 = anchor_centers[:, 1] + bbox_preds[:, 3]
-
-                bboxes = np.stack([x1, y1, x2, y2], axis=-1)
+                do_rotation = False
 
-                pos_scores = scores[pos_inds]
-                pos_bboxes = bboxes[pos_inds]
-
-                # bboxes
+            for angle in rotation_angles:
+                # Prepare data and find model parameters
                 if angle != 0:
-                    if len(pos_bboxes) > 0:
-                        # Split the points into coordinates (x1, y1) and (x2, y2)
-                        points1 = pos_bboxes[:, :2]  # (x1, y1)
-                        points2 = pos_bboxes[:, 2:]  # (x2, y2)
-
-                        # Apply the inverse of the rotation matrix to points1 and points2
-                        points1 = faceutil.trans_points2d(points1, IM)
-                        points2 = faceutil.trans_points2d(points2, IM)
-
-                        _x1 = points1[:, 0]
-                        _y1 = points1[:, 1]
-                        _x2 = points2[:, 0]
-                        _y2 = points2[:, 1]
-
-                        if angle in (-270, 90):
-                            # x1, y2, x2, y1
-                            points1 = np.stack((_x1, _y2), axis=1)
-                            points2 = np.stack((_x2, _y1), axis=1)
-                        elif angle in (-180, 180):
-                            # x2, y2, x1, y1
-                            points1 = np.stack((_x2, _y2), axis=1)
-                            points2 = np.stack((_x1, _y1), axis=1)
-                        elif angle in (-90, 270):
-                            # x2, y1, x1, y2
-                            points1 = np.stack((_x2, _y1), axis=1)
-                            points2 = np.stack((_x1, _y2), axis=1)
-
-                        # Reassemble the transformed points into the format [x1', y1', x2', y2']
-                        pos_bboxes = np.hstack((points1, points2))
-
-                # kpss
-                preds = []
-                for i in range(0, kps_preds.shape[1], 2):
-                    px = anchor_centers[:, i%2] + kps_preds[:, i]
-                    py = anchor_centers[:, i%2+1] + kps_preds[:, i+1]
-
-                    preds.append(px)
-                    preds.append(py)
-                kpss = np.stack(preds, axis=-1)
-                kpss = kpss.reshape( (kpss.shape[0], -1, 2) )
-                pos_kpss = kpss[pos_inds]
-
-                if do_rotation:
-                    for i in range(len(pos_kpss)):
-                        face_size = max(pos_bboxes[i][2] - pos_bboxes[i][0], pos_bboxes[i][3] - pos_bboxes[i][1])
-                        angle_deg_to_front = faceutil.get_face_orientation(face_size, pos_kpss[i])
-                        if angle_deg_to_front < -50.00 or angle_deg_to_front > 50.00:
-                            pos_scores[i] = 0.0
-
-                        if angle != 0:
-                            pos_kpss[i] = faceutil.trans_points2d(pos_kpss[i], IM)
-
-                    pos_inds = np.where(pos_scores>=score)[0]
-                    pos_scores = pos_scores[pos_inds]
-                    pos_bboxes = pos_bboxes[pos_inds]
-                    pos_kpss = pos_kpss[pos_inds]
-
-                kpss_list.append(pos_kpss)
-                bboxes_list.append(pos_bboxes)
-                scores_list.append(pos_scores)
+                    aimg, M = faceutil.transform(det_img, (cx, cy), max(input_size), 1.0, angle)
+                    IM = faceutil.invertAffineTransform(M)
+                    aimg = torch.unsqueeze(aimg, 0).contiguous()
+                else:
+                    IM = None
+                    aimg = input_buffers.input
+
+                io_binding = self.models_processor.models['RetinaFace'].io_binding()
+                io_binding.bind_input(name='input.1', device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
+
+                io_binding.bind_output('448', self.models_processor.device)
+                io_binding.bind_output('471', self.models_processor.device)
+                io_binding.bind_output('494', self.models_processor.device)
+                io_binding.bind_output('451', self.models_processor.device)
+                io_binding.bind_output('474', self.models_processor.device)
+                io_binding.bind_output('497', self.models_processor.device)
+                io_binding.bind_output('454', self.models_processor.device)
+                io_binding.bind_output('477', self.models_processor.device)
+                io_binding.bind_output('500', self.models_processor.device)
+
+                # Sync and run model
+                if self.models_processor.device == "cuda":
+                    torch.cuda.synchronize()
+                elif self.models_processor.device != "cpu":
+                    self.models_processor.syncvec.cpu()
+                self.models_processor.models['RetinaFace'].run_with_iobinding(io_binding)
+
+                net_outs = io_binding.copy_outputs_to_cpu()
+
+                input_height = aimg.shape[2]
+                input_width = aimg.shape[3]
+
+                fmc = 3
+                for idx, stride in enumerate([8, 16, 32]):
+                    scores = net_outs[idx]
+                    bbox_preds = net_outs[idx+fmc]
+                    bbox_preds = bbox_preds * stride
+
+                    kps_preds = net_outs[idx+fmc*2] * stride
+                    height = input_height // stride
+                    width = input_width // stride
+                    anchor_centers = self.get_anchor_centers('RetinaFace', height, width, stride)
+
+                    pos_inds = np.where(scores>=score)[0]
+
+                    x1 = anchor_centers[:, 0] - bbox_preds[:, 0]
+                    y1 = anchor_centers[:, 1] - bbox_preds[:, 1]
+                    x2 = anchor_centers[:, 0] + bbox_preds[:, 2]
+                    y2 = anchor_centers[:, 1] + bbox_preds[:, 3]
+
+                    bboxes = np.stack([x1, y1, x2, y2], axis=-1)
+
+                    pos_scores = scores[pos_inds]
+                    pos_bboxes = bboxes[pos_inds]
+
+                    # bboxes
+                    if angle != 0:
+                        if len(pos_bboxes) > 0:
+                            # Split the points into coordinates (x1, y1) and (x2, y2)
+                            points1 = pos_bboxes[:, :2]  # (x1, y1)
+                            points2 = pos_bboxes[:, 2:]  # (x2, y2)
+
+                            # Apply the inverse of the rotation matrix to points1 and points2
+                            points1 = faceutil.trans_points2d(points1, IM)
+                            points2 = faceutil.trans_points2d(points2, IM)
+
+                            _x1 = points1[:, 0]
+                            _y1 = points1[:, 1]
+                            _x2 = points2[:, 0]
+                            _y2 = points2[:, 1]
+
+                            if angle in (-270, 90):
+                                # x1, y2, x2, y1
+                                points1 = np.stack((_x1, _y2), axis=1)
+                                points2 = np.stack((_x2, _y1), axis=1)
+                            elif angle in (-180, 180):
+                                # x2, y2, x1, y1
+                                points1 = np.stack((_x2, _y2), axis=1)
+                                points2 = np.stack((_x1, _y1), axis=1)
+                            elif angle in (-90, 270):
+                                # x2, y1, x1, y2
+                                points1 = np.stack((_x2, _y1), axis=1)
+                                points2 = np.stack((_x1, _y2), axis=1)
+
+                            # Reassemble the transformed points into the format [x1', y1', x2', y2']
+                            pos_bboxes = np.hstack((points1, points2))
+
+                    # kpss
+                    preds = []
+                    for i in range(0, kps_preds.shape[1], 2):
+                        px = anchor_centers[:, i%2] + kps_preds[:, i]
+                        py = anchor_centers[:, i%2+1] + kps_preds[:, i+1]
+
+                        preds.append(px)
+                        preds.append(py)
+                    kpss = np.stack(preds, axis=-1)
+                    kpss = kpss.reshape( (kpss.shape[0], -1, 2) )
+                    pos_kpss = kpss[pos_inds]
+
+                    if do_rotation:
+                        for i in range(len(pos_kpss)):
+                            face_size = max(pos_bboxes[i][2] - pos_bboxes[i][0], pos_bboxes[i][3] - pos_bboxes[i][1])
+                            angle_deg_to_front = faceutil.get_face_orientation(face_size, pos_kpss[i])
+                            if angle_deg_to_front < -50.00 or angle_deg_to_front > 50.00:
+                                pos_scores[i] = 0.0
+
+                            if angle != 0:
+                                pos_kpss[i] = faceutil.trans_points2d(pos_kpss[i], IM)
+
+                        pos_inds = np.where(pos_scores>=score)[0]
+                        pos_scores = pos_scores[pos_inds]
+                        pos_bboxes = pos_bboxes[pos_inds]
+                        pos_kpss = pos_kpss[pos_inds]
+
+                    kpss_list.append(pos_kpss)
+                    bboxes_list.append(pos_bboxes)
+                    scores_list.append(pos_scores)
+        finally:
+            self.release_input_buffers('RetinaFace', input_size, input_buffers)
 
         if len(bboxes_list) == 0:
             return [], [], []
@@ -294,195 +402,160 @@ class FaceDetectors:
 
         kpss_5 = kpss.copy()
         if use_landmark_detection and len(kpss_5) > 0:
-            kpss = []
-            for i in range(kpss_5.shape[0]):
-                landmark_kpss_5, landmark_kpss, landmark_scores = self.models_processor.run_detect_landmark(img_landmark, det[i], kpss_5[i], landmark_detect_mode, landmark_score, from_points)
-                # Always add to kpss, regardless of the length of landmark_kpss.
-                kpss.append(landmark_kpss if len(landmark_kpss) > 0 else kpss_5[i])
-                if len(landmark_kpss_5) > 0:
-                    if len(landmark_scores) > 0:
-                        if np.mean(landmark_scores) > np.mean(score_values[i]):
-                            kpss_5[i] = landmark_kpss_5
-                    else:
-                        kpss_5[i] = landmark_kpss_5
-            kpss = np.array(kpss, dtype=object)
+            kpss_5, kpss = self.refine_landmarks(img_landmark, det, kpss_5, score_values, landmark_detect_mode, landmark_score, from_points)
 
         return det, kpss_5, kpss
 
     def detect_scrdf(self, img, max_num, score, input_size, use_landmark_detection, landmark_detect_mode, landmark_score, from_points, rotation_angles=None):
         rotation_angles = rotation_angles or [0]
-        img_landmark = None
-        if use_landmark_detection:
-            img_landmark = img.clone()
+        # The frame is not modified in place, so the landmark detection can use it as it is
+        img_landmark = img
+        # Frame size, used to favour the faces close to the center when max_num is set
+        img_height, img_width = (img.size()[1], img.size()[2])
 
         # Resize image to fit within the input_size
         if not isinstance(input_size, tuple):
             input_size = (input_size, input_size)
-        img_height, img_width = (img.size()[1], img.size()[2])
-        im_ratio = torch.div(img_height, img_width)
-
-        model_ratio = 1.0
-        if im_ratio > model_ratio:
-            new_height = input_size[1]
-            new_width = int(new_height / im_ratio)
-        else:
-            new_width = input_size[0]
-            new_height = int(new_width * im_ratio)
-        det_scale = torch.div(new_height,  img.size()[1])
-
-        resize = v2.Resize((new_height, new_width), antialias=True)
-        img = resize(img)
-        img = img.permute(1,2,0)
-
-        det_img = torch.zeros((input_size[1], input_size[0], 3), dtype=torch.float32, device=self.models_processor.device)
-        det_img[:new_height,:new_width,  :] = img
 
-        # Switch to RGB and normalize
-        #det_img = det_img[:, :, [2,1,0]]
-        det_img = torch.sub(det_img, 127.5)
-        det_img = torch.div(det_img, 128.0)
-        det_img = det_img.permute(2, 0, 1) #3,128,128
+        # Letterbox and normalize the image in a single pass into the pooled model input
+        input_buffers = self.acquire_input_buffers('SCRFD2.5g', input_size)
+        try:
+            det_img, det_scale = letterbox(img, input_buffers)
+            det_img = det_img[0] #3,input_size[1],input_size[0]
 
-        scores_list = []
-        bboxes_list = []
-        kpss_list = []
+            scores_list = []
+            bboxes_list = []
+            kpss_list = []
 
-        cx = input_size[0] / 2  # image center x coordinate
-        cy = input_size[1] / 2  # image center y coordinate
+            cx = input_size[0] / 2  # image center x coordinate
+            cy = input_size[1] / 2  # image center y coordinate
 
-        if len(rotation_angles) > 1:
-            do_rotation = True
-        else:
-            do_rotation = False
-
-        input_name = self.models_processor.models['SCRFD2.5g'].get_inputs()[0].name
-        outputs = self.models_processor.models['SCRFD2.5g'].get_outputs()
-        output_names = []
-        for o in outputs:
-            output_names.append(o.name)
-
-        for angle in rotation_angles:
-            # Prepare data and find model parameters
-            if angle != 0:
-                aimg, M = faceutil.transform(det_img, (cx, cy), 640, 1.0, angle)
-                IM = faceutil.invertAffineTransform(M)
-                aimg = torch.unsqueeze(aimg, 0).contiguous()
+            if len(rotation_angles) > 1:
+                do_rotation = True
             else:
-                IM = None
-                aimg = torch.unsqueeze(det_img, 0).contiguous()
-
-            io_binding = self.models_processor.models['SCRFD2.5g'].io_binding()
-            io_binding.bind_input(name=input_name, device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
-
-            for i in range(len(output_names)):
-                io_binding.bind_output(output_names[i], self.models_processor.device)
-
-            # Sync and run model
-            if self.models_processor.device == "cuda":
-                torch.cuda.synchronize()
-            elif self.models_processor.device != "cpu":
-                self.models_processor.syncvec.cpu()
-            self.models_processor.models['SCRFD2.5g'].run_with_iobinding(io_binding)
-
-            net_outs = io_binding.copy_outputs_to_cpu()
-
-            input_height = aimg.shape[2]
-            input_width = aimg.shape[3]
-
-            fmc = 3
-            center_cache = {}
-            for idx, stride in enumerate([8, 16, 32]):
-                scores = net_outs[idx]
-                bbox_preds = net_outs[idx+fmc]
-                bbox_preds = bbox_preds * stride
-
-                kps_preds = net_outs[idx+fmc*2] * stride
-                height = input_height // stride
-                width = input_width // stride
-                key = (height, width, stride)
-                if key in center_cache:
-                    anchor_centers = center_cache[key]
-                else:
-                    anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
-                    anchor_centers = (anchor_centers * stride).reshape( (-1, 2) )
-                    anchor_centers = np.stack([anchor_centers]*2, axis=1).reshape( (-1,2) )
-                    if len(center_cache)<100:
-                        center_cache[key] = anchor_centers
-
-                pos_inds = np.where(scores>=score)[0]
-
-                x1 = anchor_centers[:, 0] - bbox_preds[:, 0]
-                y1 = anchor_centers[:, 1] - bbox_preds[:, 1]
-                x2 = anchor_centers[:, 0] + bbox_preds[:, 2]
-                y2 = anchor_centers[:, 1] + bbox_preds[:, 3]
-
-                bboxes = np.stack([x1, y1, x2, y2], axis=-1)
+                do_rotation = False
 
-                pos_scores = scores[pos_inds]
-                pos_bboxes = bboxes[pos_inds]
+            input_name = self.models_processor.models['SCRFD2.5g'].get_inputs()[0].name
+            outputs = self.models_processor.models['SCRFD2.5g'].get_outputs()
+            output_names = []
+            for o in outputs:
+                output_names.append(o.name)
 
-                # bboxes
+            for angle in rotation_angles:
+                # Prepare data and find model parameters
                 if angle != 0:
-                    if len(pos_bboxes) > 0:
-                        # Split the points into coordinates (x1, y1) and (x2, y2)
-                        points1 = pos_bboxes[:, :2]  # (x1, y1)
-                        points2 = pos_bboxes[:, 2:]  # (x2, y2)
-
-                        # Apply the inverse of the rotation matrix to points1 and points2
-                        points1 = faceutil.trans_points2d(points1, IM)
-                        points2 = faceutil.trans_points2d(points2, IM)
-
-                        _x1 = points1[:, 0]
-                        _y1 = points1[:, 1]
-                        _x2 = points2[:, 0]
-                        _y2 = points2[:, 1]
-
-                        if angle in (-270, 90):
-                            # x1, y2, x2, y1
-                            points1 = np.stack((_x1, _y2), axis=1)
-                            points2 = np.stack((_x2, _y1), axis=1)
-                        elif angle in (-180, 180):
-                            # x2, y2, x1, y1
-                            points1 = np.stack((_x2, _y2), axis=1)
-                            points2 = np.stack((_x1, _y1), axis=1)
-                        elif angle in (-90, 270):
-                            # x2, y1, x1, y2
-                            points1 = np.stack((_x2, _y1), axis=1)
-                            points2 = np.stack((_x1, _y2), axis=1)
-
-                        # Reassemble the transformed points into the format [x1', y1', x2', y2']
-                        pos_bboxes = np.hstack((points1, points2))
-
-                # kpss
-                preds = []
-                for i in range(0, kps_preds.shape[1], 2):
-                    px = anchor_centers[:, i%2] + kps_preds[:, i]
-                    py = anchor_centers[:, i%2+1] + kps_preds[:, i+1]
-
-                    preds.append(px)
-                    preds.append(py)
-                kpss = np.stack(preds, axis=-1)
-                kpss = kpss.reshape( (kpss.shape[0], -1, 2) )
-                pos_kpss = kpss[pos_inds]
-
-                if do_rotation:
-                    for i in range(len(pos_kpss)):
-                        face_size = max(pos_bboxes[i][2] - pos_bboxes[i][0], pos_bboxes[i][3] - pos_bboxes[i][1])
-                        angle_deg_to_front = faceutil.get_face_orientation(face_size, pos_kpss[i])
-                        if angle_deg_to_front < -50.00 or angle_deg_to_front > 50.00:
-                            pos_scores[i] = 0.0
-
-                        if angle != 0:
-                            pos_kpss[i] = faceutil.trans_points2d(pos_kpss[i], IM)
-
-                    pos_inds = np.where(pos_scores>=score)[0]
-                    pos_scores = pos_scores[pos_inds]
-                    pos_bboxes = pos_bboxes[pos_inds]
-                    pos_kpss = pos_kpss[pos_inds]
-
-                kpss_list.append(pos_kpss)
-                bboxes_list.append(pos_bboxes)
-                scores_list.append(pos_scores)
+                    aimg, M = faceutil.transform(det_img, (cx, cy), max(input_size), 1.0, angle)
+                    IM = faceutil.invertAffineTransform(M)
+                    aimg = torch.unsqueeze(aimg, 0).contiguous()
+                else:
+                    IM = None
+                    aimg = input_buffers.input
+
+                io_binding = self.models_processor.models['SCRFD2.5g'].io_binding()
+                io_binding.bind_input(name=input_name, device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
+
+                for i in range(len(output_names)):
+                    io_binding.bind_output(output_names[i], self.models_processor.device)
+
+                # Sync and run model
+                if self.models_processor.device == "cuda":
+                    torch.cuda.synchronize()
+                elif self.models_processor.device != "cpu":
+                    self.models_processor.syncvec.cpu()
+                self.models_processor.models['SCRFD2.5g'].run_with_iobinding(io_binding)
+
+                net_outs = io_binding.copy_outputs_to_cpu()
+
+                input_height = aimg.shape[2]
+                input_width = aimg.shape[3]
+
+                fmc = 3
+                for idx, stride in enumerate([8, 16, 32]):
+                    scores = net_outs[idx]
+                    bbox_preds = net_outs[idx+fmc]
+                    bbox_preds = bbox_preds * stride
+
+                    kps_preds = net_outs[idx+fmc*2] * stride
+                    height = input_height // stride
+                    width = input_width // stride
+                    anchor_centers = self.get_anchor_centers('SCRFD2.5g', height, width, stride)
+
+                    pos_inds = np.where(scores>=score)[0]
+
+                    x1 = anchor_centers[:, 0] - bbox_preds[:, 0]
+                    y1 = anchor_centers[:, 1] - bbox_preds[:, 1]
+                    x2 = anchor_centers[:, 0] + bbox_preds[:, 2]
+                    y2 = anchor_centers[:, 1] + bbox_preds[:, 3]
+
+                    bboxes = np.stack([x1, y1, x2, y2], axis=-1)
+
+                    pos_scores = scores[pos_inds]
+                    pos_bboxes = bboxes[pos_inds]
+
+                    # bboxes
+                    if angle != 0:
+                        if len(pos_bboxes) > 0:
+                            # Split the points into coordinates (x1, y1) and (x2, y2)
+                            points1 = pos_bboxes[:, :2]  # (x1, y1)
+                            points2 = pos_bboxes[:, 2:]  # (x2, y2)
+
+                            # Apply the inverse of the rotation matrix to points1 and points2
+                            points1 = faceutil.trans_points2d(points1, IM)
+                            points2 = faceutil.trans_points2d(points2, IM)
+
+                            _x1 = points1[:, 0]
+                            _y1 = points1[:, 1]
+                            _x2 = points2[:, 0]
+                            _y2 = points2[:, 1]
+
+                            if angle in (-270, 90):
+                                # x1, y2, x2, y1
+                                points1 = np.stack((_x1, _y2), axis=1)
+                                points2 = np.stack((_x2, _y1), axis=1)
+                            elif angle in (-180, 180):
+                                # x2, y2, x1, y1
+                                points1 = np.stack((_x2, _y2), axis=1)
+                                points2 = np.stack((_x1, _y1), axis=1)
+                            elif angle in (-90, 270):
+                                # x2, y1, x1, y2
+                                points1 = np.stack((_x2, _y1), axis=1)
+                                points2 = np.stack((_x1, _y2), axis=1)
+
+                            # Reassemble the transformed points into the format [x1', y1', x2', y2']
+                            pos_bboxes = np.hstack((points1, points2))
+
+                    # kpss
+                    preds = []
+                    for i in range(0, kps_preds.shape[1], 2):
+                        px = anchor_centers[:, i%2] + kps_preds[:, i]
+                        py = anchor_centers[:, i%2+1] + kps_preds[:, i+1]
+
+                        preds.append(px)
+                        preds.append(py)
+                    kpss = np.stack(preds, axis=-1)
+                    kpss = kpss.reshape( (kpss.shape[0], -1, 2) )
+                    pos_kpss = kpss[pos_inds]
+
+                    if do_rotation:
+                        for i in range(len(pos_kpss)):
+                            face_size = max(pos_bboxes[i][2] - pos_bboxes[i][0], pos_bboxes[i][3] - pos_bboxes[i][1])
+                            angle_deg_to_front = faceutil.get_face_orientation(face_size, pos_kpss[i])
+                            if angle_deg_to_front < -50.00 or angle_deg_to_front > 50.00:
+                                pos_scores[i] = 0.0
+
+                            if angle != 0:
+                                pos_kpss[i] = faceutil.trans_points2d(pos_kpss[i], IM)
+
+                        pos_inds = np.where(pos_scores>=score)[0]
+                        pos_scores = pos_scores[pos_inds]
+                        pos_bboxes = pos_bboxes[pos_inds]
+                        pos_kpss = pos_kpss[pos_inds]
+
+                    kpss_list.append(pos_kpss)
+                    bboxes_list.append(pos_bboxes)
+                    scores_list.append(pos_scores)
+        finally:
+            self.release_input_buffers('SCRFD2.5g', input_size, input_buffers)
 
         if len(bboxes_list) == 0:
             return [], [], []
@@ -557,170 +630,141 @@ class FaceDetectors:
 
         kpss_5 = kpss.copy()
         if use_landmark_detection and len(kpss_5) > 0:
-            kpss = []
-            for i in range(kpss_5.shape[0]):
-                landmark_kpss_5, landmark_kpss, landmark_scores = self.models_processor.run_detect_landmark(img_landmark, det[i], kpss_5[i], landmark_detect_mode, landmark_score, from_points)
-                # Always add to kpss, regardless of the length of landmark_kpss.
-                kpss.append(landmark_kpss if len(landmark_kpss) > 0 else kpss_5[i])
-                if len(landmark_kpss_5) > 0:
-                    if len(landmark_scores) > 0:
-                        if np.mean(landmark_scores) > np.mean(score_values[i]):
-                            kpss_5[i] = landmark_kpss_5
-                    else:
-                        kpss_5[i] = landmark_kpss_5
-            kpss = np.array(kpss, dtype=object)
+            kpss_5, kpss = self.refine_landmarks(img_landmark, det, kpss_5, score_values, landmark_detect_mode, landmark_score, from_points)
 
         return det, kpss_5, kpss
 
-    def detect_yoloface(self, img, max_num, score, use_landmark_detection, landmark_detect_mode, landmark_score, from_points, rotation_angles=None):
+    def detect_yoloface(self, img, max_num, score, input_size, use_landmark_detection, landmark_detect_mode, landmark_score, from_points, rotation_angles=None):
         rotation_angles = rotation_angles or [0]
-        img_landmark = None
-        if use_landmark_detection:
-            img_landmark = img.clone()
-
-        # Resize image to fit within the input_size
-        input_size = (640, 640)
+        # The frame is not modified in place, so the landmark detection can use it as it is
+        img_landmark = img
+        # Frame size, used to favour the faces close to the center when max_num is set
         img_height, img_width = (img.size()[1], img.size()[2])
-        im_ratio = torch.div(img_height, img_width)
 
-        # model_ratio = float(input_size[1]) / input_size[0]
-        model_ratio = 1.0
-        if im_ratio>model_ratio:
-            new_height = input_size[1]
-            new_width = int(new_height / im_ratio)
-        else:
-            new_width = input_size[0]
-            new_height = int(new_width * im_ratio)
-        det_scale = torch.div(new_height,  img.size()[1])
-
-        resize = v2.Resize((new_height, new_width), antialias=True)
-        img = resize(img)
-        img = img.permute(1,2,0)
-
-        det_img = torch.zeros((input_size[1], input_size[0], 3), dtype=torch.uint8, device=self.models_processor.device)
-        det_img[:new_height,:new_width,  :] = img
+        # Resize image to fit within the input_size
+        input_size = self.get_model_input_size('YoloFace8n', input_size)
 
-        det_img = det_img.permute(2, 0, 1)
+        # Letterbox and normalize the image in a single pass into the pooled model input
+        input_buffers = self.acquire_input_buffers('YoloFace8n', input_size)
+        try:
+            det_img, det_scale = letterbox(img, input_buffers)
+            det_img = det_img[0] #3,input_size[1],input_size[0]
 
-        scores_list = []
-        bboxes_list = []
-        kpss_list = []
+            scores_list = []
+            bboxes_list = []
+            kpss_list = []
 
-        cx = input_size[0] / 2  # image center x coordinate
-        cy = input_size[1] / 2  # image center y coordinate
+            cx = input_size[0] / 2  # image center x coordinate
+            cy = input_size[1] / 2  # image center y coordinate
 
-        if len(rotation_angles) > 1:
-            do_rotation = True
-        else:
-            do_rotation = False
-
-        for angle in rotation_angles:
-            # Prepare data and find model parameters
-            if angle != 0:
-                aimg, M = faceutil.transform(det_img, (cx, cy), 640, 1.0, angle)
-                IM = faceutil.invertAffineTransform(M)
-                aimg = aimg.permute(1, 2, 0)
-                aimg = torch.div(aimg, 255.0)
-                aimg = aimg.permute(2, 0, 1)
-                aimg = torch.unsqueeze(aimg, 0).contiguous()
+            if len(rotation_angles) > 1:
+                do_rotation = True
             else:
-                aimg = det_img.permute(1, 2, 0)
-                aimg = torch.div(aimg, 255.0)
-                aimg = aimg.permute(2, 0, 1)
-                aimg = torch.unsqueeze(aimg, 0).contiguous()
-                IM = None
-
-            io_binding = self.models_processor.models['YoloFace8n'].io_binding()
-            io_binding.bind_input(name='images', device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
-            io_binding.bind_output('output0', self.models_processor.device)
-
-            # Sync and run model
-            if self.models_processor.device == "cuda":
-                torch.cuda.synchronize()
-            elif self.models_processor.device != "cpu":
-                self.models_processor.syncvec.cpu()
-            self.models_processor.models['YoloFace8n'].run_with_iobinding(io_binding)
-
-            net_outs = io_binding.copy_outputs_to_cpu()
-
-            outputs = np.squeeze(net_outs).T
+                do_rotation = False
 
-            bbox_raw, score_raw, kps_raw, *_ = np.split(outputs, [4, 5], axis=1)
-
-            keep_indices = np.where(score_raw > score)[0]
-
-            if keep_indices.any():
-                bbox_raw, kps_raw, score_raw = bbox_raw[keep_indices], kps_raw[keep_indices], score_raw[keep_indices]
-
-                # Compute the transformed bounding box coordinates
-                x1 = bbox_raw[:, 0] - bbox_raw[:, 2] / 2
-                y1 = bbox_raw[:, 1] - bbox_raw[:, 3] / 2
-                x2 = bbox_raw[:, 0] + bbox_raw[:, 2] / 2
-                y2 = bbox_raw[:, 1] + bbox_raw[:, 3] / 2
-
-                # Stack the results into a single array
-                bboxes_raw = np.stack((x1, y1, x2, y2), axis=-1)
-
-                # bboxes
+            for angle in rotation_angles:
+                # Prepare data and find model parameters
                 if angle != 0:
-                    if len(bboxes_raw) > 0:
-                        # Split the points into coordinates (x1, y1) and (x2, y2)
-                        points1 = bboxes_raw[:, :2]  # (x1, y1)
-                        points2 = bboxes_raw[:, 2:]  # (x2, y2)
-
-                        # Apply the inverse of the rotation matrix to points1 and points2
-                        points1 = faceutil.trans_points2d(points1, IM)
-                        points2 = faceutil.trans_points2d(points2, IM)
-
-                        _x1 = points1[:, 0]
-                        _y1 = points1[:, 1]
-                        _x2 = points2[:, 0]
-                        _y2 = points2[:, 1]
-
-                        if angle in (-270, 90):
-                            # x1, y2, x2, y1
-                            points1 = np.stack((_x1, _y2), axis=1)
-                            points2 = np.stack((_x2, _y1), axis=1)
-                        elif angle in (-180, 180):
-                            # x2, y2, x1, y1
-                            points1 = np.stack((_x2, _y2), axis=1)
-                            points2 = np.stack((_x1, _y1), axis=1)
-                        elif angle in (-90, 270):
-                            # x2, y1, x1, y2
-                            points1 = np.stack((_x2, _y1), axis=1)
-                            points2 = np.stack((_x1, _y2), axis=1)
-
-                        # Reassemble the transformed points into the format [x1', y1', x2', y2']
-                        bboxes_raw = np.hstack((points1, points2))
-
-                kps_list = []
-                for kps in kps_raw:
-                    indexes = np.arange(0, len(kps), 3)
-                    temp_kps = []
-                    for index in indexes:
-                        temp_kps.append([kps[index], kps[index + 1]])
-                    kps_list.append(np.array(temp_kps))
-
-                kpss_raw = np.stack(kps_list)
-
-                if do_rotation:
-                    for i in range(len(kpss_raw)):
-                        face_size = max(bboxes_raw[i][2] - bboxes_raw[i][0], bboxes_raw[i][3] - bboxes_raw[i][1])
-                        angle_deg_to_front = faceutil.get_face_orientation(face_size, kpss_raw[i])
-                        if angle_deg_to_front < -50.00 or angle_deg_to_front > 50.00:
-                            score_raw[i] = 0.0
-
-                        if angle != 0:
-                            kpss_raw[i] = faceutil.trans_points2d(kpss_raw[i], IM)
-
-                    keep_indices = np.where(score_raw>=score)[0]
-                    score_raw = score_raw[keep_indices]
-                    bboxes_raw = bboxes_raw[keep_indices]
-                    kpss_raw = kpss_raw[keep_indices]
-
-                kpss_list.append(kpss_raw)
-                bboxes_list.append(bboxes_raw)
-                scores_list.append(score_raw)
+                    aimg, M = faceutil.transform(det_img, (cx, cy), max(input_size), 1.0, angle)
+                    IM = faceutil.invertAffineTransform(M)
+                    aimg = torch.unsqueeze(aimg, 0).contiguous()
+                else:
+                    aimg = input_buffers.input
+                    IM = None
+
+                io_binding = self.models_processor.models['YoloFace8n'].io_binding()
+                io_binding.bind_input(name='images', device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
+                io_binding.bind_output('output0', self.models_processor.device)
+
+                # Sync and run model
+                if self.models_processor.device == "cuda":
+                    torch.cuda.synchronize()
+                elif self.models_processor.device != "cpu":
+                    self.models_processor.syncvec.cpu()
+                self.models_processor.models['YoloFace8n'].run_with_iobinding(io_binding)
+
+                net_outs = io_binding.copy_outputs_to_cpu()
+
+                outputs = np.squeeze(net_outs).T
+
+                bbox_raw, score_raw, kps_raw, *_ = np.split(outputs, [4, 5], axis=1)
+
+                keep_indices = np.where(score_raw > score)[0]
+
+                if keep_indices.any():
+                    bbox_raw, kps_raw, score_raw = bbox_raw[keep_indices], kps_raw[keep_indices], score_raw[keep_indices]
+
+                    # Compute the transformed bounding box coordinates
+                    x1 = bbox_raw[:, 0] - bbox_raw[:, 2] / 2
+                    y1 = bbox_raw[:, 1] - bbox_raw[:, 3] / 2
+                    x2 = bbox_raw[:, 0] + bbox_raw[:, 2] / 2
+                    y2 = bbox_raw[:, 1] + bbox_raw[:, 3] / 2
+
+                    # Stack the results into a single array
+                    bboxes_raw = np.stack((x1, y1, x2, y2), axis=-1)
+
+                    # bboxes
+                    if angle != 0:
+                        if len(bboxes_raw) > 0:
+                            # Split the points into coordinates (x1, y1) and (x2, y2)
+                            points1 = bboxes_raw[:, :2]  # (x1, y1)
+                            points2 = bboxes_raw[:, 2:]  # (x2, y2)
+
+                            # Apply the inverse of the rotation matrix to points1 and points2
+                            points1 = faceutil.trans_points2d(points1, IM)
+                            points2 = faceutil.trans_points2d(points2, IM)
+
+                            _x1 = points1[:, 0]
+                            _y1 = points1[:, 1]
+                            _x2 = points2[:, 0]
+                            _y2 = points2[:, 1]
+
+                            if angle in (-270, 90):
+                                # x1, y2, x2, y1
+                                points1 = np.stack((_x1, _y2), axis=1)
+                                points2 = np.stack((_x2, _y1), axis=1)
+                            elif angle in (-180, 180):
+                                # x2, y2, x1, y1
+                                points1 = np.stack((_x2, _y2), axis=1)
+                                points2 = np.stack((_x1, _y1), axis=1)
+                            elif angle in (-90, 270):
+                                # x2, y1, x1, y2
+                                points1 = np.stack((_x2, _y1), axis=1)
+                                points2 = np.stack((_x1, _y2), axis=1)
+
+                            # Reassemble the transformed points into the format [x1', y1', x2', y2']
+                            bboxes_raw = np.hstack((points1, points2))
+
+                    kps_list = []
+                    for kps in kps_raw:
+                        indexes = np.arange(0, len(kps), 3)
+                        temp_kps = []
+                        for index in indexes:
+                            temp_kps.append([kps[index], kps[index + 1]])
+                        kps_list.append(np.array(temp_kps))
+
+                    kpss_raw = np.stack(kps_list)
+
+                    if do_rotation:
+                        for i in range(len(kpss_raw)):
+                            face_size = max(bboxes_raw[i][2] - bboxes_raw[i][0], bboxes_raw[i][3] - bboxes_raw[i][1])
+                            angle_deg_to_front = faceutil.get_face_orientation(face_size, kpss_raw[i])
+                            if angle_deg_to_front < -50.00 or angle_deg_to_front > 50.00:
+                                score_raw[i] = 0.0
+
+                            if angle != 0:
+                                kpss_raw[i] = faceutil.trans_points2d(kpss_raw[i], IM)
+
+                        keep_indices = np.where(score_raw>=score)[0]
+                        score_raw = score_raw[keep_indices]
+                        bboxes_raw = bboxes_raw[keep_indices]
+                        kpss_raw = kpss_raw[keep_indices]
+
+                    kpss_list.append(kpss_raw)
+                    bboxes_list.append(bboxes_raw)
+                    scores_list.append(score_raw)
+        finally:
+            self.release_input_buffers('YoloFace8n', input_size, input_buffers)
 
         if len(bboxes_list) == 0:
             return [], [], []
@@ -795,186 +839,154 @@ class FaceDetectors:
 
         kpss_5 = kpss.copy()
         if use_landmark_detection and len(kpss_5) > 0:
-            kpss = []
-            for i in range(kpss_5.shape[0]):
-                landmark_kpss_5, landmark_kpss, landmark_scores = self.models_processor.run_detect_landmark(img_landmark, det[i], kpss_5[i], landmark_detect_mode, landmark_score, from_points)
-                # Always add to kpss, regardless of the length of landmark_kpss.
-                kpss.append(landmark_kpss if len(landmark_kpss) > 0 else kpss_5[i])
-                if len(landmark_kpss_5) > 0:
-                    if len(landmark_scores) > 0:
-                        if np.mean(landmark_scores) > np.mean(score_values[i]):
-                            kpss_5[i] = landmark_kpss_5
-                    else:
-                        kpss_5[i] = landmark_kpss_5
-            kpss = np.array(kpss, dtype=object)
+            kpss_5, kpss = self.refine_landmarks(img_landmark, det, kpss_5, score_values, landmark_detect_mode, landmark_score, from_points)
 
         return det, kpss_5, kpss
 
-    def detect_yunet(self, img, max_num, score, use_landmark_detection, landmark_detect_mode, landmark_score, from_points, rotation_angles=None):
+    def detect_yunet(self, img, max_num, score, input_size, use_landmark_detection, landmark_detect_mode, landmark_score, from_points, rotation_angles=None):
         rotation_angles = rotation_angles or [0]
-        img_landmark = None
-        if use_landmark_detection:
-            img_landmark = img.clone()
-
-        # Resize image to fit within the input_size
-        input_size = (640, 640)
+        # The frame is not modified in place, so the landmark detection can use it as it is
+        img_landmark = img
+        # Frame size, used to favour the faces close to the center when max_num is set
         img_height, img_width = (img.size()[1], img.size()[2])
-        im_ratio = torch.div(img_height, img_width)
 
-        model_ratio = 1.0
-        if im_ratio > model_ratio:
-            new_height = input_size[1]
-            new_width = int(new_height / im_ratio)
-        else:
-            new_width = input_size[0]
-            new_height = int(new_width * im_ratio)
-        det_scale = torch.div(new_height,  img.size()[1])
-
-        resize = v2.Resize((new_height, new_width), antialias=False)
-        img = resize(img)
-
-        img = img.permute(1,2,0)
+        # Resize image to fit within the input_size
+        input_size = self.get_model_input_size('YunetN', input_size)
 
-        det_img = torch.zeros((input_size[1], input_size[0], 3), dtype=torch.uint8, device=self.models_processor.device)
-        det_img[:new_height,:new_width,  :] = img
+        # Letterbox and normalize the image in a single pass into the pooled model input
+        input_buffers = self.acquire_input_buffers('YunetN', input_size)
+        try:
+            det_img, det_scale = letterbox(img, input_buffers)
+            det_img = det_img[0] #3,input_size[1],input_size[0]
 
-        # Switch to BGR
-        det_img = det_img[:, :, [2,1,0]]
+            scores_list = []
+            bboxes_list = []
+            kpss_list = []
 
-        det_img = det_img.permute(2, 0, 1) #3,640,640
+            cx = input_size[0] / 2  # image center x coordinate
+            cy = input_size[1] / 2  # image center y coordinate
 
-        scores_list = []
-        bboxes_list = []
-        kpss_list = []
+            if len(rotation_angles) > 1:
+                do_rotation = True
+            else:
+                do_rotation = False
 
-        cx = input_size[0] / 2  # image center x coordinate
-        cy = input_size[1] / 2  # image center y coordinate
+            input_name = self.models_processor.models['YunetN'].get_inputs()[0].name
+            outputs = self.models_processor.models['YunetN'].get_outputs()
+            output_names = []
+            for o in outputs:
+                output_names.append(o.name)
 
-        if len(rotation_angles) > 1:
-            do_rotation = True
-        else:
-            do_rotation = False
-
-        input_name = self.models_processor.models['YunetN'].get_inputs()[0].name
-        outputs = self.models_processor.models['YunetN'].get_outputs()
-        output_names = []
-        for o in outputs:
-            output_names.append(o.name)
-
-        for angle in rotation_angles:
-            # Prepare data and find model parameters
-            if angle != 0:
-                aimg, M = faceutil.transform(det_img, (cx, cy), 640, 1.0, angle)
-                IM = faceutil.invertAffineTransform(M)
-                aimg = torch.unsqueeze(aimg, 0).contiguous()
-            else:
-                IM = None
-                aimg = torch.unsqueeze(det_img, 0).contiguous()
-            aimg = aimg.to(dtype=torch.float32)
-
-            io_binding = self.models_processor.models['YunetN'].io_binding()
-            io_binding.bind_input(name=input_name, device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
-
-            for i in range(len(output_names)):
-                io_binding.bind_output(output_names[i], self.models_processor.device)
-
-            # Sync and run model
-            if self.models_processor.device == "cuda":
-                torch.cuda.synchronize()
-            elif self.models_processor.device != "cpu":
-                self.models_processor.syncvec.cpu()
-            self.models_processor.models['YunetN'].run_with_iobinding(io_binding)
-            net_outs = io_binding.copy_outputs_to_cpu()
-
-            strides = [8, 16, 32]
-            for idx, stride in enumerate(strides):
-                cls_pred = net_outs[idx].reshape(-1, 1)
-                obj_pred = net_outs[idx + len(strides)].reshape(-1, 1)
-                reg_pred = net_outs[idx + len(strides) * 2].reshape(-1, 4)
-                kps_pred = net_outs[idx + len(strides) * 3].reshape(
-                    -1, 5 * 2)
-
-                anchor_centers = np.stack(
-                    np.mgrid[:(input_size[1] // stride), :(input_size[0] //
-                                                            stride)][::-1],
-                    axis=-1)
-                anchor_centers = (anchor_centers * stride).astype(
-                    np.float32).reshape(-1, 2)
-
-                scores = (cls_pred * obj_pred)
-                pos_inds = np.where(scores>=score)[0]
-
-                bbox_cxy = reg_pred[:, :2] * stride + anchor_centers[:]
-                bbox_wh = np.exp(reg_pred[:, 2:]) * stride
-                tl_x = (bbox_cxy[:, 0] - bbox_wh[:, 0] / 2.)
-                tl_y = (bbox_cxy[:, 1] - bbox_wh[:, 1] / 2.)
-                br_x = (bbox_cxy[:, 0] + bbox_wh[:, 0] / 2.)
-                br_y = (bbox_cxy[:, 1] + bbox_wh[:, 1] / 2.)
-
-                bboxes = np.stack([tl_x, tl_y, br_x, br_y], axis=-1)
-
-                pos_scores = scores[pos_inds]
-                pos_bboxes = bboxes[pos_inds]
-
-                # bboxes
+            for angle in rotation_angles:
+                # Prepare data and find model parameters
                 if angle != 0:
-                    if len(pos_bboxes) > 0:
-                        # Split the points into coordinates (x1, y1) and (x2, y2)
-                        points1 = pos_bboxes[:, :2]  # (x1, y1)
-                        points2 = pos_bboxes[:, 2:]  # (x2, y2)
-
-                        # Apply the inverse of the rotation matrix to points1 and points2
-                        points1 = faceutil.trans_points2d(points1, IM)
-                        points2 = faceutil.trans_points2d(points2, IM)
-
-                        _x1 = points1[:, 0]
-                        _y1 = points1[:, 1]
-                        _x2 = points2[:, 0]
-                        _y2 = points2[:, 1]
-
-                        if angle in (-270, 90):
-                            # x1, y2, x2, y1
-                            points1 = np.stack((_x1, _y2), axis=1)
-                            points2 = np.stack((_x2, _y1), axis=1)
-                        elif angle in (-180, 180):
-                            # x2, y2, x1, y1
-                            points1 = np.stack((_x2, _y2), axis=1)
-                            points2 = np.stack((_x1, _y1), axis=1)
-                        elif angle in (-90, 270):
-                            # x2, y1, x1, y2
-                            points1 = np.stack((_x2, _y1), axis=1)
-                            points2 = np.stack((_x1, _y2), axis=1)
-
-                        # Reassemble the transformed points into the format [x1', y1', x2', y2']
-                        pos_bboxes = np.hstack((points1, points2))
-
-                # kpss
-                kpss = np.concatenate(
-                    [((kps_pred[:, [2 * i, 2 * i + 1]] * stride) + anchor_centers)
-                        for i in range(5)],
-                    axis=-1)
-
-                kpss = kpss.reshape( (kpss.shape[0], -1, 2) )
-                pos_kpss = kpss[pos_inds]
-
-                if do_rotation:
-                    for i in range(len(pos_kpss)):
-                        face_size = max(pos_bboxes[i][2] - pos_bboxes[i][0], pos_bboxes[i][3] - pos_bboxes[i][1])
-                        angle_deg_to_front = faceutil.get_face_orientation(face_size, pos_kpss[i])
-                        if angle_deg_to_front < -50.00 or angle_deg_to_front > 50.00:
-                            pos_scores[i] = 0.0
-
-                        if angle != 0:
-                            pos_kpss[i] = faceutil.trans_points2d(pos_kpss[i], IM)
-
-                    pos_inds = np.where(pos_scores>=score)[0]
-                    pos_scores = pos_scores[pos_inds]
-                    pos_bboxes = pos_bboxes[pos_inds]
-                    pos_kpss = pos_kpss[pos_inds]
-
-                kpss_list.append(pos_kpss)
-                bboxes_list.append(pos_bboxes)
-                scores_list.append(pos_scores)
+                    aimg, M = faceutil.transform(det_img, (cx, cy), max(input_size), 1.0, angle)
+                    IM = faceutil.invertAffineTransform(M)
+                    aimg = torch.unsqueeze(aimg, 0).contiguous()
+                else:
+                    IM = None
+                    aimg = input_buffers.input
+
+                io_binding = self.models_processor.models['YunetN'].io_binding()
+                io_binding.bind_input(name=input_name, device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
+
+                for i in range(len(output_names)):
+                    io_binding.bind_output(output_names[i], self.models_processor.device)
+
+                # Sync and run model
+                if self.models_processor.device == "cuda":
+                    torch.cuda.synchronize()
+                elif self.models_processor.device != "cpu":
+                    self.models_processor.syncvec.cpu()
+                self.models_processor.models['YunetN'].run_with_iobinding(io_binding)
+                net_outs = io_binding.copy_outputs_to_cpu()
+
+                strides = [8, 16, 32]
+                for idx, stride in enumerate(strides):
+                    cls_pred = net_outs[idx].reshape(-1, 1)
+                    obj_pred = net_outs[idx + len(strides)].reshape(-1, 1)
+                    reg_pred = net_outs[idx + len(strides) * 2].reshape(-1, 4)
+                    kps_pred = net_outs[idx + len(strides) * 3].reshape(
+                        -1, 5 * 2)
+
+                    anchor_centers = self.get_anchor_centers('YunetN', input_size[1] // stride, input_size[0] // stride, stride, num_anchors=1)
+
+                    scores = (cls_pred * obj_pred)
+                    pos_inds = np.where(scores>=score)[0]
+
+                    bbox_cxy = reg_pred[:, :2] * stride + anchor_centers[:]
+                    bbox_wh = np.exp(reg_pred[:, 2:]) * stride
+                    tl_x = (bbox_cxy[:, 0] - bbox_wh[:, 0] / 2.)
+                    tl_y = (bbox_cxy[:, 1] - bbox_wh[:, 1] / 2.)
+                    br_x = (bbox_cxy[:, 0] + bbox_wh[:, 0] / 2.)
+                    br_y = (bbox_cxy[:, 1] + bbox_wh[:, 1] / 2.)
+
+                    bboxes = np.stack([tl_x, tl_y, br_x, br_y], axis=-1)
+
+                    pos_scores = scores[pos_inds]
+                    pos_bboxes = bboxes[pos_inds]
+
+                    # bboxes
+                    if angle != 0:
+                        if len(pos_bboxes) > 0:
+                            # Split the points into coordinates (x1, y1) and (x2, y2)
+                            points1 = pos_bboxes[:, :2]  # (x1, y1)
+                            points2 = pos_bboxes[:, 2:]  # (x2, y2)
+
+                            # Apply the inverse of the rotation matrix to points1 and points2
+                            points1 = faceutil.trans_points2d(points1, IM)
+                            points2 = faceutil.trans_points2d(points2, IM)
+
+                            _x1 = points1[:, 0]
+                            _y1 = points1[:, 1]
+                            _x2 = points2[:, 0]
+                            _y2 = points2[:, 1]
+
+                            if angle in (-270, 90):
+                                # x1, y2, x2, y1
+                                points1 = np.stack((_x1, _y2), axis=1)
+                                points2 = np.stack((_x2, _y1), axis=1)
+                            elif angle in (-180, 180):
+                                # x2, y2, x1, y1
+                                points1 = np.stack((_x2, _y2), axis=1)
+                                points2 = np.stack((_x1, _y1), axis=1)
+                            elif angle in (-90, 270):
+                                # x2, y1, x1, y2
+                                points1 = np.stack((_x2, _y1), axis=1)
+                                points2 = np.stack((_x1, _y2), axis=1)
+
+                            # Reassemble the transformed points into the format [x1', y1', x2', y2']
+                            pos_bboxes = np.hstack((points1, points2))
+
+                    # kpss
+                    kpss = np.concatenate(
+                        [((kps_pred[:, [2 * i, 2 * i + 1]] * stride) + anchor_centers)
+                            for i in range(5)],
+                        axis=-1)
+
+                    kpss = kpss.reshape( (kpss.shape[0], -1, 2) )
+                    pos_kpss = kpss[pos_inds]
+
+                    if do_rotation:
+                        for i in range(len(pos_kpss)):
+                            face_size = max(pos_bboxes[i][2] - pos_bboxes[i][0], pos_bboxes[i][3] - pos_bboxes[i][1])
+                            angle_deg_to_front = faceutil.get_face_orientation(face_size, pos_kpss[i])
+                            if angle_deg_to_front < -50.00 or angle_deg_to_front > 50.00:
+                                pos_scores[i] = 0.0
+
+                            if angle != 0:
+                                pos_kpss[i] = faceutil.trans_points2d(pos_kpss[i], IM)
+
+                        pos_inds = np.where(pos_scores>=score)[0]
+                        pos_scores = pos_scores[pos_inds]
+                        pos_bboxes = pos_bboxes[pos_inds]
+                        pos_kpss = pos_kpss[pos_inds]
+
+                    kpss_list.append(pos_kpss)
+                    bboxes_list.append(pos_bboxes)
+                    scores_list.append(pos_scores)
+        finally:
+            self.release_input_buffers('YunetN', input_size, input_buffers)
 
         if len(bboxes_list) == 0:
             return [], [], []
@@ -1049,17 +1061,6 @@ class FaceDetectors:
 
         kpss_5 = kpss.copy()
         if use_landmark_detection and len(kpss_5) > 0:
-            kpss = []
-            for i in range(kpss_5.shape[0]):
-                landmark_kpss_5, landmark_kpss, landmark_scores = self.models_processor.run_detect_landmark(img_landmark, det[i], kpss_5[i], landmark_detect_mode, landmark_score, from_points)
-                # Always add to kpss, regardless of the length of landmark_kpss.
-                kpss.append(landmark_kpss if len(landmark_kpss) > 0 else kpss_5[i])
-                if len(landmark_kpss_5) > 0:
-                    if len(landmark_scores) > 0:
-                        if np.mean(landmark_scores) > np.mean(score_values[i]):
-                            kpss_5[i] = landmark_kpss_5
-                    else:
-                        kpss_5[i] = landmark_kpss_5
-            kpss = np.array(kpss, dtype=object)
+            kpss_5, kpss = self.refine_landmarks(img_landmark, det, kpss_5, score_values, landmark_detect_mode, landmark_score, from_points)
 
         return det, kpss_5, kpss
\ No newline at end of file
@@ -6,11 +6,10 @@ import torch
 import numpy as np
 from torch.cuda import nvtx
 
-from torchvision import transforms
 from torchvision.transforms import v2
 
 from app.processors.models_data import models_dir
-from app.processors.utils import faceutil
+from app.processors.utils import faceutil, morphology
 if TYPE_CHECKING:
     from app.processors.models_processor import ModelsProcessor
     
@@ -536,13 +535,9 @@ class FaceEditors:
             17: parameters['HairMakeupEnableToggle'],  # Hair
         }
 
-        # Pre-calculated kernel per dilatazione (kernel 3x3)
-        kernel = torch.ones((1, 1, 3, 3), dtype=torch.float32, device=self.models_processor.device)
-
         # Apply blur if blur kernel size is greater than 1
         blur_kernel_size = parameters['FaceEditorBlurAmountSlider'] * 2 + 1
-        if blur_kernel_size > 1:
-            gauss = transforms.GaussianBlur(blur_kernel_size, (parameters['FaceEditorBlurAmountSlider'] + 1) * 0.2)
+        blur_sigma = (parameters['FaceEditorBlurAmountSlider'] + 1) * 0.2
 
         # Generate masks for each face attribute
         face_parses = []
@@ -556,16 +551,14 @@ class FaceEditors:
                 attribute_parse = torch.reshape(attribute_parse, (1, 1, 512, 512))
 
                 # Dilate the mask (if necessary)
-                for _ in range(1):  # One pass, modify if needed
-                    attribute_parse = torch.nn.functional.conv2d(attribute_parse, kernel, padding=(1, 1))
-                    attribute_parse = torch.clamp(attribute_parse, 0, 1)
+                attribute_parse = morphology.dilate_mask(attribute_parse, 1)  # One pass, modify if needed
 
                 # Squeeze to restore dimensions
                 attribute_parse = torch.squeeze(attribute_parse)
 
                 # Apply blur if required
                 if blur_kernel_size > 1:
-                    attribute_parse = gauss(attribute_parse.unsqueeze(0)).squeeze(0)
+                    attribute_parse = faceutil.gaussian_blur(attribute_parse.unsqueeze(0), blur_kernel_size, blur_sigma).squeeze(0)
 
             else:
                 # If the attribute is not enabled, use a black mask
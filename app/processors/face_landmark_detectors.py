@@ -1,4 +1,3 @@
-from itertools import product as product
 from typing import TYPE_CHECKING
 import pickle
 
@@ -15,74 +14,61 @@ from app.processors.utils import faceutil
 class FaceLandmarkDetectors:
     def __init__(self, models_processor: 'ModelsProcessor'):
         self.models_processor = models_processor
-
-    def run_detect_landmark(self, img, bbox, det_kpss, detect_mode='203', score=0.5, from_points=False):
-        kpss_5 = []
-        kpss = []
-        scores = []
-
+        # Key: (image_size, device), Value: FaceLandmark5 prior boxes tensor
+        self.priors_cache = {}
+
+    def clear_cache(self):
+        self.priors_cache.clear()
+
+    def get_landmark_5_priors(self, image_size=512):
+        key = (image_size, self.models_processor.device)
+        priors = self.priors_cache.get(key)
+        if priors is None:
+            feature_maps = [[64, 64], [32, 32], [16, 16]]
+            min_sizes = [[16, 32], [64, 128], [256, 512]]
+            steps = [8, 16, 32]
+
+            anchors = []
+            for k, f in enumerate(feature_maps):
+                # One [cx, cy, s_kx, s_ky] prior per feature map cell and min size, in row major order
+                rows, cols = np.meshgrid(np.arange(f[0]), np.arange(f[1]), indexing='ij')
+                centers = np.stack([(cols + 0.5) * steps[k] / image_size, (rows + 0.5) * steps[k] / image_size], axis=-1).reshape(-1, 1, 2)
+                sizes = np.array(min_sizes[k], dtype=np.float64).reshape(1, -1, 1) / image_size
+                centers = np.broadcast_to(centers, (centers.shape[0], sizes.shape[1], 2))
+                sizes = np.broadcast_to(sizes, (centers.shape[0], sizes.shape[1], 2))
+                anchors.append(np.concatenate([centers, sizes], axis=-1).reshape(-1, 4))
+
+            priors = torch.from_numpy(np.concatenate(anchors, axis=0).astype(np.float32)).to(self.models_processor.device)
+            self.priors_cache[key] = priors
+        return priors
+
+    def load_landmark_model(self, detect_mode):
         if detect_mode=='5':
             if not self.models_processor.models['FaceLandmark5']:
                 self.models_processor.models['FaceLandmark5'] = self.models_processor.load_model('FaceLandmark5')
 
-                feature_maps = [[64, 64], [32, 32], [16, 16]]
-                min_sizes = [[16, 32], [64, 128], [256, 512]]
-                steps = [8, 16, 32]
-                image_size = 512
-                # re-initialize self.models_processor.anchors due to clear_mem function
-                self.models_processor.anchors  = []
-
-                for k, f in enumerate(feature_maps):
-                    min_size_array = min_sizes[k]
-                    for i, j in product(range(f[0]), range(f[1])):
-                        for min_size in min_size_array:
-                            s_kx = min_size / image_size
-                            s_ky = min_size / image_size
-                            dense_cx = [x * steps[k] / image_size for x in [j + 0.5]]
-                            dense_cy = [y * steps[k] / image_size for y in [i + 0.5]]
-                            for cy, cx in product(dense_cy, dense_cx):
-                                self.models_processor.anchors += [cx, cy, s_kx, s_ky]
-
-            kpss_5, kpss, scores = self.detect_face_landmark_5(img, bbox=bbox, det_kpss=det_kpss, from_points=from_points)
-
         elif detect_mode=='68':
             if not self.models_processor.models['FaceLandmark68']:
                 self.models_processor.models['FaceLandmark68'] = self.models_processor.load_model('FaceLandmark68')
 
-            kpss_5, kpss, scores = self.detect_face_landmark_68(img, bbox=bbox, det_kpss=det_kpss, from_points=from_points)
-
         elif detect_mode=='3d68':
             if not self.models_processor.models['FaceLandmark3d68']:
                 self.models_processor.models['FaceLandmark3d68'] = self.models_processor.load_model('FaceLandmark3d68')
                 with open(f'{models_dir}/meanshape_68.pkl', 'rb') as f:
                     self.models_processor.mean_lmk = pickle.load(f)
 
-            kpss_5, kpss, scores = self.detect_face_landmark_3d68(img, bbox=bbox, det_kpss=det_kpss, from_points=from_points)
-
-            return kpss_5, kpss, scores
-
         elif detect_mode=='98':
             if not self.models_processor.models['FaceLandmark98']:
                 self.models_processor.models['FaceLandmark98'] = self.models_processor.load_model('FaceLandmark98')
 
-            kpss_5, kpss, scores = self.detect_face_landmark_98(img, bbox=bbox, det_kpss=det_kpss, from_points=from_points)
-
         elif detect_mode=='106':
             if not self.models_processor.models['FaceLandmark106']:
                 self.models_processor.models['FaceLandmark106'] = self.models_processor.load_model('FaceLandmark106')
 
-            kpss_5, kpss, scores = self.detect_face_landmark_106(img, bbox=bbox, det_kpss=det_kpss, from_points=from_points)
-
-            return kpss_5, kpss, scores
-
         elif detect_mode=='203':
             if not self.models_processor.models['FaceLandmark203']:
                 self.models_processor.models['FaceLandmark203'] = self.models_processor.load_model('FaceLandmark203')
 
-            kpss_5, kpss, scores = self.detect_face_landmark_203(img, bbox=bbox, det_kpss=det_kpss, from_points=from_points)
-
-            return kpss_5, kpss, scores
-
         elif detect_mode=='478':
             if not self.models_processor.models['FaceLandmark478']:
                 self.models_processor.models['FaceLandmark478'] = self.models_processor.load_model('FaceLandmark478')
@@ -90,19 +76,50 @@ class FaceLandmarkDetectors:
             if not self.models_processor.models['FaceBlendShapes']:
                 self.models_processor.models['FaceBlendShapes'] = self.models_processor.load_model('FaceBlendShapes')
 
-            kpss_5, kpss, scores = self.detect_face_landmark_478(img, bbox=bbox, det_kpss=det_kpss, from_points=from_points)
+    def run_detect_landmark(self, img, bbox, det_kpss, detect_mode='203', score=0.5, from_points=False):
+        kpss_5, kpss, scores = self.run_detect_landmark_batch(img, [bbox], [det_kpss], detect_mode, score, from_points)
 
-            return kpss_5, kpss, scores
+        return kpss_5[0], kpss[0], scores[0]
 
-        if len(kpss_5) > 0:
-            if len(scores) > 0:
-                if np.mean(scores) >= score:
-                    return kpss_5, kpss, scores
-            else:
-                return kpss_5, kpss, scores
+    def run_detect_landmark_batch(self, img, bboxes, det_kpss, detect_mode='203', score=0.5, from_points=False):
+        # Detects the landmarks of all the faces with a single model run per landmark model
+        # Returns one (kpss_5, kpss, scores) entry per face, entries are empty lists when the detection failed
+        if len(bboxes) == 0:
+            return [], [], []
 
-        return [], [], []
+        self.load_landmark_model(detect_mode)
 
+        if detect_mode=='5':
+            results = [self.detect_face_landmark_5(img, bbox=bbox, det_kpss=kps, from_points=from_points) for bbox, kps in zip(bboxes, det_kpss)]
+        elif detect_mode=='68':
+            results = self.detect_face_landmark_68(img, bboxes=bboxes, det_kpss=det_kpss, from_points=from_points)
+        elif detect_mode=='3d68':
+            results = self.detect_face_landmark_3d68(img, bboxes=bboxes, det_kpss=det_kpss, from_points=from_points)
+        elif detect_mode=='98':
+            results = [self.detect_face_landmark_98(img, bbox=bbox, det_kpss=kps, from_points=from_points) for bbox, kps in zip(bboxes, det_kpss)]
+        elif detect_mode=='106':
+            results = self.detect_face_landmark_106(img, bboxes=bboxes, det_kpss=det_kpss, from_points=from_points)
+        elif detect_mode=='203':
+            results = self.detect_face_landmark_203(img, bboxes=bboxes, det_kpss=det_kpss, from_points=from_points)
+        elif detect_mode=='478':
+            results = self.detect_face_landmark_478(img, bboxes=bboxes, det_kpss=det_kpss, from_points=from_points)
+        else:
+            results = [([], [], [])] * len(bboxes)
+
+        kpss_5 = []
+        kpss = []
+        scores = []
+        for landmark_5, landmark, landmark_score in results:
+            # 3d68, 106, 203 and 478 models don't return scores and are not filtered
+            if detect_mode in ('5', '68', '98'):
+                if len(landmark_5) == 0 or (len(landmark_score) > 0 and np.mean(landmark_score) < score):
+                    landmark_5, landmark, landmark_score = [], [], []
+
+            kpss_5.append(landmark_5)
+            kpss.append(landmark)
+            scores.append(landmark_score)
+
+        return kpss_5, kpss, scores
 
     def detect_face_landmark_5(self, img, bbox, det_kpss, from_points=False):
         if from_points == False:
@@ -141,8 +158,7 @@ class FaceLandmarkDetectors:
         self.models_processor.models['FaceLandmark5'].run_with_iobinding(io_binding)
 
         scores = torch.squeeze(conf)[:, 1]
-        priors = torch.tensor(self.models_processor.anchors).view(-1, 4)
-        priors = priors.to(self.models_processor.device)
+        priors = self.get_landmark_5_priors(512)
 
         pre = torch.squeeze(landmarks, 0)
 
@@ -177,100 +193,90 @@ class FaceLandmarkDetectors:
 
         return [], [], []
 
-    def detect_face_landmark_68(self, img, bbox, det_kpss, from_points=False):
-        if from_points == False:
-            crop_image, affine_matrix = faceutil.warp_face_by_bounding_box_for_landmark_68(img, bbox, (256, 256))
-        else:
-            crop_image, affine_matrix = faceutil.warp_face_by_face_landmark_5(img, det_kpss, 256, mode='arcface128', interpolation=v2.InterpolationMode.BILINEAR)
-
-        crop_image = crop_image.to(dtype=torch.float32)
-        crop_image = torch.div(crop_image, 255.0)
-        crop_image = torch.unsqueeze(crop_image, 0).contiguous()
+    def detect_face_landmark_68(self, img, bboxes, det_kpss, from_points=False):
+        crop_images = []
+        affine_matrices = []
+        for bbox, kps in zip(bboxes, det_kpss):
+            if from_points == False:
+                crop_image, affine_matrix = faceutil.warp_face_by_bounding_box_for_landmark_68(img, bbox, (256, 256))
+            else:
+                crop_image, affine_matrix = faceutil.warp_face_by_face_landmark_5(img, kps, 256, mode='arcface128', interpolation=v2.InterpolationMode.BILINEAR)
+            crop_images.append(crop_image)
+            affine_matrices.append(affine_matrix)
+
+        crop_images = torch.stack(crop_images).to(dtype=torch.float32)
+        crop_images = torch.div(crop_images, 255.0)
+
+        face_landmarks_68, face_heatmaps = self.models_processor.run_model_batch('FaceLandmark68', 'input', ['landmarks_xyscore', 'heatmaps'], crop_images)
+
+        results = []
+        for face_landmark_68, face_heatmap, affine_matrix in zip(face_landmarks_68, face_heatmaps, affine_matrices):
+            face_landmark_68 = face_landmark_68[:, :2] / 64.0
+            face_landmark_68 = face_landmark_68.reshape(1, -1, 2) * 256.0
+            face_landmark_68 = cv2.transform(face_landmark_68, cv2.invertAffineTransform(affine_matrix))
+
+            face_landmark_68 = face_landmark_68.reshape(-1, 2)
+            face_landmark_68_score = np.amax(face_heatmap, axis = (1, 2))
+            face_landmark_68_score = face_landmark_68_score.reshape(-1, 1)
+
+            face_landmark_68_5, face_landmark_68_score = faceutil.convert_face_landmark_68_to_5(face_landmark_68, face_landmark_68_score)
+            results.append((face_landmark_68_5, face_landmark_68, face_landmark_68_score))
+
+        return results
+
+    def detect_face_landmark_3d68(self, img, bboxes, det_kpss, from_points=False):
+        aimgs = []
+        Ms = []
+        for bbox, kps in zip(bboxes, det_kpss):
+            if from_points == False:
+                w, h = (bbox[2] - bbox[0]), (bbox[3] - bbox[1])
+                center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
+                rotate = 0
+                _scale = 192  / (max(w, h)*1.5)
+                aimg, M = faceutil.transform(img, center, 192, _scale, rotate)
+            else:
+                aimg, M = faceutil.warp_face_by_face_landmark_5(img, kps, image_size=192, mode='arcface128', interpolation=v2.InterpolationMode.BILINEAR)
+            aimgs.append(aimg)
+            Ms.append(M)
 
-        io_binding = self.models_processor.models['FaceLandmark68'].io_binding()
-        io_binding.bind_input(name='input', device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=crop_image.size(), buffer_ptr=crop_image.data_ptr())
+        aimgs = torch.stack(aimgs).to(dtype=torch.float32)
+        aimgs = self.models_processor.normalize(aimgs)
 
-        io_binding.bind_output('landmarks_xyscore', self.models_processor.device)
-        io_binding.bind_output('heatmaps', self.models_processor.device)
+        preds = self.models_processor.run_model_batch('FaceLandmark3d68', 'data', ['fc1'], aimgs)[0]
 
-        # Sync and run model
-        if self.models_processor.device == "cuda":
-            torch.cuda.synchronize()
-        elif self.models_processor.device != "cpu":
-            self.models_processor.syncvec.cpu()
-        self.models_processor.models['FaceLandmark68'].run_with_iobinding(io_binding)
-        net_outs = io_binding.copy_outputs_to_cpu()
-        face_landmark_68 = net_outs[0]
-        face_heatmap = net_outs[1]
-
-        face_landmark_68 = face_landmark_68[:, :, :2][0] / 64.0
-        face_landmark_68 = face_landmark_68.reshape(1, -1, 2) * 256.0
-        face_landmark_68 = cv2.transform(face_landmark_68, cv2.invertAffineTransform(affine_matrix))
+        results = []
+        for pred, M in zip(preds, Ms):
+            if pred.shape[0] >= 3000:
+                pred = pred.reshape((-1, 3))
+            else:
+                pred = pred.reshape((-1, 2))
+            if 68 < pred.shape[0]:
+                pred = pred[68*-1:,:]
+            pred[:, 0:2] += 1
+            pred[:, 0:2] *= (192 // 2)
+            if pred.shape[1] == 3:
+                pred[:, 2] *= (192 // 2)
 
-        face_landmark_68 = face_landmark_68.reshape(-1, 2)
-        face_landmark_68_score = np.amax(face_heatmap, axis = (2, 3))
-        face_landmark_68_score = face_landmark_68_score.reshape(-1, 1)
+            IM = faceutil.invertAffineTransform(M)
+            pred = faceutil.trans_points3d(pred, IM)
 
-        face_landmark_68_5, face_landmark_68_score = faceutil.convert_face_landmark_68_to_5(face_landmark_68, face_landmark_68_score)
+            # at moment we don't use 3d points
 
-        return face_landmark_68_5, face_landmark_68, face_landmark_68_score
+            #'''
+            #P = faceutil.estimate_affine_matrix_3d23d(self.models_processor.mean_lmk, pred)
+            #s, R, t = faceutil.P2sRt(P)
+            #rx, ry, rz = faceutil.matrix2angle(R)
+            #pose = np.array( [rx, ry, rz], dtype=np.float32 ) #pitch, yaw, roll
+            #'''
 
-    def detect_face_landmark_3d68(self, img, bbox, det_kpss, from_points=False):
-        if from_points == False:
-            w, h = (bbox[2] - bbox[0]), (bbox[3] - bbox[1])
-            center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
-            rotate = 0
-            _scale = 192  / (max(w, h)*1.5)
-            aimg, M = faceutil.transform(img, center, 192, _scale, rotate)
-        else:
-            aimg, M = faceutil.warp_face_by_face_landmark_5(img, det_kpss, image_size=192, mode='arcface128', interpolation=v2.InterpolationMode.BILINEAR)
+            # convert from 3d68 to 2d68 keypoints
+            landmark2d68 = np.array(pred[:, [0, 1]])
 
-        aimg = torch.unsqueeze(aimg, 0).contiguous()
-        aimg = aimg.to(dtype=torch.float32)
-        aimg = self.models_processor.normalize(aimg)
-        io_binding = self.models_processor.models['FaceLandmark3d68'].io_binding()
-        io_binding.bind_input(name='data', device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
+            # convert from 68 to 5 keypoints
+            landmark2d68_5, _ = faceutil.convert_face_landmark_68_to_5(landmark2d68, [])
+            results.append((landmark2d68_5, landmark2d68, []))
 
-        io_binding.bind_output('fc1', self.models_processor.device)
-
-        # Sync and run model
-        if self.models_processor.device == "cuda":
-            torch.cuda.synchronize()
-        elif self.models_processor.device != "cpu":
-            self.models_processor.syncvec.cpu()
-        self.models_processor.models['FaceLandmark3d68'].run_with_iobinding(io_binding)
-        pred = io_binding.copy_outputs_to_cpu()[0][0]
-
-        if pred.shape[0] >= 3000:
-            pred = pred.reshape((-1, 3))
-        else:
-            pred = pred.reshape((-1, 2))
-        if 68 < pred.shape[0]:
-            pred = pred[68*-1:,:]
-        pred[:, 0:2] += 1
-        pred[:, 0:2] *= (192 // 2)
-        if pred.shape[1] == 3:
-            pred[:, 2] *= (192 // 2)
-
-        IM = faceutil.invertAffineTransform(M)
-        pred = faceutil.trans_points3d(pred, IM)
-
-        # at moment we don't use 3d points
-        
-        #'''
-        #P = faceutil.estimate_affine_matrix_3d23d(self.models_processor.mean_lmk, pred)
-        #s, R, t = faceutil.P2sRt(P)
-        #rx, ry, rz = faceutil.matrix2angle(R)
-        #pose = np.array( [rx, ry, rz], dtype=np.float32 ) #pitch, yaw, roll
-        #'''
-
-        # convert from 3d68 to 2d68 keypoints
-        landmark2d68 = np.array(pred[:, [0, 1]])
-
-        # convert from 68 to 5 keypoints
-        landmark2d68_5, _ = faceutil.convert_face_landmark_68_to_5(landmark2d68, [])
-
-        return landmark2d68_5, landmark2d68, []
+        return results
 
     def detect_face_landmark_98(self, img, bbox, det_kpss, from_points=False):
         if from_points == False:
@@ -320,174 +326,152 @@ class FaceLandmarkDetectors:
 
         return landmark_5, landmark, landmark_score
 
-    def detect_face_landmark_106(self, img, bbox, det_kpss, from_points=False):
-        if from_points == False:
-            w, h = (bbox[2] - bbox[0]), (bbox[3] - bbox[1])
-            center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
-            rotate = 0
-            _scale = 192  / (max(w, h)*1.5)
-            #print('param:', img.size(), bbox, center, (192, 192), _scale, rotate)
-            aimg, M = faceutil.transform(img, center, 192, _scale, rotate)
-        else:
-            aimg, M = faceutil.warp_face_by_face_landmark_5(img, det_kpss, image_size=192, mode='arcface128', interpolation=v2.InterpolationMode.BILINEAR)
-
-        aimg = torch.unsqueeze(aimg, 0).contiguous()
-        aimg = aimg.to(dtype=torch.float32)
-        aimg = self.models_processor.normalize(aimg)
-        io_binding = self.models_processor.models['FaceLandmark106'].io_binding()
-        io_binding.bind_input(name='data', device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
-
-        io_binding.bind_output('fc1', self.models_processor.device)
-
-        # Sync and run model
-        if self.models_processor.device == "cuda":
-            torch.cuda.synchronize()
-        elif self.models_processor.device != "cpu":
-            self.models_processor.syncvec.cpu()
-        self.models_processor.models['FaceLandmark106'].run_with_iobinding(io_binding)
-        pred = io_binding.copy_outputs_to_cpu()[0][0]
-
-        if pred.shape[0] >= 3000:
-            pred = pred.reshape((-1, 3))
-        else:
-            pred = pred.reshape((-1, 2))
-
-        if 106 < pred.shape[0]:
-            pred = pred[106*-1:,:]
+    def detect_face_landmark_106(self, img, bboxes, det_kpss, from_points=False):
+        aimgs = []
+        Ms = []
+        for bbox, kps in zip(bboxes, det_kpss):
+            if from_points == False:
+                w, h = (bbox[2] - bbox[0]), (bbox[3] - bbox[1])
+                center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
+                rotate = 0
+                _scale = 192  / (max(w, h)*1.5)
+                #print('param:', img.size(), bbox, center, (192, 192), _scale, rotate)
+                aimg, M = faceutil.transform(img, center, 192, _scale, rotate)
+            else:
+                aimg, M = faceutil.warp_face_by_face_landmark_5(img, kps, image_size=192, mode='arcface128', interpolation=v2.InterpolationMode.BILINEAR)
+            aimgs.append(aimg)
+            Ms.append(M)
 
-        pred[:, 0:2] += 1
-        pred[:, 0:2] *= (192 // 2)
-        if pred.shape[1] == 3:
-            pred[:, 2] *= (192 // 2)
+        aimgs = torch.stack(aimgs).to(dtype=torch.float32)
+        aimgs = self.models_processor.normalize(aimgs)
 
-        IM = faceutil.invertAffineTransform(M)
-        pred = faceutil.trans_points(pred, IM)
+        preds = self.models_processor.run_model_batch('FaceLandmark106', 'data', ['fc1'], aimgs)[0]
 
-        pred_5 = []
-        if pred is not None:
-            # convert from 106 to 5 keypoints
-            pred_5 = faceutil.convert_face_landmark_106_to_5(pred)
+        results = []
+        for pred, M in zip(preds, Ms):
+            if pred.shape[0] >= 3000:
+                pred = pred.reshape((-1, 3))
+            else:
+                pred = pred.reshape((-1, 2))
 
-        return pred_5, pred, []
+            if 106 < pred.shape[0]:
+                pred = pred[106*-1:,:]
 
-    def detect_face_landmark_203(self, img, bbox, det_kpss, from_points=False):
-        IM = None
-        if from_points == False:
-            w, h = (bbox[2] - bbox[0]), (bbox[3] - bbox[1])
-            center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
-            rotate = 0
-            _scale = 224  / (max(w, h)*1.5)
+            pred[:, 0:2] += 1
+            pred[:, 0:2] *= (192 // 2)
+            if pred.shape[1] == 3:
+                pred[:, 2] *= (192 // 2)
 
-            aimg, M = faceutil.transform(img, center, 224, _scale, rotate)
-        elif len(det_kpss) == 0:
-            return [], [], []
-        else:
-            if det_kpss.shape[0] == 5:
-                aimg, M = faceutil.warp_face_by_face_landmark_5(img, det_kpss, image_size=224, mode='arcface128', interpolation=v2.InterpolationMode.BILINEAR)
+            IM = faceutil.invertAffineTransform(M)
+            pred = faceutil.trans_points(pred, IM)
+
+            pred_5 = []
+            if pred is not None:
+                # convert from 106 to 5 keypoints
+                pred_5 = faceutil.convert_face_landmark_106_to_5(pred)
+            results.append((pred_5, pred, []))
+
+        return results
+
+    def detect_face_landmark_203(self, img, bboxes, det_kpss, from_points=False):
+        results = [([], [], [])] * len(bboxes)
+        aimgs = []
+        IMs = []
+        face_indexes = []
+        for i, (bbox, kps) in enumerate(zip(bboxes, det_kpss)):
+            IM = None
+            if from_points == False:
+                w, h = (bbox[2] - bbox[0]), (bbox[3] - bbox[1])
+                center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
+                rotate = 0
+                _scale = 224  / (max(w, h)*1.5)
+
+                aimg, M = faceutil.transform(img, center, 224, _scale, rotate)
+            elif len(kps) == 0:
+                continue
             else:
-                aimg, M, IM = faceutil.warp_face_by_face_landmark_x(img, det_kpss, dsize=224, scale=1.5, vy_ratio=-0.1, interpolation=v2.InterpolationMode.BILINEAR)
+                if kps.shape[0] == 5:
+                    aimg, M = faceutil.warp_face_by_face_landmark_5(img, kps, image_size=224, mode='arcface128', interpolation=v2.InterpolationMode.BILINEAR)
+                else:
+                    aimg, M, IM = faceutil.warp_face_by_face_landmark_x(img, kps, dsize=224, scale=1.5, vy_ratio=-0.1, interpolation=v2.InterpolationMode.BILINEAR)
 
-        aimg = torch.unsqueeze(aimg, 0).contiguous()
-        aimg = aimg.to(dtype=torch.float32)
-        aimg = torch.div(aimg, 255.0)
-        io_binding = self.models_processor.models['FaceLandmark203'].io_binding()
-        io_binding.bind_input(name='input', device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
+            if len(kps) == 0 or kps.shape[0] == 5:
+                IM = faceutil.invertAffineTransform(M)
 
-        io_binding.bind_output('output', self.models_processor.device)
-        io_binding.bind_output('853', self.models_processor.device)
-        io_binding.bind_output('856', self.models_processor.device)
+            aimgs.append(aimg)
+            IMs.append(IM)
+            face_indexes.append(i)
 
-        # Sync and run model
-        if self.models_processor.device == "cuda":
-            torch.cuda.synchronize()
-        elif self.models_processor.device != "cpu":
-            self.models_processor.syncvec.cpu()
-        self.models_processor.models['FaceLandmark203'].run_with_iobinding(io_binding)
-        out_lst = io_binding.copy_outputs_to_cpu()
-        out_pts = out_lst[2]
+        if len(aimgs) == 0:
+            return results
 
-        out_pts = out_pts.reshape((-1, 2)) * 224.0
+        aimgs = torch.stack(aimgs).to(dtype=torch.float32)
+        aimgs = torch.div(aimgs, 255.0)
 
-        if len(det_kpss) == 0 or det_kpss.shape[0] == 5:
-            IM = faceutil.invertAffineTransform(M)
+        out_lst = self.models_processor.run_model_batch('FaceLandmark203', 'input', ['output', '853', '856'], aimgs)
 
-        out_pts = faceutil.trans_points(out_pts, IM)
+        for i, out_pts, IM in zip(face_indexes, out_lst[2], IMs):
+            out_pts = out_pts.reshape((-1, 2)) * 224.0
 
-        out_pts_5 = []
-        if out_pts is not None:
-            # convert from 203 to 5 keypoints
-            out_pts_5 = faceutil.convert_face_landmark_203_to_5(out_pts)
+            out_pts = faceutil.trans_points(out_pts, IM)
 
-        return out_pts_5, out_pts, []
+            out_pts_5 = []
+            if out_pts is not None:
+                # convert from 203 to 5 keypoints
+                out_pts_5 = faceutil.convert_face_landmark_203_to_5(out_pts)
+            results[i] = (out_pts_5, out_pts, [])
 
-    def detect_face_landmark_478(self, img, bbox, det_kpss, from_points=False):
-        if from_points == False:
-            w, h = (bbox[2] - bbox[0]), (bbox[3] - bbox[1])
-            center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
-            rotate = 0
-            _scale = 256.0  / (max(w, h)*1.5)
-            #print('param:', img.size(), bbox, center, (192, 192), _scale, rotate)
-            aimg, M = faceutil.transform(img, center, 256, _scale, rotate)
-        else:
-            aimg, M = faceutil.warp_face_by_face_landmark_5(img, det_kpss, 256, mode='arcfacemap', interpolation=v2.InterpolationMode.BILINEAR)
+        return results
 
-        aimg = torch.unsqueeze(aimg, 0).contiguous()
-        aimg = aimg.to(dtype=torch.float32)
-        aimg = torch.div(aimg, 255.0)
-        io_binding = self.models_processor.models['FaceLandmark478'].io_binding()
-        io_binding.bind_input(name='input_12', device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=aimg.size(), buffer_ptr=aimg.data_ptr())
+    def detect_face_landmark_478(self, img, bboxes, det_kpss, from_points=False):
+        aimgs = []
+        Ms = []
+        for bbox, kps in zip(bboxes, det_kpss):
+            if from_points == False:
+                w, h = (bbox[2] - bbox[0]), (bbox[3] - bbox[1])
+                center = (bbox[2] + bbox[0]) / 2, (bbox[3] + bbox[1]) / 2
+                rotate = 0
+                _scale = 256.0  / (max(w, h)*1.5)
+                #print('param:', img.size(), bbox, center, (192, 192), _scale, rotate)
+                aimg, M = faceutil.transform(img, center, 256, _scale, rotate)
+            else:
+                aimg, M = faceutil.warp_face_by_face_landmark_5(img, kps, 256, mode='arcfacemap', interpolation=v2.InterpolationMode.BILINEAR)
+            aimgs.append(aimg)
+            Ms.append(M)
 
-        io_binding.bind_output('Identity', self.models_processor.device)
-        io_binding.bind_output('Identity_1', self.models_processor.device)
-        io_binding.bind_output('Identity_2', self.models_processor.device)
+        aimgs = torch.stack(aimgs).to(dtype=torch.float32)
+        aimgs = torch.div(aimgs, 255.0)
 
-        # Sync and run model
-        if self.models_processor.device == "cuda":
-            torch.cuda.synchronize()
-        elif self.models_processor.device != "cpu":
-            self.models_processor.syncvec.cpu()
-        self.models_processor.models['FaceLandmark478'].run_with_iobinding(io_binding)
-        landmarks, faceflag, blendshapes = io_binding.copy_outputs_to_cpu() # pylint: disable=unused-variable
-        landmarks = landmarks.reshape( (1,478,3))
+        landmarks, faceflag, blendshapes = self.models_processor.run_model_batch('FaceLandmark478', 'input_12', ['Identity', 'Identity_1', 'Identity_2'], aimgs) # pylint: disable=unused-variable
+        landmarks = landmarks.reshape((-1,478,3))
 
-        landmark = []
-        landmark_5 = []
-        landmark_score = [] # pylint: disable=unused-variable
-        if len(landmarks) > 0:
-            for one_face_landmarks in landmarks:
-                landmark = one_face_landmarks
-                IM = faceutil.invertAffineTransform(M)
-                landmark = faceutil.trans_points3d(landmark, IM)
-
-                #'''
-                #P = faceutil.estimate_affine_matrix_3d23d(self.models_processor.mean_lmk, landmark)
-                #s, R, t = faceutil.P2sRt(P)
-                #rx, ry, rz = faceutil.matrix2angle(R)
-                #pose = np.array( [rx, ry, rz], dtype=np.float32 ) #pitch, yaw, roll
-                #'''
-                landmark = landmark[:, [0, 1]].reshape(-1,2)
-
-                #get scores
-                landmark_for_score = landmark[self.models_processor.LandmarksSubsetIdxs]
-                landmark_for_score = landmark_for_score[:, :2]
-                landmark_for_score = np.expand_dims(landmark_for_score, axis=0)
-                landmark_for_score = landmark_for_score.astype(np.float32)
-                landmark_for_score = torch.from_numpy(landmark_for_score).to(self.models_processor.device)
-
-                io_binding_bs = self.models_processor.models['FaceBlendShapes'].io_binding()
-                io_binding_bs.bind_input(name='input_points', device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=tuple(landmark_for_score.shape), buffer_ptr=landmark_for_score.data_ptr())
-                io_binding_bs.bind_output('output', self.models_processor.device)
-
-                # Sync and run model
-                if self.models_processor.device == "cuda":
-                    torch.cuda.synchronize()
-                elif self.models_processor.device != "cpu":
-                    self.models_processor.syncvec.cpu()
-                self.models_processor.models['FaceBlendShapes'].run_with_iobinding(io_binding_bs)
-                landmark_score = io_binding_bs.copy_outputs_to_cpu()[0] # pylint: disable=unused-variable
-
-                # convert from 478 to 5 keypoints
-                landmark_5 = faceutil.convert_face_landmark_478_to_5(landmark)
+        landmarks_2d = []
+        landmarks_for_score = []
+        for one_face_landmarks, M in zip(landmarks, Ms):
+            IM = faceutil.invertAffineTransform(M)
+            landmark = faceutil.trans_points3d(one_face_landmarks, IM)
+
+            #'''
+            #P = faceutil.estimate_affine_matrix_3d23d(self.models_processor.mean_lmk, landmark)
+            #s, R, t = faceutil.P2sRt(P)
+            #rx, ry, rz = faceutil.matrix2angle(R)
+            #pose = np.array( [rx, ry, rz], dtype=np.float32 ) #pitch, yaw, roll
+            #'''
+            landmark = landmark[:, [0, 1]].reshape(-1,2)
+            landmarks_2d.append(landmark)
+
+            #get scores
+            landmark_for_score = landmark[self.models_processor.LandmarksSubsetIdxs]
+            landmarks_for_score.append(landmark_for_score[:, :2])
+
+        landmarks_for_score = torch.from_numpy(np.stack(landmarks_for_score).astype(np.float32)).to(self.models_processor.device)
+        landmark_scores = self.models_processor.run_model_batch('FaceBlendShapes', 'input_points', ['output'], landmarks_for_score)[0] # pylint: disable=unused-variable
+
+        results = []
+        for landmark in landmarks_2d:
+            # convert from 478 to 5 keypoints
+            landmark_5 = faceutil.convert_face_landmark_478_to_5(landmark)
+            results.append((landmark_5, landmark, []))
 
         #return landmark, landmark_score
-        return landmark_5, landmark, []
\ No newline at end of file
+        return results
\ No newline at end of file
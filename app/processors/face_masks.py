@@ -7,6 +7,7 @@ from torchvision.transforms import v2
 
 from app.processors.external.clipseg import CLIPDensePredT
 from app.processors.models_data import models_dir
+from app.processors.utils import faceutil, morphology
 if TYPE_CHECKING:
     from app.processors.models_processor import ModelsProcessor
 
@@ -15,107 +16,81 @@ class FaceMasks:
         self.models_processor = models_processor
 
     def apply_occlusion(self, img, amount):
-        img = torch.div(img, 255)
-        img = torch.unsqueeze(img, 0).contiguous()
-        outpred = torch.ones((256,256), dtype=torch.float32, device=self.models_processor.device).contiguous()
+        return self.apply_occlusion_batch(torch.unsqueeze(img, 0), [amount])[0]
+
+    def apply_occlusion_batch(self, imgs, amounts):
+        # imgs is a [N,3,256,256] batch of faces, the occluder runs once for all of them
+        imgs = torch.div(imgs, 255).contiguous()
+        outpreds = torch.ones((imgs.size(dim=0),1,256,256), dtype=torch.float32, device=self.models_processor.device).contiguous()
 
-        self.models_processor.run_occluder(img, outpred)
+        self.models_processor.run_occluder(imgs, outpreds)
 
+        return [self.get_occlusion_mask(outpreds[i, 0], amount) for i, amount in enumerate(amounts)]
+
+    def get_occlusion_mask(self, outpred, amount):
         outpred = torch.squeeze(outpred)
         outpred = (outpred > 0)
         outpred = torch.unsqueeze(outpred, 0).type(torch.float32)
 
-        if amount >0:
-            kernel = torch.ones((1,1,3,3), dtype=torch.float32, device=self.models_processor.device)
-
-            for _ in range(int(amount)):
-                outpred = torch.nn.functional.conv2d(outpred, kernel, padding=(1, 1))
-                outpred = torch.clamp(outpred, 0, 1)
-
-            outpred = torch.squeeze(outpred)
-
-        if amount <0:
-            outpred = torch.neg(outpred)
-            outpred = torch.add(outpred, 1)
-            kernel = torch.ones((1,1,3,3), dtype=torch.float32, device=self.models_processor.device)
-
-            for _ in range(int(-amount)):
-                outpred = torch.nn.functional.conv2d(outpred, kernel, padding=(1, 1))
-                outpred = torch.clamp(outpred, 0, 1)
-
-            outpred = torch.squeeze(outpred)
-            outpred = torch.neg(outpred)
-            outpred = torch.add(outpred, 1)
+        outpred = morphology.grow_mask(outpred, int(amount))
 
         outpred = torch.reshape(outpred, (1, 256, 256))
         return outpred
 
-    def run_occluder(self, image, output):
-        if not self.models_processor.models['Occluder']:
-            self.models_processor.models['Occluder'] = self.models_processor.load_model('Occluder')
+    def run_mask_model_batch(self, model_name, input_name, output_name, image, output):
+        # image and output have the batch as first dimension, models exported with a fixed batch size are run once per face
+        if not self.models_processor.models[model_name]:
+            self.models_processor.models[model_name] = self.models_processor.load_model(model_name)
+        model = self.models_processor.models[model_name]
 
-        io_binding = self.models_processor.models['Occluder'].io_binding()
-        io_binding.bind_input(name='img', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=(1,3,256,256), buffer_ptr=image.data_ptr())
-        io_binding.bind_output(name='output', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=(1,1,256,256), buffer_ptr=output.data_ptr())
+        batch_size = image.size(dim=0)
+        if batch_size > 1 and isinstance(model.get_inputs()[0].shape[0], int):
+            items = [(image[i:i+1], output[i:i+1]) for i in range(batch_size)]
+        else:
+            items = [(image, output)]
 
         if self.models_processor.device == "cuda":
             torch.cuda.synchronize()
         elif self.models_processor.device != "cpu":
             self.models_processor.syncvec.cpu()
-        self.models_processor.models['Occluder'].run_with_iobinding(io_binding)
+        for item_image, item_output in items:
+            io_binding = model.io_binding()
+            io_binding.bind_input(name=input_name, device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=item_image.size(), buffer_ptr=item_image.data_ptr())
+            io_binding.bind_output(name=output_name, device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=item_output.size(), buffer_ptr=item_output.data_ptr())
+            model.run_with_iobinding(io_binding)
+
+    def run_occluder(self, image, output):
+        # image is [N,3,256,256] and output [N,1,256,256]
+        self.run_mask_model_batch('Occluder', 'img', 'output', image, output.view(-1, 1, 256, 256))
 
     def apply_dfl_xseg(self, img, amount):
-        img = img.type(torch.float32)
-        img = torch.div(img, 255)
-        img = torch.unsqueeze(img, 0).contiguous()
-        outpred = torch.ones((256,256), dtype=torch.float32, device=self.models_processor.device).contiguous()
+        return self.apply_dfl_xseg_batch(torch.unsqueeze(img, 0), [amount])[0]
+
+    def apply_dfl_xseg_batch(self, imgs, amounts):
+        # imgs is a [N,3,256,256] batch of faces, XSeg runs once for all of them
+        imgs = imgs.type(torch.float32)
+        imgs = torch.div(imgs, 255).contiguous()
+        outpreds = torch.ones((imgs.size(dim=0),1,256,256), dtype=torch.float32, device=self.models_processor.device).contiguous()
+
+        self.run_dfl_xseg(imgs, outpreds)
 
-        self.run_dfl_xseg(img, outpred)
+        return [self.get_dfl_xseg_mask(outpreds[i, 0], amount) for i, amount in enumerate(amounts)]
 
+    def get_dfl_xseg_mask(self, outpred, amount):
         outpred = torch.clamp(outpred, min=0.0, max=1.0)
         outpred[outpred < 0.1] = 0
         # invert values to mask areas to keep
         outpred = 1.0 - outpred
         outpred = torch.unsqueeze(outpred, 0).type(torch.float32)
 
-        if amount > 0:
-            kernel = torch.ones((1,1,3,3), dtype=torch.float32, device=self.models_processor.device)
-
-            for _ in range(int(amount)):
-                outpred = torch.nn.functional.conv2d(outpred, kernel, padding=(1, 1))
-                outpred = torch.clamp(outpred, 0, 1)
-
-            outpred = torch.squeeze(outpred)
-
-        if amount < 0:
-            outpred = torch.neg(outpred)
-            outpred = torch.add(outpred, 1)
-            kernel = torch.ones((1,1,3,3), dtype=torch.float32, device=self.models_processor.device)
-
-            for _ in range(int(-amount)):
-                outpred = torch.nn.functional.conv2d(outpred, kernel, padding=(1, 1))
-                outpred = torch.clamp(outpred, 0, 1)
-
-            outpred = torch.squeeze(outpred)
-            outpred = torch.neg(outpred)
-            outpred = torch.add(outpred, 1)
+        outpred = morphology.grow_mask(outpred, int(amount))
 
         outpred = torch.reshape(outpred, (1, 256, 256))
         return outpred
 
     def run_dfl_xseg(self, image, output):
-        if not self.models_processor.models['XSeg']:
-            self.models_processor.models['XSeg'] = self.models_processor.load_model('XSeg')
-
-        io_binding = self.models_processor.models['XSeg'].io_binding()
-        io_binding.bind_input(name='in_face:0', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=image.size(), buffer_ptr=image.data_ptr())
-        io_binding.bind_output(name='out_mask:0', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=(1,1,256,256), buffer_ptr=output.data_ptr())
-
-        if self.models_processor.device == "cuda":
-            torch.cuda.synchronize()
-        elif self.models_processor.device != "cpu":
-            self.models_processor.syncvec.cpu()
-        self.models_processor.models['XSeg'].run_with_iobinding(io_binding)
+        # image is [N,3,256,256] and output [N,1,256,256]
+        self.run_mask_model_batch('XSeg', 'in_face:0', 'out_mask:0', image, output.view(-1, 1, 256, 256))
         
     def apply_face_parser(self, img, parameters):
         # atts = [1 'skin', 2 'l_brow', 3 'r_brow', 4 'l_eye', 5 'r_eye', 6 'eye_g', 7 'l_ear', 8 'r_ear', 9 'ear_r', 10 'nose', 11 'mouth', 12 'u_lip', 13 'l_lip', 14 'neck', 15 'neck_l', 16 'cloth', 17 'hair', 18 'hat']
@@ -146,24 +121,16 @@ class FaceMasks:
             17: parameters['HairParserSlider'], #Hair
         }
         
-        # Pre-calculated kernel for dilation (3x3 kernel to reduce iterations)
-        kernel = torch.ones((1, 1, 3, 3), dtype=torch.float32, device=self.models_processor.device)  # Kernel 3x3
-
         face_parses = []
         for attribute, attribute_value in face_attributes.items():
             if attribute_value > 0:
                 attribute_idxs = torch.tensor( [attribute], device=self.models_processor.device)
                 iters = int(attribute_value)
 
-                attribute_parse = torch.isin(outpred, attribute_idxs)
-                attribute_parse = torch.clamp(~attribute_parse, 0, 1).type(torch.float32)
+                attribute_parse = torch.isin(outpred, attribute_idxs).type(torch.float32)
                 attribute_parse = torch.reshape(attribute_parse, (1,1,512,512))
-                attribute_parse = torch.neg(attribute_parse)
-                attribute_parse = torch.add(attribute_parse, 1)
 
-                for _ in range(iters):
-                    attribute_parse = torch.nn.functional.conv2d(attribute_parse, kernel, padding=(1, 1))
-                    attribute_parse = torch.clamp(attribute_parse, 0, 1)
+                attribute_parse = morphology.dilate_mask(attribute_parse, iters)
 
                 attribute_parse = torch.squeeze(attribute_parse)
                 attribute_parse = torch.neg(attribute_parse)
@@ -173,8 +140,7 @@ class FaceMasks:
                 # Apply Gaussian blur if needed
                 blur_kernel_size = parameters['FaceBlurParserSlider'] * 2 + 1
                 if blur_kernel_size > 1:
-                    gauss = transforms.GaussianBlur(blur_kernel_size, (parameters['FaceBlurParserSlider'] + 1) * 0.2)
-                    attribute_parse = gauss(attribute_parse)
+                    attribute_parse = faceutil.gaussian_blur(attribute_parse, blur_kernel_size, (parameters['FaceBlurParserSlider'] + 1) * 0.2)
             else:
                 attribute_parse = torch.ones((1, 512, 512), dtype=torch.float32, device=self.models_processor.device)
             face_parses.append(attribute_parse)
@@ -186,28 +152,20 @@ class FaceMasks:
         bg_parse = 1 - torch.isin(outpred, bg_idxs).float().unsqueeze(0).unsqueeze(0)  # (1, 1, 512, 512)
 
         if FaceAmount > 0:
-            for _ in range(int(FaceAmount)):
-                bg_parse = torch.nn.functional.conv2d(bg_parse, kernel, padding=(1, 1))  # Padding (1, 1) for 3x3 kernel
-                bg_parse = torch.clamp(bg_parse, 0, 1)
+            bg_parse = morphology.dilate_mask(bg_parse, int(FaceAmount))
 
             blur_kernel_size = parameters['BackgroundBlurParserSlider'] * 2 + 1
             if blur_kernel_size > 1:
-                gauss = transforms.GaussianBlur(blur_kernel_size, (parameters['BackgroundBlurParserSlider'] + 1) * 0.2)
-                bg_parse = gauss(bg_parse)
+                bg_parse = faceutil.gaussian_blur(bg_parse, blur_kernel_size, (parameters['BackgroundBlurParserSlider'] + 1) * 0.2)
 
             bg_parse = torch.clamp(bg_parse, 0, 1)
 
         elif FaceAmount < 0:
-            bg_parse = 1 - bg_parse  # Invert mask back
-            for _ in range(int(-FaceAmount)):
-                bg_parse = torch.nn.functional.conv2d(bg_parse, kernel, padding=(1, 1))  # Padding (1, 1) for 3x3 kernel
-                bg_parse = torch.clamp(bg_parse, 0, 1)
-
-            bg_parse = 1 - bg_parse  # Re-invert back
+            # Erode the face so that the black background expands
+            bg_parse = morphology.erode_mask(bg_parse, int(-FaceAmount))
             blur_kernel_size = parameters['BackgroundBlurParserSlider'] * 2 + 1
             if blur_kernel_size > 1:
-                gauss = transforms.GaussianBlur(blur_kernel_size, (parameters['BackgroundBlurParserSlider'] + 1) * 0.2)
-                bg_parse = gauss(bg_parse)
+                bg_parse = faceutil.gaussian_blur(bg_parse, blur_kernel_size, (parameters['BackgroundBlurParserSlider'] + 1) * 0.2)
 
             bg_parse = torch.clamp(bg_parse, 0, 1)
 
@@ -1,3 +1,7 @@
+import threading
+import weakref
+from functools import partial
+
 import torch
 from skimage import transform as trans
 from torchvision.transforms import v2
@@ -13,23 +17,94 @@ from app.helpers.miscellaneous import is_file_exists
 class FaceSwappers:
     def __init__(self, models_processor: 'ModelsProcessor'):
         self.models_processor = models_processor
+        # Key: (swapper_model, id(embedding)), Value: (embedding, latent tensor on the device)
+        self.swapper_latents_cache = {}
+        self.swapper_latents_lock = threading.Lock()
+        # Key: image tensor, Value: {(kps, template, size): uint8 recognition crop}
+        # Entries go away with the image, so crops are only shared between the recognition models run on the same image
+        self.recognition_crops_cache = weakref.WeakKeyDictionary()
+        self.recognition_crops_lock = threading.Lock()
+
+    def clear_swapper_latents_cache(self):
+        with self.swapper_latents_lock:
+            self.swapper_latents_cache.clear()
+
+    def invalidate_swapper_latents(self, embeddings):
+        # Drops the latents computed from the given embeddings, for all the swapper models
+        embedding_ids = {id(embedding) for embedding in embeddings}
+        with self.swapper_latents_lock:
+            for key in [key for key in self.swapper_latents_cache if key[1] in embedding_ids]:
+                del self.swapper_latents_cache[key]
+
+    def calc_swapper_latent(self, swapper_model, source_embedding):
+        if swapper_model == 'Inswapper128':
+            return self.calc_inswapper_latent(source_embedding)
+        elif swapper_model in ('InStyleSwapper256 Version A', 'InStyleSwapper256 Version B', 'InStyleSwapper256 Version C'):
+            return self.calc_swapper_latent_iss(source_embedding, swapper_model[-1])
+        elif swapper_model == 'SimSwap512':
+            return self.calc_swapper_latent_simswap512(source_embedding)
+        elif swapper_model in ('GhostFace-v1', 'GhostFace-v2', 'GhostFace-v3'):
+            return self.calc_swapper_latent_ghost(source_embedding)
+        elif swapper_model == 'CSCS':
+            return self.calc_swapper_latent_cscs(source_embedding)
+        raise ValueError(f"No latent for swapper model {swapper_model}")
+
+    def get_swapper_latent(self, swapper_model, source_embedding):
+        # The latent of an embedding doesn't change during a render, it is computed and copied to the device only once
+        # The embedding is kept in the cache entry so that its id can't be reused by another array
+        key = (swapper_model, id(source_embedding))
+        with self.swapper_latents_lock:
+            cached = self.swapper_latents_cache.get(key)
+        if cached is not None and cached[0] is source_embedding:
+            return cached[1]
+
+        latent = torch.from_numpy(self.calc_swapper_latent(swapper_model, source_embedding)).float().to(self.models_processor.device)
+        with self.swapper_latents_lock:
+            # Entries of embeddings that are not used anymore are only dropped when the cache gets too large
+            if len(self.swapper_latents_cache) >= 256:
+                self.swapper_latents_cache.clear()
+            self.swapper_latents_cache[key] = (source_embedding, latent)
+        return latent
 
     def run_recognize_direct(self, img, kps, similarity_type='Opal', arcface_model='Inswapper128ArcFace'):
+        embeddings, cropped_images = self.run_recognize_direct_batch(img, [kps], similarity_type, arcface_model)
+
+        return embeddings[0], cropped_images[0]
+
+    def run_recognize_direct_batch(self, img, kpss, similarity_type='Opal', arcface_model='Inswapper128ArcFace'):
+        # Recognizes all the faces of the image with a single model run, returns a [N,D] embeddings matrix and the N cropped faces
+        # img can also be a list with the image of each face, to recognize faces of different images together
         if not self.models_processor.models[arcface_model]:
             self.models_processor.models[arcface_model] = self.models_processor.load_model(arcface_model)
 
+        if len(kpss) == 0:
+            return np.empty((0, 512), dtype=np.float32), []
+
         if arcface_model == 'CSCSArcFace':
-            embedding, cropped_image = self.recognize_cscs(img, kps)
+            embeddings, cropped_images = self.recognize_cscs(img, kpss)
         else:
-            embedding, cropped_image = self.recognize(arcface_model, img, kps, similarity_type=similarity_type)
+            embeddings, cropped_images = self.recognize(arcface_model, img, kpss, similarity_type=similarity_type)
 
-        return embedding, cropped_image
+        return embeddings, cropped_images
         
     def run_recognize(self, img, kps, similarity_type='Opal', face_swapper_model='Inswapper128'):
         arcface_model = self.models_processor.get_arcface_model(face_swapper_model)
         return self.run_recognize_direct(img, kps, similarity_type, arcface_model)
 
-    def recognize(self, arcface_model, img, face_kps, similarity_type):
+    def get_recognition_crop(self, img, face_kps, template, size, warp_function):
+        # Returns the crop of the face for the given template, warped only once per image and shared by the recognition models
+        key = (np.asarray(face_kps, dtype=np.float32).tobytes(), template, size)
+        with self.recognition_crops_lock:
+            image_crops = self.recognition_crops_cache.get(img)
+            if image_crops is not None and key in image_crops:
+                return image_crops[key]
+
+        crop = warp_function(img, face_kps)
+        with self.recognition_crops_lock:
+            self.recognition_crops_cache.setdefault(img, {})[key] = crop
+        return crop
+
+    def warp_arcface_crop(self, img, face_kps, similarity_type):
         if similarity_type == 'Optimal':
             # Find transform & Transform
             img, _ = faceutil.warp_face_by_face_landmark_5(img, face_kps, mode='arcfacemap', interpolation=v2.InterpolationMode.BILINEAR)
@@ -54,6 +129,12 @@ class FaceSwappers:
             img = v2.functional.affine(img, tform.rotation*57.2958, (tform.translation[0], tform.translation[1]) , tform.scale, 0, center = (0,0) )
             img = v2.functional.crop(img, 0,0, 112, 112)
 
+        return img
+
+    def get_recognition_input(self, arcface_model, img, face_kps, similarity_type):
+        # Inswapper128ArcFace, SimSwapArcFace and GhostArcFace use the same crop, only the normalization is different
+        img = self.get_recognition_crop(img, face_kps, similarity_type, 112, partial(self.warp_arcface_crop, similarity_type=similarity_type))
+
         if arcface_model == 'Inswapper128ArcFace':
             cropped_image = img.permute(1, 2, 0).clone()
             if img.dtype == torch.uint8:
@@ -73,8 +154,19 @@ class FaceSwappers:
             img = torch.div(img, 127.5)
             img = torch.sub(img, 1)
 
+        return img, cropped_image
+
+    def recognize(self, arcface_model, img, faces_kps, similarity_type):
+        faces_imgs = img if isinstance(img, list) else [img] * len(faces_kps)
+        imgs = []
+        cropped_images = []
+        for face_img, face_kps in zip(faces_imgs, faces_kps):
+            face_img, cropped_image = self.get_recognition_input(arcface_model, face_img, face_kps, similarity_type)
+            imgs.append(face_img)
+            cropped_images.append(cropped_image)
+
         # Prepare data and find model parameters
-        img = torch.unsqueeze(img, 0).contiguous()
+        imgs = torch.stack(imgs)
         input_name = self.models_processor.models[arcface_model].get_inputs()[0].name
 
         outputs = self.models_processor.models[arcface_model].get_outputs()
@@ -82,30 +174,22 @@ class FaceSwappers:
         for o in outputs:
             output_names.append(o.name)
 
-        io_binding = self.models_processor.models[arcface_model].io_binding()
-        io_binding.bind_input(name=input_name, device_type=self.models_processor.device, device_id=0, element_type=np.float32,  shape=img.size(), buffer_ptr=img.data_ptr())
+        outputs = self.models_processor.run_model_batch(arcface_model, input_name, output_names, imgs)
 
-        for i in range(len(output_names)):
-            io_binding.bind_output(output_names[i], self.models_processor.device)
+        # Return embeddings, one row per face
+        return np.concatenate([output.reshape((len(cropped_images), -1)) for output in outputs], axis=1), cropped_images
 
-        # Sync and run model
-        if self.models_processor.device == "cuda":
-            torch.cuda.synchronize()
-        elif self.models_processor.device != "cpu":
-            self.models_processor.syncvec.cpu()
-        self.models_processor.models[arcface_model].run_with_iobinding(io_binding)
-
-        # Return embedding
-        return np.array(io_binding.copy_outputs_to_cpu()).flatten(), cropped_image
-
-    def preprocess_image_cscs(self, img, face_kps):
+    def warp_cscs_crop(self, img, face_kps):
         tform = trans.SimilarityTransform()
         tform.estimate(face_kps, self.models_processor.FFHQ_kps)
 
         temp = v2.functional.affine(img, tform.rotation*57.2958, (tform.translation[0], tform.translation[1]) , tform.scale, 0, center = (0,0) )
         temp = v2.functional.crop(temp, 0,0, 512, 512)
         
-        image = v2.Resize((112, 112), interpolation=v2.InterpolationMode.BILINEAR, antialias=False)(temp)
+        return v2.Resize((112, 112), interpolation=v2.InterpolationMode.BILINEAR, antialias=False)(temp)
+
+    def preprocess_image_cscs(self, img, face_kps):
+        image = self.get_recognition_crop(img, face_kps, 'CSCS', 112, self.warp_cscs_crop)
         
         cropped_image = image.permute(1, 2, 0).clone()
         if image.dtype == torch.uint8:
@@ -116,30 +200,26 @@ class FaceSwappers:
         # Ritorna l'immagine e l'immagine ritagliata
         return torch.unsqueeze(image, 0).contiguous(), cropped_image  # (C, H, W) e (H, W, C)
 
-    def recognize_cscs(self, img, face_kps):
+    def recognize_cscs(self, img, faces_kps):
         # Usa la funzione di preprocessamento
-        img, cropped_image = self.preprocess_image_cscs(img, face_kps)
+        faces_imgs = img if isinstance(img, list) else [img] * len(faces_kps)
+        imgs = []
+        cropped_images = []
+        for face_img, face_kps in zip(faces_imgs, faces_kps):
+            face_img, cropped_image = self.preprocess_image_cscs(face_img, face_kps)
+            imgs.append(face_img)
+            cropped_images.append(cropped_image)
+        imgs = torch.cat(imgs, dim=0)
 
-        io_binding = self.models_processor.models['CSCSArcFace'].io_binding()
-        io_binding.bind_input(name='input', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=img.size(), buffer_ptr=img.data_ptr())
-        io_binding.bind_output(name='output', device_type=self.models_processor.device)
+        output = self.models_processor.run_model_batch('CSCSArcFace', 'input', ['output'], imgs)[0]
+        embeddings = torch.from_numpy(output.reshape((len(cropped_images), -1))).to('cpu')
+        embeddings = torch.nn.functional.normalize(embeddings, dim=-1, p=2)
+        embeddings = embeddings.numpy()
 
-        if self.models_processor.device == "cuda":
-            torch.cuda.synchronize()
-        elif self.models_processor.device != "cpu":
-            self.models_processor.syncvec.cpu()
-
-        self.models_processor.models['CSCSArcFace'].run_with_iobinding(io_binding)
-
-        output = io_binding.copy_outputs_to_cpu()[0]
-        embedding = torch.from_numpy(output).to('cpu')
-        embedding = torch.nn.functional.normalize(embedding, dim=-1, p=2)
-        embedding = embedding.numpy().flatten()
+        embeddings_id = self.recognize_cscs_id_adapter(imgs, None)
+        embeddings = embeddings + embeddings_id
 
-        embedding_id = self.recognize_cscs_id_adapter(img, None)
-        embedding = embedding + embedding_id
-
-        return embedding, cropped_image
+        return embeddings, cropped_images
 
     def recognize_cscs_id_adapter(self, img, face_kps):
         if not self.models_processor.models['CSCSIDArcFace']:
@@ -149,22 +229,12 @@ class FaceSwappers:
         if face_kps is not None:
             img, _ = self.preprocess_image_cscs(img, face_kps)
 
-        io_binding = self.models_processor.models['CSCSIDArcFace'].io_binding()
-        io_binding.bind_input(name='input', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=img.size(), buffer_ptr=img.data_ptr())
-        io_binding.bind_output(name='output', device_type=self.models_processor.device)
-
-        if self.models_processor.device == "cuda":
-            torch.cuda.synchronize()
-        elif self.models_processor.device != "cpu":
-            self.models_processor.syncvec.cpu()
-            
-        self.models_processor.models['CSCSIDArcFace'].run_with_iobinding(io_binding)
-
-        output = io_binding.copy_outputs_to_cpu()[0]
-        embedding_id = torch.from_numpy(output).to('cpu')
+        output = self.models_processor.run_model_batch('CSCSIDArcFace', 'input', ['output'], img)[0]
+        embedding_id = torch.from_numpy(output.reshape((img.size(dim=0), -1))).to('cpu')
         embedding_id = torch.nn.functional.normalize(embedding_id, dim=-1, p=2)
 
-        return embedding_id.numpy().flatten()
+        # One row per face
+        return embedding_id.numpy()
 
     def calc_swapper_latent_cscs(self, source_embedding):
         latent = source_embedding.reshape((1,-1))
@@ -207,6 +277,50 @@ class FaceSwappers:
             self.models_processor.syncvec.cpu()
         self.models_processor.models['Inswapper128'].run_with_iobinding(io_binding)
 
+    def run_inswapper_batch(self, images, embedding, output):
+        # images and output are [N,3,128,128] contiguous tensors, embedding is either [1,512] for all the images or [N,512]
+        if not self.models_processor.models['Inswapper128']:
+            self.models_processor.models['Inswapper128'] = self.models_processor.load_model('Inswapper128')
+        model = self.models_processor.models['Inswapper128']
+        batch_size = images.size(dim=0)
+
+        embeddings = embedding.reshape(-1, 512)
+        if embeddings.size(dim=0) == 1:
+            embeddings = embeddings.expand(batch_size, 512)
+        embeddings = embeddings.contiguous()
+        fixed_batch = isinstance(model.get_inputs()[0].shape[0], int)
+
+        # Round up the batch size for TensorRT like run_model_batch, the number of sub-images changes with the faces and the resolution
+        padded_output = output
+        if not fixed_batch and batch_size > 1 and self.models_processor.provider_name in ['TensorRT', 'TensorRT-Engine']:
+            padded_size = 1 << (batch_size - 1).bit_length()
+            if padded_size > batch_size:
+                images = torch.cat([images, images.new_zeros((padded_size - batch_size, 3, 128, 128))], dim=0)
+                embeddings = torch.cat([embeddings, embeddings.new_zeros((padded_size - batch_size, 512))], dim=0)
+                padded_output = output.new_empty((padded_size, 3, 128, 128))
+
+        io_binding = model.io_binding()
+        if self.models_processor.device == "cuda":
+            torch.cuda.synchronize()
+        elif self.models_processor.device != "cpu":
+            self.models_processor.syncvec.cpu()
+
+        # Models exported with a fixed batch size are run once per image, rebinding slices of the same buffers
+        if fixed_batch:
+            for i in range(batch_size):
+                io_binding.bind_input(name='source', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=(1,512), buffer_ptr=embeddings[i].data_ptr())
+                io_binding.bind_input(name='target', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=(1,3,128,128), buffer_ptr=images[i].data_ptr())
+                io_binding.bind_output(name='output', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=(1,3,128,128), buffer_ptr=output[i].data_ptr())
+                model.run_with_iobinding(io_binding)
+            return
+
+        io_binding.bind_input(name='target', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=tuple(images.shape), buffer_ptr=images.data_ptr())
+        io_binding.bind_input(name='source', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=tuple(embeddings.shape), buffer_ptr=embeddings.data_ptr())
+        io_binding.bind_output(name='output', device_type=self.models_processor.device, device_id=0, element_type=np.float32, shape=tuple(padded_output.shape), buffer_ptr=padded_output.data_ptr())
+        model.run_with_iobinding(io_binding)
+        if padded_output is not output:
+            output.copy_(padded_output[:batch_size])
+
     def calc_swapper_latent_ghost(self, source_embedding):
         latent = source_embedding.reshape((1,-1))
 
@@ -29,6 +29,8 @@ from app.processors.face_swappers import FaceSwappers
 from app.processors.frame_enhancers import FrameEnhancers
 from app.processors.face_editors import FaceEditors
 from app.processors.utils.dfm_model import DFMModel
+from app.processors.utils.face_matcher import TargetFaceMatcher
+from app.processors.utils.tensor_arena import TensorArenaPool
 from app.processors.models_data import models_list, arcface_mapping_model_dict, models_trt_list
 from app.helpers.miscellaneous import is_file_exists
 from app.helpers.downloader import download_file
@@ -111,12 +113,14 @@ class ModelsProcessor(QtCore.QObject):
         self.face_swappers = FaceSwappers(self)
         self.frame_enhancers = FrameEnhancers(self)
         self.face_editors = FaceEditors(self)
+        self.target_face_matcher = TargetFaceMatcher()
+        # Buffers of the frame workers, reused across frames
+        self.tensor_arena_pool = TensorArenaPool()
 
         self.clip_session = []
         self.arcface_dst = np.array( [[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366], [41.5493, 92.3655], [70.7299, 92.2041]], dtype=np.float32)
         self.FFHQ_kps = np.array([[ 192.98138, 239.94708 ], [ 318.90277, 240.1936 ], [ 256.63416, 314.01935 ], [ 201.26117, 371.41043 ], [ 313.08905, 371.15118 ] ])
         self.mean_lmk = []
-        self.anchors  = []
         self.emap = []
         self.LandmarksSubsetIdxs = [
             0, 1, 4, 5, 6, 7, 8, 10, 13, 14, 17, 21, 33, 37, 39,
@@ -261,6 +265,10 @@ class ModelsProcessor(QtCore.QObject):
         self.providers = providers
         self.provider_name = provider_name
         self.lp_mask_crop = self.lp_mask_crop.to(self.device)
+        # Cached anchors and preprocessing buffers are bound to the previous provider/device
+        self.face_detectors.clear_cache()
+        self.face_landmark_detectors.clear_cache()
+        self.face_swappers.clear_swapper_latents_cache()
 
         return self.provider_name
 
@@ -285,6 +293,7 @@ class ModelsProcessor(QtCore.QObject):
         self.delete_models()
         self.delete_models_dfm()
         self.delete_models_trt()
+        self.tensor_arena_pool.clear()
         torch.cuda.empty_cache()
 
 
@@ -296,6 +305,38 @@ class ModelsProcessor(QtCore.QObject):
                 self.emap = onnx.numpy_helper.to_array(graph.initializer[-1])
                 self.main_window.model_loaded_signal.emit()
 
+    def run_model_batch(self, model_name, input_name, output_names, images):
+        # Runs the model on a batch of inputs, returns the outputs as numpy arrays with the batch as first dimension
+        model = self.models[model_name]
+        batch_size = images.size(dim=0)
+
+        # Models exported with a fixed batch size are run once per input
+        if batch_size > 1 and isinstance(model.get_inputs()[0].shape[0], int):
+            outputs = [self.run_model_batch(model_name, input_name, output_names, images[i:i+1]) for i in range(batch_size)]
+            return [np.concatenate([output[k] for output in outputs], axis=0) for k in range(len(output_names))]
+
+        # Round up the batch size for TensorRT, so that crowds of varying sizes don't trigger a rebuild of the engine for every new size
+        if batch_size > 1 and self.provider_name in ['TensorRT', 'TensorRT-Engine']:
+            padded_size = 1 << (batch_size - 1).bit_length()
+            if padded_size > batch_size:
+                images = torch.cat([images, images.new_zeros((padded_size - batch_size, *images.shape[1:]))], dim=0)
+
+        images = images.contiguous()
+        io_binding = model.io_binding()
+        io_binding.bind_input(name=input_name, device_type=self.device, device_id=0, element_type=np.float32,  shape=images.size(), buffer_ptr=images.data_ptr())
+
+        for output_name in output_names:
+            io_binding.bind_output(output_name, self.device)
+
+        # Sync and run model
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+        elif self.device != "cpu":
+            self.syncvec.cpu()
+        model.run_with_iobinding(io_binding)
+
+        return [output[:batch_size] for output in io_binding.copy_outputs_to_cpu()]
+
     def run_detect(self, img, detect_mode='RetinaFace', max_num=1, score=0.5, input_size=(512, 512), use_landmark_detection=False, landmark_detect_mode='203', landmark_score=0.5, from_points=False, rotation_angles=None):
         rotation_angles = rotation_angles or [0]
         return self.face_detectors.run_detect(img, detect_mode, max_num, score, input_size, use_landmark_detection, landmark_detect_mode, landmark_score, from_points, rotation_angles)
@@ -303,6 +344,9 @@ class ModelsProcessor(QtCore.QObject):
     def run_detect_landmark(self, img, bbox, det_kpss, detect_mode='203', score=0.5, from_points=False):
         return self.face_landmark_detectors.run_detect_landmark(img, bbox, det_kpss, detect_mode, score, from_points)
 
+    def run_detect_landmark_batch(self, img, bboxes, det_kpss, detect_mode='203', score=0.5, from_points=False):
+        return self.face_landmark_detectors.run_detect_landmark_batch(img, bboxes, det_kpss, detect_mode, score, from_points)
+
     def get_arcface_model(self, face_swapper_model): 
         if face_swapper_model in arcface_mapping_model_dict:
             return arcface_mapping_model_dict[face_swapper_model]
@@ -312,12 +356,24 @@ class ModelsProcessor(QtCore.QObject):
     def run_recognize_direct(self, img, kps, similarity_type='Opal', arcface_model='Inswapper128ArcFace'):
         return self.face_swappers.run_recognize_direct(img, kps, similarity_type, arcface_model)
 
+    def run_recognize_direct_batch(self, img, kpss, similarity_type='Opal', arcface_model='Inswapper128ArcFace'):
+        return self.face_swappers.run_recognize_direct_batch(img, kpss, similarity_type, arcface_model)
+
+    def get_swapper_latent(self, swapper_model, source_embedding):
+        return self.face_swappers.get_swapper_latent(swapper_model, source_embedding)
+
+    def invalidate_swapper_latents(self, embeddings):
+        self.face_swappers.invalidate_swapper_latents(embeddings)
+
     def calc_inswapper_latent(self, source_embedding):
         return self.face_swappers.calc_inswapper_latent(source_embedding)
 
     def run_inswapper(self, image, embedding, output):
         self.face_swappers.run_inswapper(image, embedding, output)
 
+    def run_inswapper_batch(self, images, embedding, output):
+        self.face_swappers.run_inswapper_batch(images, embedding, output)
+
     def calc_swapper_latent_iss(self, source_embedding, version="A"):
         return self.face_swappers.calc_swapper_latent_iss(source_embedding, version)
 
@@ -399,14 +455,23 @@ class ModelsProcessor(QtCore.QObject):
         cos_dist = 1 - np.dot(vector1, vector2)/(np.linalg.norm(vector1)*np.linalg.norm(vector2)) # 2..0
         return 100-cos_dist*50
 
+    def match_target_faces(self, faces_embeddings, target_faces, recognition_model, thresholds, one_to_one=False):
+        return self.target_face_matcher.match(faces_embeddings, target_faces, recognition_model, thresholds, one_to_one)
+
     def apply_facerestorer(self, swapped_face_upscaled, restorer_det_type, restorer_type, restorer_blend, fidelity_weight, detect_score):
         return self.face_restorers.apply_facerestorer(swapped_face_upscaled, restorer_det_type, restorer_type, restorer_blend, fidelity_weight, detect_score)
 
     def apply_occlusion(self, img, amount):
         return self.face_masks.apply_occlusion(img, amount)
+
+    def apply_occlusion_batch(self, imgs, amounts):
+        return self.face_masks.apply_occlusion_batch(imgs, amounts)
     
     def apply_dfl_xseg(self, img, amount):
         return self.face_masks.apply_dfl_xseg(img, amount)
+
+    def apply_dfl_xseg_batch(self, imgs, amounts):
+        return self.face_masks.apply_dfl_xseg_batch(imgs, amounts)
     
     def apply_face_parser(self, img, parameters):
         return self.face_masks.apply_face_parser(img, parameters)
@@ -0,0 +1,71 @@
+import threading
+from typing import List
+
+import numpy as np
+import torch
+
+from app.processors.utils.embedding_cache import get_bbox_iou
+
+def get_kps_bbox(kps):
+    # Bounding box of the keypoints of a face, the swapped faces don't keep the bbox of the detector
+    kps = np.asarray(kps, dtype=np.float32)
+    return [float(kps[:, 0].min()), float(kps[:, 1].min()), float(kps[:, 0].max()), float(kps[:, 1].max())]
+
+def smooth_statistics(previous, current, smoothing):
+    # Exponential moving average of the statistics tensors, smoothing is the weight of the previous statistics
+    return tuple(torch.lerp(c, p, smoothing) if c.is_floating_point() else c for p, c in zip(previous, current))
+
+class ColorTransferTrack:
+    def __init__(self, bbox, statistics, frame_number, shot_id, key):
+        self.bbox = bbox
+        self.frame_number = frame_number
+        self.shot_id = shot_id
+        self.key = key
+        self.statistics = statistics
+        # Frame the statistics were last computed on
+        self.ref_frame_number = frame_number
+
+class TrackColorTransferCache:
+    """
+    Color transfer statistics (histogram CDFs or LAB mean and std) of the faces tracked across the frames of a video.
+    The lighting of a tracked face changes slowly, so the statistics are computed again only every refresh_interval
+    frames, and smoothed with the previous ones, which also removes the frame to frame flicker of the colors.
+    """
+    def __init__(self, iou_threshold=0.3):
+        self.iou_threshold = iou_threshold
+        self.tracks: List[ColorTransferTrack] = []
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.tracks.clear()
+
+    def get_statistics(self, frame_number, shot_id, key, kps, compute, refresh_interval=5, smoothing=0.5):
+        # compute() returns the tuple of tensors of the statistics of the face on this frame
+        bbox = get_kps_bbox(kps)
+        with self.lock:
+            # Tracks of another shot or far away in the video can't be matched anymore
+            self.tracks = [track for track in self.tracks if track.shot_id == shot_id and abs(frame_number - track.frame_number) < 2 * refresh_interval]
+
+            # A track already matched by another face of this frame is not available
+            available_tracks = [track for track in self.tracks if track.key == key and track.frame_number != frame_number]
+            ious = [get_bbox_iou(bbox, track.bbox) for track in available_tracks]
+            track = available_tracks[int(np.argmax(ious))] if ious and max(ious) >= self.iou_threshold else None
+            if track is not None:
+                # Frames can be processed out of order by the frame workers, keep the position of the latest one
+                if frame_number > track.frame_number:
+                    track.bbox = bbox
+                    track.frame_number = frame_number
+                if abs(frame_number - track.ref_frame_number) < refresh_interval:
+                    return track.statistics
+
+        statistics = compute()
+
+        with self.lock:
+            if track is None:
+                self.tracks.append(ColorTransferTrack(bbox, statistics, frame_number, shot_id, key))
+                return statistics
+            statistics = smooth_statistics(track.statistics, statistics, smoothing)
+            track.statistics = statistics
+            track.ref_frame_number = frame_number
+        return statistics
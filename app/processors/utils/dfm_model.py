@@ -66,10 +66,11 @@ class DFMModel:
     def has_morph_value(self) -> bool:
         return self._model_type == 2
 
-    def convert(self, img, morph_factor=0.75, rct=False):
+    def convert(self, img, morph_factor=0.75, rct=False, get_rct_statistics=None):
         """
         img    torch.Tensor  CHW uint8,float32
         morph_factor   float   used if model supports it
+        get_rct_statistics   callable   optional, see rct
         returns:
          img        NHW3  same dtype as img
          celeb_mask NHW1  same dtype as img
@@ -151,7 +152,7 @@ class DFMModel:
             # convert img back to original dtype
             img = self.to_dtype(img, dtype)
             # apply rct
-            out_celeb = self.rct(out_celeb, img, out_celeb_mask, out_celeb_mask, 0.3)
+            out_celeb = self.rct(out_celeb, img, out_celeb_mask, out_celeb_mask, 0.3, get_statistics=get_rct_statistics)
             # NHWC to HWC
             out_celeb = torch.squeeze(out_celeb, dim=0)
             if out_celeb.shape[-1] == 3:  # Check if there are 3 channels
@@ -167,7 +168,7 @@ class DFMModel:
 
         return out_celeb, out_celeb_mask, out_face_mask
 
-    def rct(self, img: torch.Tensor, like: torch.Tensor, mask: torch.Tensor = None, like_mask: torch.Tensor = None, mask_cutoff=0.5):
+    def rct(self, img: torch.Tensor, like: torch.Tensor, mask: torch.Tensor = None, like_mask: torch.Tensor = None, mask_cutoff=0.5, get_statistics=None):
         """
         Transfer color using the RCT method.
 
@@ -177,70 +178,43 @@ class DFMModel:
             mask (torch.Tensor, optional): [N, H, W, 1] torch.uint8/torch.float32
             like_mask (torch.Tensor, optional): [N, H, W, 1] torch.uint8/torch.float32
             mask_cutoff (float, optional): Cutoff value for masks. Defaults to 0.5.
+            get_statistics (callable, optional): get_statistics(compute) can return cached LAB statistics instead of
+                calling compute(), the statistics of these images. Defaults to None.
 
         Returns:
             torch.Tensor: The color-transferred image. [N, C, H, W]
         """
         dtype = img.dtype
-        N = img.shape[0]  # Batch size
 
         # Convert images to float32 and normalize to [0, 1]
         img = self.to_ufloat32(img).permute(0, 3, 1, 2)  # Convert to (N, 3, H, W)
-        like_for_stat = self.to_ufloat32(like).permute(0, 3, 1, 2)  # Convert to (N, 3, H, W)
-
-        # Convert to LAB color space for each image in the batch
-        img_lab = torch.stack([faceutil.rgb_to_lab(img[i], False) for i in range(N)])  # Convert to LAB in (N, 3, H, W)
-        like_lab = torch.stack([faceutil.rgb_to_lab(like_for_stat[i], False) for i in range(N)])  # Convert to LAB in (N, 3, H, W)
-
-        # Apply like mask
-        if like_mask is not None:
-            like_mask = self.get_image(self.ch(self.to_ufloat32(like_mask), 1), 'NHW')  # Convert to (N, H, W)
-            like_mask = like_mask.unsqueeze(1).expand(-1, 3, -1, -1)  # Convert to (N, 3, H, W) to match (N, 3, H, W)
-            like_lab = like_lab.clone()
-            like_lab[like_mask < mask_cutoff] = 0  # Zero out regions below cutoff
-
-        # Apply img mask
-        img_for_stat = img_lab.clone()
-        if mask is not None:
-            mask = self.get_image(self.ch(self.to_ufloat32(mask), 1), 'NHW')  # Convert to (N, H, W)
-            mask = mask.unsqueeze(1).expand(-1, 3, -1, -1)  # Convert to (N, 3, H, W) to match (N, 3, H, W)
-            img_for_stat = img_for_stat.clone()
-            img_for_stat[mask < mask_cutoff] = 0  # Zero out regions below cutoff
-
-        # Initialize the output tensor
-        img_out = torch.zeros_like(img_lab)
-
-        # Process each image in the batch
-        for i in range(N):
-            # Compute statistics for LAB channels in (3, H, W)
-            source_l_mean, source_l_std = img_for_stat[i, 0].mean(), img_for_stat[i, 0].std()
-            source_a_mean, source_a_std = img_for_stat[i, 1].mean(), img_for_stat[i, 1].std()
-            source_b_mean, source_b_std = img_for_stat[i, 2].mean(), img_for_stat[i, 2].std()
-
-            like_l_mean, like_l_std = like_lab[i, 0].mean(), like_lab[i, 0].std()
-            like_a_mean, like_a_std = like_lab[i, 1].mean(), like_lab[i, 1].std()
-            like_b_mean, like_b_std = like_lab[i, 2].mean(), like_lab[i, 2].std()
-
-            # Perform color transfer adjustments in (3, H, W)
-            source_l = img_lab[i, 0]
-            source_a = img_lab[i, 1]
-            source_b = img_lab[i, 2]
-
-            # Adjust L, A, B channels
-            source_l = (source_l - source_l_mean) * (like_l_std / (source_l_std + 1e-6)) + like_l_mean
-            source_a = (source_a - source_a_mean) * (like_a_std / (source_a_std + 1e-6)) + like_a_mean
-            source_b = (source_b - source_b_mean) * (like_b_std / (source_b_std + 1e-6)) + like_b_mean
-
-            # Clip the adjusted channels to valid LAB ranges
-            source_l = torch.clamp(source_l, 0, 100)
-            source_a = torch.clamp(source_a, -127, 127)
-            source_b = torch.clamp(source_b, -127, 127)
-
-            # Stack channels back together in (3, H, W)
-            img_out[i] = torch.stack([source_l, source_a, source_b], dim=0)
-
-        # Convert back to RGB for each image in the batch
-        img_out = torch.stack([faceutil.lab_to_rgb(img_out[i], False) for i in range(N)])  # Convert from LAB to RGB directly in (N, 3, H, W)
+
+        # Convert to LAB color space, all the images of the batch at once
+        img_lab = faceutil.rgb_to_lab_batch(img)  # (N, 3, H, W)
+
+        def compute_statistics():
+            like_for_stat = self.to_ufloat32(like).permute(0, 3, 1, 2)  # Convert to (N, 3, H, W)
+            like_lab = faceutil.rgb_to_lab_batch(like_for_stat)
+
+            # Zero out the regions below the cutoff of the masks
+            if like_mask is not None:
+                like_mask_nhw = self.get_image(self.ch(self.to_ufloat32(like_mask), 1), 'NHW')  # Convert to (N, H, W)
+                like_lab = torch.where(like_mask_nhw.unsqueeze(1) < mask_cutoff, 0.0, like_lab)
+            img_for_stat = img_lab
+            if mask is not None:
+                mask_nhw = self.get_image(self.ch(self.to_ufloat32(mask), 1), 'NHW')  # Convert to (N, H, W)
+                img_for_stat = torch.where(mask_nhw.unsqueeze(1) < mask_cutoff, 0.0, img_lab)
+
+            # The like image is the source of the colors
+            return faceutil.get_lab_statistics(like_lab, img_for_stat)
+
+        statistics = get_statistics(compute_statistics) if get_statistics is not None else compute_statistics()
+
+        # Adjust the L, A, B channels and clip them to valid LAB ranges
+        img_out = faceutil.transfer_lab_statistics(img_lab, statistics, eps=1e-6)
+
+        # Convert back to RGB
+        img_out = faceutil.lab_to_rgb_batch(img_out)  # (N, 3, H, W)
 
         # Convert back to the original data type
         img_out = self.to_dtype(img_out, dtype).permute(0, 2, 3, 1)  # Convert back to (N, H, W, 3)
@@ -0,0 +1,105 @@
+import threading
+from typing import List
+
+import numpy as np
+
+def get_bbox_iou(bbox1, bbox2):
+    x1, y1 = max(bbox1[0], bbox2[0]), max(bbox1[1], bbox2[1])
+    x2, y2 = min(bbox1[2], bbox2[2]), min(bbox1[3], bbox2[3])
+    intersection = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (bbox1[2] - bbox1[0]) * (bbox1[3] - bbox1[1]) + (bbox2[2] - bbox2[0]) * (bbox2[3] - bbox2[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+def get_bbox_size(bbox):
+    return max(bbox[2] - bbox[0], bbox[3] - bbox[1])
+
+def get_normalized_kps(bbox, kps):
+    # Keypoints relative to the center and size of the bbox, changes when the face turns or tilts
+    center = np.array([(bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2])
+    return (np.asarray(kps, dtype=np.float32) - center) / max(get_bbox_size(bbox), 1.0)
+
+class FaceTrack:
+    def __init__(self, bbox, kps, embedding, frame_number, shot_id, model_key):
+        self.bbox = bbox
+        self.frame_number = frame_number
+        self.shot_id = shot_id
+        self.model_key = model_key
+        self.set_embedding(bbox, kps, embedding, frame_number)
+
+    def set_embedding(self, bbox, kps, embedding, frame_number):
+        self.embedding = embedding
+        # Face geometry at the time the embedding was computed
+        self.ref_frame_number = frame_number
+        self.ref_size = get_bbox_size(bbox)
+        self.ref_kps = get_normalized_kps(bbox, kps)
+
+class TrackEmbeddingCache:
+    def __init__(self, iou_threshold=0.4, size_change=0.25, pose_change=0.08):
+        self.iou_threshold = iou_threshold
+        self.size_change = size_change
+        self.pose_change = pose_change
+        self.tracks: List[FaceTrack] = []
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        with self.lock:
+            self.tracks.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def is_track_valid(self, track: FaceTrack, bbox, kps, frame_number, refresh_interval):
+        if abs(frame_number - track.ref_frame_number) >= refresh_interval:
+            return False
+        if abs(get_bbox_size(bbox) / max(track.ref_size, 1.0) - 1.0) > self.size_change:
+            return False
+        if np.abs(get_normalized_kps(bbox, kps) - track.ref_kps).max() > self.pose_change:
+            return False
+        return True
+
+    def get_embeddings(self, frame_number, shot_id, model_key, bboxes, kpss_5, recognize, refresh_interval=10):
+        # recognize(indexes) returns the [M,D] embeddings of the faces at the given indexes
+        # Returns the [N,D] embeddings of all the faces, recomputing only those without a valid track
+        matched_tracks = [None] * len(bboxes)
+        embeddings = [None] * len(bboxes)
+        with self.lock:
+            # Tracks of another shot or far away in the video can't be matched anymore
+            self.tracks = [track for track in self.tracks if track.shot_id == shot_id and abs(frame_number - track.frame_number) < 2 * refresh_interval]
+
+            available_tracks = [track for track in self.tracks if track.model_key == model_key]
+            for i, bbox in enumerate(bboxes):
+                ious = [get_bbox_iou(bbox, track.bbox) for track in available_tracks]
+                if not ious or max(ious) < self.iou_threshold:
+                    continue
+                track = available_tracks.pop(int(np.argmax(ious)))
+                matched_tracks[i] = track
+                if self.is_track_valid(track, bbox, kpss_5[i], frame_number, refresh_interval):
+                    embeddings[i] = track.embedding
+
+            miss_indexes = [i for i, embedding in enumerate(embeddings) if embedding is None]
+            self.hits += len(bboxes) - len(miss_indexes)
+            self.misses += len(miss_indexes)
+
+        if miss_indexes:
+            for i, embedding in zip(miss_indexes, recognize(miss_indexes)):
+                embeddings[i] = embedding
+
+        with self.lock:
+            for i, bbox in enumerate(bboxes):
+                track = matched_tracks[i]
+                if track is None:
+                    self.tracks.append(FaceTrack(bbox, kpss_5[i], embeddings[i], frame_number, shot_id, model_key))
+                    continue
+                if i in miss_indexes:
+                    track.set_embedding(bbox, kpss_5[i], embeddings[i], frame_number)
+                # Frames can be processed out of order by the frame workers, keep the position of the latest one
+                if frame_number >= track.frame_number:
+                    track.bbox = bbox
+                    track.frame_number = frame_number
+
+        return np.stack(embeddings)
@@ -0,0 +1,142 @@
+import threading
+
+import numpy as np
+
+from app.processors.utils.face_matcher import normalize_embeddings
+
+def cosine_to_similarity(cosine):
+    # Same scale as findCosineDistance and the similarity threshold: 100 for identical, 0 for opposite embeddings
+    return 50.0 + 50.0 * cosine
+
+class EmbeddingIndex:
+    def __init__(self, ids, embeddings, block_size=4096, ivf_min_size=20000, n_lists=None, seed=0):
+        # ids is the list of the ids of the embeddings, embeddings their [N,D] matrix
+        self.ids = list(ids)
+        self.block_size = block_size
+        self.matrix = normalize_embeddings(embeddings) if len(self.ids) else np.empty((0, 0), dtype=np.float32)
+        # Key: threshold, Value: duplicates found by find_duplicates, the index is rebuilt when the embeddings change
+        self.duplicates = {}
+        self.lock = threading.Lock()
+
+        # Coarse quantizer, only for large sets where the exact search becomes slow
+        self.centroids = None
+        self.lists = None
+        if len(self.ids) >= ivf_min_size:
+            self.train_ivf(n_lists or int(np.sqrt(len(self.ids))), seed)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_cosines(self, queries, rows=None):
+        # Yields (first row, [Q,block] cosine block) over the blocks of the matrix, or of the given rows
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        for start in range(0, matrix.shape[0], self.block_size):
+            yield start, queries @ matrix[start:start + self.block_size].T
+
+    def train_ivf(self, n_lists, seed, iterations=10):
+        rng = np.random.default_rng(seed)
+        n_lists = max(1, min(n_lists, len(self.ids)))
+        # k-means on a sample of the embeddings, on the unit sphere
+        sample = self.matrix[rng.choice(len(self.ids), size=min(len(self.ids), 64 * n_lists), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], size=n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = ~sums.any(axis=1)
+            # Empty lists keep their previous centroid
+            sums[empty] = centroids[empty]
+            centroids = normalize_embeddings(sums)
+
+        assignment = np.empty(len(self.ids), dtype=np.int64)
+        for start, cosines in self.get_cosines(centroids):
+            assignment[start:start + cosines.shape[1]] = np.argmax(cosines, axis=0)
+        self.centroids = centroids
+        self.lists = [np.flatnonzero(assignment == i) for i in range(n_lists)]
+
+    def search(self, query, top_k=None, min_similarity=None, n_probe=8):
+        # Returns the (id, similarity) pairs of the closest embeddings, most similar first
+        # With the coarse quantizer only the n_probe lists closest to the query are searched, which is approximate
+        if not len(self.ids):
+            return []
+        query = normalize_embeddings(np.asarray(query).reshape(1, -1))
+
+        rows = None
+        if self.centroids is not None:
+            closest_lists = np.argsort(-(query @ self.centroids.T)[0])[:n_probe]
+            rows = np.concatenate([self.lists[i] for i in closest_lists])
+
+        top_k = top_k or len(self.ids)
+        best_rows, best_cosines = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        for start, cosines in self.get_cosines(query, rows):
+            cosines = cosines[0]
+            block_rows = np.arange(start, start + cosines.shape[0]) if rows is None else rows[start:start + cosines.shape[0]]
+            # Only the top_k of each block can be in the final top_k
+            if cosines.shape[0] > top_k:
+                keep = np.argpartition(-cosines, top_k - 1)[:top_k]
+                cosines, block_rows = cosines[keep], block_rows[keep]
+            best_rows = np.concatenate([best_rows, block_rows])
+            best_cosines = np.concatenate([best_cosines, cosines])
+
+        order = np.argsort(-best_cosines, kind='stable')[:top_k]
+        similarities = cosine_to_similarity(best_cosines[order])
+        results = [(self.ids[row], float(similarity)) for row, similarity in zip(best_rows[order], similarities)]
+        if min_similarity is not None:
+            results = [result for result in results if result[1] >= min_similarity]
+        return results
+
+    def find_duplicates(self, threshold=95.0):
+        # Returns {duplicate id: kept id} for the embeddings with a similarity above the threshold to a previous one,
+        # the first embedding of each group of near identical embeddings is kept
+        with self.lock:
+            duplicates = self.duplicates.get(threshold)
+            if duplicates is None:
+                duplicates = self.duplicates[threshold] = self.get_duplicates(threshold)
+        return duplicates
+
+    def get_duplicates(self, threshold):
+        duplicates = {}
+        is_duplicate = np.zeros(len(self.ids), dtype=bool)
+        min_cosine = (threshold - 50.0) / 50.0
+        for start in range(0, len(self.ids), self.block_size):
+            block = self.matrix[start:start + self.block_size]
+            # Only the previous embeddings are compared, so each pair is compared once
+            cosines = block @ self.matrix[:start + block.shape[0]].T >= min_cosine
+            # The embeddings of the previous blocks are already kept or not, so they are compared all at once
+            previous = cosines[:, :start] & ~is_duplicate[:start]
+            has_previous = previous.any(axis=1)
+            for i in np.flatnonzero(has_previous):
+                is_duplicate[start + i] = True
+                duplicates[self.ids[start + i]] = self.ids[int(np.argmax(previous[i]))]
+            # Within the block an embedding is only compared with the kept ones before it, the few that have one are done in order
+            within = np.tril(cosines[:, start:], k=-1)
+            for i in np.flatnonzero(within.any(axis=1) & ~has_previous):
+                kept_rows = np.flatnonzero(within[i] & ~is_duplicate[start:start + block.shape[0]])
+                if kept_rows.size:
+                    is_duplicate[start + i] = True
+                    duplicates[self.ids[start + i]] = self.ids[start + kept_rows[0]]
+        return duplicates
+
+class EmbeddingLibrary:
+    def __init__(self, **index_kwargs):
+        self.index_kwargs = index_kwargs
+        self.lock = threading.Lock()
+        # Key: recognition model, Value: (embeddings, EmbeddingIndex)
+        self.indexes = {}
+
+    def get_index(self, embedding_stores: dict, recognition_model) -> EmbeddingIndex:
+        # embedding_stores maps the ids to their embedding store, the index is rebuilt only when one of the embeddings changes
+        # The embeddings are kept in the cache entry so that comparing them by identity is safe
+        items = [(item_id, embedding_store.get(recognition_model)) for item_id, embedding_store in embedding_stores.items()]
+        items = [(item_id, embedding) for item_id, embedding in items if embedding is not None and np.size(embedding) > 0]
+        embeddings = [embedding for _, embedding in items]
+        with self.lock:
+            cached = self.indexes.get(recognition_model)
+            if cached is not None and len(cached[0]) == len(embeddings) and all(a is b for a, b in zip(cached[0], embeddings)):
+                return cached[1]
+
+        matrix = np.stack([np.asarray(embedding, dtype=np.float32).ravel() for embedding in embeddings]) if embeddings else np.empty((0, 0), dtype=np.float32)
+        index = EmbeddingIndex([item_id for item_id, _ in items], matrix, **self.index_kwargs)
+        with self.lock:
+            self.indexes[recognition_model] = (embeddings, index)
+        return index
@@ -0,0 +1,118 @@
+from typing import Dict
+
+import numpy as np
+
+EMBEDDING_MERGE_METHODS = ['Mean', 'Median', 'Weighted Mean', 'Trimmed Mean']
+
+class ModelEmbeddings:
+    def __init__(self, dim):
+        # Rows [0, count) of the matrix hold the embeddings, removed rows are filled with the last one
+        self.matrix = np.empty((8, dim), dtype=np.float32)
+        self.count = 0
+        self.keys = []
+        # Key: source key, Value: row in the matrix
+        self.rows = {}
+        # Running sums for the mean and the norm weighted mean
+        self.sum = np.zeros(dim, dtype=np.float64)
+        self.weighted_sum = np.zeros(dim, dtype=np.float64)
+        self.weights_sum = 0.0
+        # Key: (merge method, trim ratio), Value: merged embedding, cleared on every change
+        self.merged = {}
+
+    def add(self, key, embedding):
+        if self.count == self.matrix.shape[0]:
+            self.matrix = np.concatenate([self.matrix, np.empty_like(self.matrix)])
+        self.matrix[self.count] = embedding
+        self.rows[key] = self.count
+        self.keys.append(key)
+        self.count += 1
+        embedding = self.matrix[self.rows[key]].astype(np.float64)
+        self.sum += embedding
+        # The norm of an ArcFace embedding grows with the quality of the face, it is used as the weight of the embedding
+        weight = np.linalg.norm(embedding)
+        self.weighted_sum += weight * embedding
+        self.weights_sum += weight
+        self.merged.clear()
+
+    def remove(self, key):
+        row = self.rows.pop(key)
+        embedding = self.matrix[row].astype(np.float64)
+        self.sum -= embedding
+        weight = np.linalg.norm(embedding)
+        self.weighted_sum -= weight * embedding
+        self.weights_sum -= weight
+
+        last_row = self.count - 1
+        if row != last_row:
+            self.matrix[row] = self.matrix[last_row]
+            last_key = self.keys[last_row]
+            self.keys[row] = last_key
+            self.rows[last_key] = row
+        self.keys.pop()
+        self.count -= 1
+        self.merged.clear()
+
+    def merge(self, method, trim_ratio=0.2):
+        cached = self.merged.get((method, trim_ratio))
+        if cached is not None:
+            return cached
+
+        embeddings = self.matrix[:self.count]
+        if method == 'Median':
+            merged = np.median(embeddings, axis=0)
+        elif method == 'Weighted Mean':
+            merged = self.weighted_sum / self.weights_sum if self.weights_sum > 0 else self.sum / self.count
+        elif method == 'Trimmed Mean':
+            # Drops the embeddings furthest away from the mean direction, then averages the others
+            mean = self.sum / self.count
+            cosines = embeddings @ (mean / max(np.linalg.norm(mean), 1e-12)) / np.maximum(np.linalg.norm(embeddings, axis=1), 1e-12)
+            num_kept = max(1, self.count - int(self.count * trim_ratio))
+            merged = embeddings[np.argsort(-cosines, kind='stable')[:num_kept]].mean(axis=0, dtype=np.float64)
+        else:
+            merged = self.sum / self.count
+        merged = merged.astype(np.float32)
+        self.merged[(method, trim_ratio)] = merged
+        return merged
+
+class EmbeddingMerger:
+    def __init__(self):
+        # Key: embedding model, Value: ModelEmbeddings
+        self.models: Dict[str, ModelEmbeddings] = {}
+        # Key: source key, Value: ({embedding model: embedding} of the source when it was added, models the source was added to)
+        self.sources = {}
+
+    def set_sources(self, sources: dict):
+        # sources maps a key to an embedding store, only the sources that were added, removed or changed are updated
+        for key in [key for key in self.sources if key not in sources]:
+            self.remove_source(key)
+        for key, embedding_store in sources.items():
+            current = self.sources.get(key)
+            if current is not None and current[0].keys() == embedding_store.keys() and all(current[0][model] is embedding_store[model] for model in current[0]):
+                continue
+            if current is not None:
+                self.remove_source(key)
+            self.add_source(key, embedding_store)
+
+    def add_source(self, key, embedding_store):
+        added_models = []
+        for model, embedding in embedding_store.items():
+            embedding_row = np.asarray(embedding, dtype=np.float32).ravel()
+            if model not in self.models:
+                self.models[model] = ModelEmbeddings(embedding_row.size)
+            if embedding_row.size != self.models[model].matrix.shape[1]:
+                continue
+            self.models[model].add(key, embedding_row)
+            added_models.append(model)
+        # The embeddings are kept so that changes are detected by identity
+        self.sources[key] = (dict(embedding_store), added_models)
+
+    def remove_source(self, key):
+        _, added_models = self.sources.pop(key)
+        for model in added_models:
+            self.models[model].remove(key)
+            if self.models[model].count == 0:
+                del self.models[model]
+
+    def merge(self, method='Mean', trim_ratio=0.2):
+        # Returns {embedding model: merged embedding}, the merged embeddings are the same arrays until the sources change
+        return {model: model_embeddings.merge(method, trim_ratio) for model, model_embeddings in self.models.items()}
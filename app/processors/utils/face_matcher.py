@@ -0,0 +1,82 @@
+import threading
+
+import numpy as np
+try:
+    from scipy.optimize import linear_sum_assignment
+    SCIPY_AVAILABLE = True
+except ImportError:
+    SCIPY_AVAILABLE = False
+
+def normalize_embeddings(embeddings):
+    # L2 normalize the rows of a [N,D] matrix, zero rows stay zero
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+def get_similarity_matrix(faces_embeddings, targets_matrix):
+    # Same scale as findCosineDistance: 100 for identical, 0 for opposite embeddings
+    return 50.0 + 50.0 * (normalize_embeddings(faces_embeddings) @ targets_matrix.T)
+
+class TargetFaceMatcher:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Key: recognition model, Value: (target embeddings, normalized [T,D] target matrix, valid target mask)
+        self.targets_matrices = {}
+
+    def clear_cache(self):
+        with self.lock:
+            self.targets_matrices.clear()
+
+    def get_targets_matrix(self, target_faces, recognition_model):
+        # Target faces don't change often, the matrix is rebuilt only when one of their embeddings is added, removed or replaced
+        # The embeddings are kept in the cache entry so that comparing them by identity is safe
+        embeddings = [target_face.embedding_store.get(recognition_model) for target_face in target_faces]
+        with self.lock:
+            cached = self.targets_matrices.get(recognition_model)
+            if cached is not None and len(cached[0]) == len(embeddings) and all(a is b for a, b in zip(cached[0], embeddings)):
+                return cached[1], cached[2]
+
+        valid = np.array([embedding is not None and np.size(embedding) > 0 for embedding in embeddings], dtype=bool)
+        dim = next((np.size(embedding) for embedding, is_valid in zip(embeddings, valid) if is_valid), 0)
+        targets_matrix = np.zeros((len(embeddings), dim), dtype=np.float32)
+        if valid.any():
+            targets_matrix[valid] = normalize_embeddings([embeddings[i] for i in np.flatnonzero(valid)])
+
+        with self.lock:
+            self.targets_matrices[recognition_model] = (embeddings, targets_matrix, valid)
+        return targets_matrix, valid
+
+    def match(self, faces_embeddings, target_faces, recognition_model, thresholds, one_to_one=False):
+        # faces_embeddings is the [N,D] matrix of the detected faces, thresholds the similarity threshold of each target face
+        # Returns the list of (face index, target face) pairs with a similarity above the threshold of the target,
+        # ordered by face then by target. With one_to_one, each face and each target face is used at most once.
+        if len(faces_embeddings) == 0 or not target_faces:
+            return []
+        targets_matrix, valid = self.get_targets_matrix(target_faces, recognition_model)
+        if not valid.any():
+            return []
+
+        similarities = get_similarity_matrix(faces_embeddings, targets_matrix)
+        matches = (similarities >= np.asarray(thresholds, dtype=np.float32)[None, :]) & valid[None, :]
+
+        if one_to_one and matches.any():
+            matches = self.get_one_to_one_matches(similarities, matches)
+
+        return [(int(face_index), target_faces[target_index]) for face_index, target_index in zip(*np.nonzero(matches))]
+
+    def get_one_to_one_matches(self, similarities, matches):
+        # Maximize the total similarity of the pairs above their threshold
+        scores = np.where(matches, similarities, -1.0)
+        assigned = np.zeros_like(matches)
+        if SCIPY_AVAILABLE:
+            rows, cols = linear_sum_assignment(scores, maximize=True)
+            assigned[rows, cols] = True
+        else:
+            # Greedy assignment, best pairs first
+            for index in np.argsort(scores, axis=None)[::-1]:
+                row, col = np.unravel_index(index, scores.shape)
+                if scores[row, col] < 0:
+                    break
+                if not assigned[row].any() and not assigned[:, col].any():
+                    assigned[row, col] = True
+        return assigned & matches
@@ -0,0 +1,34 @@
+import numpy as np
+from torchvision.transforms import v2
+
+from app.processors.utils import faceutil
+from app.helpers.miscellaneous import t384, t256, t128
+
+class FacePyramid:
+    """
+    Aligned crops of a face at the 512, 384, 256 and 128 resolutions. Each crop is computed the first time it is used,
+    so the resolutions that the swapper, masks and restorers don't need are never computed. Only the full size crop is
+    warped from the frame, the others are resized from the larger crops so that neighbouring pixels are averaged.
+    """
+    def __init__(self, img, tform, size=512):
+        # img is the [C,H,W] frame and tform the transform from the frame to the crop of the given size
+        self.img = img
+        self.matrix = np.asarray(tform.params[0:2], dtype=np.float64)
+        self.size = size
+        # Key: resolution, Value: [C,resolution,resolution] crop
+        self.faces = {}
+        # Key: resolution, Value: (resolution resized from, resize transform)
+        self.scalings = {384: (size, t384), 256: (size, t256), 128: (256, t128)}
+
+    def __getitem__(self, size):
+        face = self.faces.get(size)
+        if face is None:
+            if size == self.size:
+                face = faceutil.warp_affine_roi(self.img, self.matrix, 0, 0, size, size, interpolation=v2.InterpolationMode.BILINEAR)
+            elif size in self.scalings:
+                source_size, scale = self.scalings[size]
+                face = scale(self[source_size])
+            else:
+                face = v2.functional.resize(self[self.size], [size, size], interpolation=v2.InterpolationMode.BILINEAR, antialias=False)
+            self.faces[size] = face
+        return face
@@ -1,5 +1,6 @@
 import math
 from math import sin, cos, acos, degrees, floor, ceil
+from functools import lru_cache
 
 import numpy as np
 import cv2
@@ -236,6 +237,32 @@ def warp_affine_torchvision(img, matrix, image_size, rotation_ratio=0.0, border_
 
     return warped_img_tensor.squeeze(0)
 
+def warp_affine_roi(img, matrix, left, top, width, height, interpolation=v2.InterpolationMode.BILINEAR):
+    """
+    Same result as v2.functional.affine(img, ..., center=(0, 0)) with the transform of the 2x3 matrix, cropped to
+    [top:top+height, left:left+width], but only the pixels of that region are sampled. The cost depends on the size
+    of the region instead of the size of img. img is [C,H,W], the region can go past the borders of the output image.
+    """
+    # Inverse mapping of the centers of the output pixels, in the coordinates where the pixel (0, 0) covers [0,1]x[0,1]
+    matrix = np.vstack([np.asarray(matrix, dtype=np.float64)[:2], [0.0, 0.0, 1.0]])
+    inverse = np.linalg.inv(matrix)[:2]
+    # Normalize to the [-1,1] coordinates of grid_sample with align_corners=False
+    height_in, width_in = img.shape[-2:]
+    inverse = np.diag([2.0 / width_in, 2.0 / height_in]) @ inverse
+    inverse[:, 2] -= 1.0
+    theta = torch.tensor(inverse, dtype=torch.float32, device=img.device)
+
+    xs = torch.arange(left, left + width, dtype=torch.float32, device=img.device) + 0.5
+    ys = torch.arange(top, top + height, dtype=torch.float32, device=img.device) + 0.5
+    grid_y, grid_x = torch.meshgrid(ys, xs, indexing='ij')
+    grid = torch.stack([grid_x, grid_y, torch.ones_like(grid_x)], dim=-1) @ theta.T
+
+    mode = 'nearest' if interpolation == v2.InterpolationMode.NEAREST else 'bilinear'
+    warped = torch.nn.functional.grid_sample(img.unsqueeze(0).float(), grid.unsqueeze(0), mode=mode, padding_mode='zeros', align_corners=False)[0]
+    if not img.is_floating_point():
+        warped = torch.round(warped).to(img.dtype)
+    return warped
+
 def umeyama(src, dst, estimate_scale):
     num = src.shape[0]
     dim = src.shape[1]
@@ -949,6 +976,111 @@ def hsv_to_rgb(hsv_image):
 
     return rgb_image
 
+@lru_cache(maxsize=64)
+def get_gaussian_kernel_1d(kernel_size, sigma, device):
+    # Same weights as the kernels of transforms.GaussianBlur, cached as the blur amounts rarely change between frames
+    # The kernel is shared, it must not be modified by the caller
+    ksize_half = (kernel_size - 1) * 0.5
+    x = torch.linspace(-ksize_half, ksize_half, steps=kernel_size, device=device)
+    pdf = torch.exp(-0.5 * (x / sigma).pow(2))
+    return pdf / pdf.sum()
+
+def gaussian_blur(img, kernel_size, sigma):
+    """
+    Same result as transforms.GaussianBlur(kernel_size, sigma)(img) for a [C,H,W] or [N,C,H,W] tensor, but the kernel
+    is cached and applied as two 1D convolutions.
+    """
+    is_batch = img.dim() == 4
+    out_dtype = img.dtype
+    blurred = img if img.is_floating_point() else img.to(torch.float32)
+    if not is_batch:
+        blurred = blurred.unsqueeze(0)
+
+    kernel = get_gaussian_kernel_1d(int(kernel_size), float(sigma), str(img.device)).to(blurred.dtype)
+    channels = blurred.shape[1]
+    padding = int(kernel_size) // 2
+    blurred = torch.nn.functional.pad(blurred, [padding, padding, padding, padding], mode="reflect")
+    blurred = torch.nn.functional.conv2d(blurred, kernel.view(1, 1, 1, -1).expand(channels, 1, 1, -1), groups=channels)
+    blurred = torch.nn.functional.conv2d(blurred, kernel.view(1, 1, -1, 1).expand(channels, 1, -1, 1), groups=channels)
+
+    if not is_batch:
+        blurred = blurred.squeeze(0)
+    if not img.is_floating_point():
+        blurred = torch.round(blurred).to(out_dtype)
+    return blurred
+
+@lru_cache(maxsize=16)
+def get_border_mask(top, left, bottom, right, blur_amount, device, size=128):
+    # Blurred [1,size,size] mask of the face without the given borders, cached per slider values
+    # The mask is shared, it must not be modified by the caller
+    border_mask = torch.ones((1, size, size), dtype=torch.float32, device=device)
+    border_mask[:, :top, :] = 0
+    border_mask[:, size - bottom:, :] = 0
+    border_mask[:, :, :left] = 0
+    border_mask[:, :, size - right:] = 0
+    return gaussian_blur(border_mask, blur_amount*2+1, (blur_amount+1)*0.2)
+
+@lru_cache(maxsize=16)
+def get_color_lut(gamma, red, green, blue, brightness, device):
+    """
+    [3,256] uint8 table of the gamma, RGB offset and brightness corrections of a uint8 image, with the same rounding as
+    adjust_gamma, the clamped offset and adjust_brightness applied one after the other. Cached per slider values.
+    The table is shared, it must not be modified by the caller
+    """
+    values = torch.arange(256, dtype=torch.float32, device=device)
+    if gamma != 1.0:
+        values = torch.floor(torch.pow(values.mul(1.0 / 255), gamma) * (256 - 1e-3))
+    values = torch.tensor([red, green, blue], dtype=torch.float32, device=device).view(3, 1) + values
+    values = torch.floor(torch.clamp(values, 0, 255))
+    if brightness != 1.0:
+        values = torch.floor(torch.clamp(values * brightness, 0, 255))
+    return values.to(torch.uint8)
+
+def get_grayscale(img):
+    # Grayscale of a float [3,H,W] image holding uint8 values, rounded down like the uint8 grayscale of the v2 adjust functions
+    r, g, b = img.unbind(dim=-3)
+    return torch.floor(r.mul(0.2989).add_(g, alpha=0.587).add_(b, alpha=0.114)).unsqueeze(dim=-3)
+
+def color_correct(img, gamma=1.0, red=0, green=0, blue=0, brightness=1.0, contrast=1.0, saturation=1.0, sharpness=1.0, hue=0.0):
+    """
+    Same result as the v2.functional adjust_gamma, RGB offset, adjust_brightness, adjust_contrast, adjust_saturation,
+    adjust_sharpness and adjust_hue chain of the color sliders, for a [3,H,W] float image in [0, 255] or uint8 image.
+    The pointwise corrections are a single lookup in a cached table, the others run in float without the uint8 round
+    trips between them, and the corrections with a neutral value are skipped. Returns a uint8 image.
+    """
+    if img.dtype == torch.uint8:
+        indices = img.to(torch.int64)
+        lut = get_color_lut(float(gamma), float(red), float(green), float(blue), float(brightness), str(img.device))
+    else:
+        # adjust_gamma doesn't rescale float images, only the offset and brightness can be looked up
+        offset = torch.tensor([red, green, blue], dtype=torch.float32, device=img.device).view(3, 1, 1)
+        indices = torch.clamp(torch.pow(img.to(torch.float32), gamma) + offset, 0, 255).to(torch.int64)
+        lut = get_color_lut(1.0, 0.0, 0.0, 0.0, float(brightness), str(img.device))
+    img = torch.gather(lut, 1, indices.view(3, -1)).view(indices.shape)
+
+    if contrast == 1.0 and saturation == 1.0 and sharpness == 1.0 and hue == 0.0:
+        return img
+    img = img.to(torch.float32)
+
+    # Blends with the floored grayscale and truncation to integer values, as the v2 functions do on uint8 images
+    if contrast != 1.0:
+        mean = torch.mean(get_grayscale(img), dim=(-3, -2, -1), keepdim=True)
+        img = torch.floor(img.mul(contrast).add_(mean, alpha=1.0 - contrast).clamp_(0, 255))
+    if saturation != 1.0:
+        img = torch.floor(img.mul(saturation).add_(get_grayscale(img), alpha=1.0 - saturation).clamp_(0, 255))
+    if sharpness != 1.0:
+        a, b = 1.0 / 13.0, 5.0 / 13.0
+        kernel = torch.tensor([[a, a, a], [a, b, a], [a, a, a]], dtype=torch.float32, device=img.device).expand(3, 1, 3, 3)
+        blurred = torch.round(torch.nn.functional.conv2d(img, kernel, groups=3))
+        # The border pixels are left as they are
+        interior = img[:, 1:-1, 1:-1]
+        interior.add_(blurred.sub_(interior), alpha=1.0 - sharpness)
+        img = torch.floor(img.clamp_(0, 255))
+    if hue != 0.0:
+        img = v2.functional.adjust_hue(img.mul_(1.0 / 255), hue)
+        return img.mul_(256 - 1e-3).to(torch.uint8)
+    return img.to(torch.uint8)
+
 def sharpen(img):
     device = img.device  # Ensure we use the same device
 
@@ -1902,328 +2034,216 @@ def jpegBlur(img, q):
 
     return img_blurred
 
-def histogram_matching(source_image, target_image, diffslider):
-    # Determine the device (CPU or GPU)
-    device = source_image.device
-
-    # Convert images to float tensors in range [0, 1], shape (C, H, W)
-    source_image_t = source_image.float().to(device) / 255.0  # (C, H, W)
-    target_image_t = target_image.float().to(device) / 255.0  # (C, H, W)
-
-    matched_target_image_t = target_image_t.clone()
-
-    bin_edges = torch.linspace(0.0, 1.0, steps=257, device=device)  # 257 edges for 256 bins
-
-    for channel in range(3):
-        source_channel = source_image_t[channel, :, :]  # Shape: (H, W)
-        target_channel = target_image_t[channel, :, :]
-
-        # Compute histograms
-        source_hist = torch.histc(source_channel, bins=256, min=0.0, max=1.0)
-        target_hist = torch.histc(target_channel, bins=256, min=0.0, max=1.0)
-
-        # Compute probability mass functions (PMFs)
-        source_pmf = source_hist / source_hist.sum()
-        target_pmf = target_hist / target_hist.sum()
-
-        # Compute cumulative distribution functions (CDFs)
-        source_cdf = torch.cumsum(source_pmf, dim=0)
-        target_cdf = torch.cumsum(target_pmf, dim=0)
+def get_blend_alpha(diffslider, device):
+    # diffslider is the blend amount of one image, or a sequence with the amount of each image of a batch
+    if isinstance(diffslider, (int, float)):
+        return diffslider / 100.0
+    return torch.tensor(diffslider, dtype=torch.float32, device=device).view(-1, 1, 1, 1) / 100.0
 
-        # Flatten the target channel for interpolation
-        target_channel_flat = target_channel.flatten()
-
-        # Interpolate target pixel values to get their CDF values
-        interp_t_values = interp1d(
-            target_channel_flat, bin_edges[:-1], target_cdf, device=device
-        )
-
-        # Invert the source CDF to get matched pixel values
-        matched_channel_flat = interp1d_inverse(
-            interp_t_values, source_cdf, bin_edges[:-1], device=device
-        )
-
-        # Reshape back to original image shape
-        matched_channel = matched_channel_flat.reshape(target_channel.shape)
+def get_histogram_cdfs(values, weights, eps=0.0):
+    """
+    CDFs of the 256 bin histograms over [0, 1] of each row of values [B,P], as computed by torch.histc, in a single
+    bincount. weights [B,P] selects the values that are counted. Returns the [B,256] CDFs and the [B] counts.
+    """
+    num_rows = values.shape[0]
+    bins = torch.clamp(torch.mul(values, 256).to(torch.int64), 0, 255)
+    bins += torch.arange(num_rows, device=values.device).view(-1, 1) * 256
+    weights = weights.to(torch.float32)
+    hist = torch.bincount(bins.flatten(), weights=weights.flatten(), minlength=num_rows * 256).view(num_rows, 256)
+    counts = weights.sum(dim=1)
+    if eps:
+        hist += eps
+    pmf = hist / hist.sum(dim=1, keepdim=True)
+    return torch.cumsum(pmf, dim=1), counts
+
+def interp1d_bins(x, fp):
+    """
+    Linear interpolation of each row of x [B,P] on the lower edges k/256 of the 256 histogram bins, with the values
+    fp [B,256]. The edges are uniform, so the bin of each value is computed instead of searched.
+    """
+    indices = torch.floor(torch.mul(x, 256)).clamp_(0, 254).to(torch.int64)
 
-        # Update the matched image
-        matched_target_image_t[channel, :, :] = matched_channel
+    x0 = indices.to(x.dtype) / 256
+    x1 = (indices + 1).to(x.dtype) / 256
+    y0 = torch.gather(fp, 1, indices)
+    y1 = torch.gather(fp, 1, indices + 1)
 
-    # Blend the images according to diffslider
-    alpha = diffslider / 100.0
-    final_image_t = (1 - alpha) * target_image_t + alpha * matched_target_image_t
+    # Add epsilon to prevent division by zero
+    slope = (y1 - y0) / (x1 - x0 + 1e-6)
+    y = y0 + slope * (x - x0)
 
-    # Scale back to [0, 255] and clip
-    final_image_t = torch.clamp(final_image_t * 255.0, 0.0, 255.0)
+    y = torch.where(x < 0.0, fp[:, :1], y)
+    y = torch.where(x > 255 / 256, fp[:, -1:], y)
+    return y
 
-    # Ensure it's on the original device and has type float
-    final_image_tensor = final_image_t.to(device).float()
+def interp1d_inverse(y, fp, xp):
+    # Inverse of interp1d: finds each row of y [B,P] in the increasing values fp [B,K] of the points xp [K]
+    indices = torch.searchsorted(fp.contiguous(), y.contiguous(), right=True) - 1
+    indices = indices.clamp(0, fp.shape[1] - 2)
 
-    return final_image_tensor
+    y0 = torch.gather(fp, 1, indices)
+    y1 = torch.gather(fp, 1, indices + 1)
+    x0 = xp[indices]
+    x1 = xp[indices + 1]
 
-def histogram_matching_withmask(source_image, target_image, mask, diffslider):
-    # Determine the device (CPU or GPU)
-    device = source_image.device
-
-    # Convert images to float tensors in range [0, 1], shape (C, H, W)
-    source_image_t = source_image.float().to(device) / 255.0  # (C, H, W)
-    target_image_t = target_image.float().to(device) / 255.0  # (C, H, W)
-    mask_t = mask.float().to(device)
-
-    # Apply histogram matching only to the masked areas
-    matched_target_image_t = target_image_t.clone()
-
-    # Define the condition for the mask
-    valid_mask = (mask_t > 0.2)  # Shape: (1, H, W) or (H, W)
-
-    # Remove channel dimension from mask if present
-    if valid_mask.dim() == 3 and valid_mask.size(0) == 1:
-        valid_mask = valid_mask.squeeze(0)
-
-    # Create bin edges for histograms
-    bin_edges = torch.linspace(0.0, 1.0, steps=257, device=device)  # 257 edges for 256 bins
-
-    for channel in range(3):
-        source_channel = source_image_t[channel, :, :]  # Shape: (H, W)
-        target_channel = target_image_t[channel, :, :]
-
-        # Extract masked values
-        masked_source_values = source_channel[valid_mask]
-        masked_target_values = target_channel[valid_mask]
-
-        # Remove NaNs and Infs
-        masked_source_values = masked_source_values[~torch.isnan(masked_source_values)]
-        masked_source_values = masked_source_values[~torch.isinf(masked_source_values)]
-        masked_target_values = masked_target_values[~torch.isnan(masked_target_values)]
-        masked_target_values = masked_target_values[~torch.isinf(masked_target_values)]
-
-        # Check if masked values are empty
-        if masked_source_values.numel() == 0 or masked_target_values.numel() == 0:
-            print(f"No valid masked pixels for channel {channel}. Skipping histogram matching for this channel.")
-            continue
-
-        # Ensure values are within [0.0, 1.0]
-        masked_source_values = torch.clamp(masked_source_values, 0.0, 1.0)
-        masked_target_values = torch.clamp(masked_target_values, 0.0, 1.0)
-
-        # Compute histograms
-        source_hist = torch.histc(masked_source_values, bins=256, min=0.0, max=1.0)
-        target_hist = torch.histc(masked_target_values, bins=256, min=0.0, max=1.0)
-
-        # Add epsilon to histogram counts to prevent zeros
-        source_hist += 1e-6
-        target_hist += 1e-6
-
-        # Compute probability mass functions (PMFs)
-        source_hist_sum = source_hist.sum()
-        target_hist_sum = target_hist.sum()
-        if source_hist_sum == 0 or target_hist_sum == 0:
-            print(f"Histogram sum is zero for channel {channel}. Skipping histogram matching for this channel.")
-            continue
-
-        source_pmf = source_hist / source_hist_sum
-        target_pmf = target_hist / target_hist_sum
-
-        # Compute cumulative distribution functions (CDFs)
-        source_cdf = torch.cumsum(source_pmf, dim=0)
-        target_cdf = torch.cumsum(target_pmf, dim=0)
-
-        # Ensure CDFs are strictly increasing
-        source_cdf = torch.maximum(source_cdf, torch.cummax(source_cdf, dim=0)[0])
-        target_cdf = torch.maximum(target_cdf, torch.cummax(target_cdf, dim=0)[0])
-
-        # Check for NaNs or Infs in CDFs
-        if torch.isnan(source_cdf).any() or torch.isinf(source_cdf).any():
-            print(f"Channel {channel}: source_cdf contains NaN or Inf values. Skipping histogram matching for this channel.")
-            continue
-
-        # Flatten the target channel for interpolation
-        target_channel_flat = target_channel.flatten()
-
-        # Interpolate target pixel values to get their CDF values
-        interp_t_values = interp1d(
-            target_channel_flat, bin_edges[:-1], target_cdf, device=device
-        )
+    # Add epsilon to prevent division by zero
+    slope = (x1 - x0) / (y1 - y0 + 1e-6)
+    x = x0 + slope * (y - y0)
 
-        # Invert the source CDF to get matched pixel values
-        matched_channel_flat = interp1d_inverse(
-            interp_t_values, source_cdf, bin_edges[:-1], device=device
-        )
+    x = torch.where(y < fp[:, :1], xp[0], x)
+    x = torch.where(y > fp[:, -1:], xp[-1], x)
+    return x
 
-        # Reshape back to original image shape
-        matched_channel = matched_channel_flat.reshape(target_channel.shape)
+def match_histograms(target_values, source_cdfs, target_cdfs):
+    # Maps each row of target_values [B,P] in [0, 1] from the target CDF of the row to its source CDF
+    bin_edges = torch.linspace(0.0, 1.0, steps=257, device=target_values.device)[:-1]
+    return interp1d_inverse(interp1d_bins(target_values, target_cdfs), source_cdfs, bin_edges)
 
-        # Apply the mapping only to the valid areas
-        matched_target_image_t[channel, :, :][valid_mask] = matched_channel[valid_mask]
+def get_histogram_statistics(source_image, target_image, mask=None):
+    """
+    CDFs of each channel of source_image and target_image, [C,H,W] images or [N,C,H,W] batches in [0, 255]. With a
+    [H,W], [1,H,W] or [N,1,H,W] mask only the pixels where it is above 0.2 are counted. Returns the (source CDFs,
+    target CDFs, matched channels) statistics of histogram matching, one row per channel of each image.
+    """
+    shape = target_image.shape
+    num_pixels = shape[-2] * shape[-1]
+    source_values = (source_image.float() / 255.0).reshape(-1, num_pixels)
+    target_values = (target_image.float() / 255.0).reshape(-1, num_pixels)
+
+    if mask is None:
+        # torch.histc ignores the values outside of [0, 1]
+        source_cdfs, _ = get_histogram_cdfs(source_values, (source_values >= 0.0) & (source_values <= 1.0))
+        target_cdfs, _ = get_histogram_cdfs(target_values, (target_values >= 0.0) & (target_values <= 1.0))
+        return source_cdfs, target_cdfs, torch.ones((source_cdfs.shape[0], 1), dtype=torch.bool, device=source_cdfs.device)
+
+    # Same mask for all the channels of an image
+    valid_mask = get_histogram_valid_mask(mask, shape)
+    # NaNs and Infs are not counted, the other values are clamped to [0, 1]
+    source_cdfs, source_counts = get_histogram_cdfs(torch.clamp(source_values, 0.0, 1.0), valid_mask & torch.isfinite(source_values), eps=1e-6)
+    target_cdfs, target_counts = get_histogram_cdfs(torch.clamp(target_values, 0.0, 1.0), valid_mask & torch.isfinite(target_values), eps=1e-6)
+    # The channels without any valid pixel are left as they are
+    return source_cdfs, target_cdfs, ((source_counts > 0) & (target_counts > 0)).view(-1, 1)
+
+def get_histogram_valid_mask(mask, shape):
+    # [N*C,H*W] pixels where the mask of the image is above 0.2
+    num_pixels = shape[-2] * shape[-1]
+    return (mask.float() > 0.2).reshape(-1, 1, num_pixels).expand(-1, shape[-3], -1).reshape(-1, num_pixels)
+
+def apply_histogram_matching(target_image, statistics, diffslider, mask=None):
+    # Maps target_image with the statistics of get_histogram_statistics, only where mask is above 0.2 if given
+    source_cdfs, target_cdfs, matched_channels = statistics
+    target_image_t = target_image.float() / 255.0
+    shape = target_image_t.shape
+    target_values = target_image_t.reshape(-1, shape[-2] * shape[-1])
+
+    matched_values = match_histograms(target_values, source_cdfs, target_cdfs)
+    if mask is not None:
+        matched_channels = get_histogram_valid_mask(mask, shape) & matched_channels
+    matched_target_image_t = torch.where(matched_channels, matched_values, target_values).view(shape)
 
     # Blend the images according to diffslider
-    alpha = diffslider / 100.0
+    alpha = get_blend_alpha(diffslider, target_image_t.device)
     final_image_t = (1 - alpha) * target_image_t + alpha * matched_target_image_t
 
-    # Scale back to [0, 255] and clip
-    final_image_t = torch.clamp(final_image_t * 255.0, 0.0, 255.0)
-
-    # Ensure it's on the original device and has type float
-    final_image_tensor = final_image_t.to(device).float()
-
-    return final_image_tensor
+    return torch.clamp(final_image_t * 255.0, 0.0, 255.0)
 
-def interp1d(x, xp, fp, device='cpu'):
-    # Ensure xp is increasing
-    assert torch.all(xp[1:] >= xp[:-1]), "xp must be increasing"
+def fold_batch(images):
+    # [N,C,H,W] batch to a [C,N*H,W] image, for the conversions that only take a single image
+    if images.dim() == 3:
+        return images
+    return images.permute(1, 0, 2, 3).reshape(images.shape[1], -1, images.shape[3])
 
-    # Move tensors to the specified device and make them contiguous
-    x = x.to(device).contiguous()
-    xp = xp.to(device).contiguous()
-    fp = fp.to(device)
+def unfold_batch(image, shape):
+    # Inverse of fold_batch, shape is the shape of the batch
+    if len(shape) == 3:
+        return image
+    return image.reshape(shape[1], shape[0], shape[2], shape[3]).permute(1, 0, 2, 3)
 
-    # Find indices in xp for each x
-    indices = torch.searchsorted(xp, x, right=True) - 1
-    indices = indices.clamp(0, len(xp) - 2)
+def rgb_to_lab_batch(images):
+    # rgb_to_lab of [C,H,W] images or [N,C,H,W] batches in [0, 1]
+    return unfold_batch(rgb_to_lab(fold_batch(images), False), images.shape)
 
-    x0 = xp[indices]
-    x1 = xp[indices + 1]
-    y0 = fp[indices]
-    y1 = fp[indices + 1]
-
-    # Compute the slope
-    slope = (y1 - y0) / (x1 - x0 + 1e-6)  # Add epsilon to prevent division by zero
-
-    # Compute the interpolated values
-    y = y0 + slope * (x - x0)
+def lab_to_rgb_batch(images):
+    return unfold_batch(lab_to_rgb(fold_batch(images), False), images.shape)
 
-    # Handle edge cases
-    y = torch.where(x < xp[0], fp[0], y)
-    y = torch.where(x > xp[-1], fp[-1], y)
+def get_channel_mean_std(images):
+    # Mean and unbiased std of each channel of [...,C,H,W] images, as [...,C,1,1] tensors
+    mean = images.mean(dim=(-2, -1), keepdim=True)
+    centered = images - mean
+    # Two passes instead of std over several dims, which is several times slower on CPU
+    variance = torch.mul(centered, centered).sum(dim=(-2, -1), keepdim=True) / (images.shape[-2] * images.shape[-1] - 1)
+    return mean, torch.sqrt(variance)
 
-    return y
+def get_lab_statistics(source_lab, target_lab, mask=None, mask_cutoff=0.2):
+    """
+    Mean and std of the LAB channels of the source and target images for the DFL color transfer. With a mask the
+    pixels below mask_cutoff count as 0. Returns the (source mean, source std, target mean, target std) statistics.
+    """
+    if mask is not None:
+        mask = mask.type(torch.float32).reshape(target_lab.shape[:-3] + (1,) + target_lab.shape[-2:])
+        source_lab = torch.where(mask < mask_cutoff, 0.0, source_lab)
+        target_lab = torch.where(mask < mask_cutoff, 0.0, target_lab)
+    return get_channel_mean_std(source_lab) + get_channel_mean_std(target_lab)
 
-def interp1d_inverse(y, fp, xp, device='cpu'):
-    # Ensure fp is increasing
-    assert torch.all(fp[1:] >= fp[:-1]), "fp must be increasing"
+def transfer_lab_statistics(target_lab, statistics, eps=0.0):
+    # Reinhard color transfer: target_lab [...,3,H,W] with the source mean and std of the statistics of get_lab_statistics
+    source_mean, source_std, target_mean, target_std = statistics
 
-    # Move tensors to the specified device and make them contiguous
-    y = y.to(device).contiguous()
-    fp = fp.to(device).contiguous()
-    xp = xp.to(device)
+    # Scale by the ratio of the standard deviations, as proposed by the paper
+    scale = source_std / (target_std + eps)
+    matched = torch.addcmul(source_mean - target_mean * scale, target_lab, scale)
 
-    # Find indices in fp for each y
-    indices = torch.searchsorted(fp, y, right=True) - 1
-    indices = indices.clamp(0, len(fp) - 2)
+    matched[..., 0, :, :].clamp_(0, 100)
+    matched[..., 1:, :, :].clamp_(-127, 127)
+    return matched
 
-    y0 = fp[indices]
-    y1 = fp[indices + 1]
-    x0 = xp[indices]
-    x1 = xp[indices + 1]
-
-    # Compute the slope
-    slope = (x1 - x0) / (y1 - y0 + 1e-6)  # Add epsilon to prevent division by zero
-
-    # Compute the interpolated values
-    x = x0 + slope * (y - y0)
+def color_transfer(transfer_type, source_image, target_image, diffslider, mask=None, get_statistics=None):
+    """
+    AutoColor transfer of the colors of source_image to target_image, [C,H,W] images or [N,C,H,W] batches in [0, 255]:
+    histogram matching for 'Test' and 'Test_Mask', the DFL LAB statistics transfer for 'DFL_Test' and 'DFL_Orig'.
+    get_statistics(compute) can return cached statistics instead of calling compute(), the statistics of this frame.
+    Returns a float image in [0, 255].
+    """
+    if transfer_type in ('DFL_Test', 'DFL_Orig'):
+        target_image = target_image.type(torch.float32) / 255.0
+        # The target is converted in any case, only the source conversion is skipped with cached statistics
+        target_lab = rgb_to_lab_batch(target_image)
+        compute = lambda: get_lab_statistics(rgb_to_lab_batch(source_image.type(torch.float32) / 255.0), target_lab, mask)
+        statistics = get_statistics(compute) if get_statistics is not None else compute()
+        matched_target_image = lab_to_rgb_batch(transfer_lab_statistics(target_lab, statistics))
+
+        alpha = get_blend_alpha(diffslider, target_image.device)
+        final_image = (1 - alpha) * target_image + alpha * matched_target_image
+        return torch.clamp(final_image * 255, 0, 255)
+
+    compute = lambda: get_histogram_statistics(source_image, target_image, mask)
+    statistics = get_statistics(compute) if get_statistics is not None else compute()
+    return apply_histogram_matching(target_image, statistics, diffslider, mask)
 
-    # Handle edge cases
-    x = torch.where(y < fp[0], xp[0], x)
-    x = torch.where(y > fp[-1], xp[-1], x)
+def histogram_matching(source_image, target_image, diffslider):
+    """
+    Matches the histogram of each channel of target_image to the one of source_image. The images are [C,H,W] or
+    [N,C,H,W] batches in [0, 255], the channels of all the images are matched at once. Returns a float image in [0, 255].
+    """
+    return color_transfer('Test', source_image, target_image, diffslider)
 
-    return x
+def histogram_matching_withmask(source_image, target_image, mask, diffslider):
+    """
+    histogram_matching on the pixels where mask is above 0.2 only. mask is [H,W] or [1,H,W] for a [C,H,W] image, or
+    [N,1,H,W] for a batch. The channels without any masked pixel are left as they are.
+    """
+    return color_transfer('Test_Mask', source_image, target_image, diffslider, mask)
 
 def histogram_matching_DFL_test(source_image, target_image, diffslider):
-    # Converti i tensori Torch in array di tipo float32 e normalizza le immagini [0, 1]
-    source_image = source_image.type(torch.float32) / 255.0  # Forma (C, H, W)
-    target_image = target_image.type(torch.float32) / 255.0  # Forma (C, H, W)
-
-    # Converti da RGB a LAB (le funzioni dovrebbero supportare direttamente (C, H, W))
-    source = rgb_to_lab(source_image, False)  # Converti in LAB direttamente su (C, H, W)
-    target = rgb_to_lab(target_image, False)  # Converti in LAB direttamente su (C, H, W)
-
-    # Calcola media e deviazione standard per canali L, a, b direttamente su (C, H, W)
-    target_l_mean, target_l_std = target[0].mean(), target[0].std()
-    target_a_mean, target_a_std = target[1].mean(), target[1].std()
-    target_b_mean, target_b_std = target[2].mean(), target[2].std()
-
-    source_l_mean, source_l_std = source[0].mean(), source[0].std()
-    source_a_mean, source_a_std = source[1].mean(), source[1].std()
-    source_b_mean, source_b_std = source[2].mean(), source[2].std()
-
-    # Scala con le deviazioni standard reciproche del fattore proposto dal paper
-    target_l = (target[0] - target_l_mean) * (source_l_std / target_l_std) + source_l_mean
-    target_a = (target[1] - target_a_mean) * (source_a_std / target_a_std) + source_a_mean
-    target_b = (target[2] - target_b_mean) * (source_b_std / target_b_std) + source_b_mean
-
-    # Clamping dei valori
-    target_l = torch.clamp(target_l, 0, 100)
-    target_a = torch.clamp(target_a, -127, 127)
-    target_b = torch.clamp(target_b, -127, 127)
-
-    matched_target_image = torch.stack([target_l, target_a, target_b], 0)  # Forma (C, H, W)
-
-    # Converti da LAB a RGB direttamente su (C, H, W)
-    matched_target_image = lab_to_rgb(matched_target_image, False)  # Converti in RGB direttamente
-
-    # Calcolo dell'immagine finale
-    final_image = (1 - diffslider / 100) * target_image + (diffslider / 100) * matched_target_image
-    final_image = torch.clamp(final_image * 255, 0, 255)  # Converti in intervallo [0, 255]
-
-    return final_image
+    # DFL color transfer in LAB space, on [C,H,W] images or [N,C,H,W] batches in [0, 255]
+    return color_transfer('DFL_Test', source_image, target_image, diffslider)
 
 def histogram_matching_DFL_Orig(source_image, target_image, mask, diffslider):
-    # Converti i tensori Torch in array di tipo float32
-    source_image = source_image.type(torch.float32) / 255.0  # Forma (C, H, W)
-    target_image = target_image.type(torch.float32) / 255.0  # Forma (C, H, W)
-    mask = mask.type(torch.float32).squeeze()  # Rimuove dimensioni inutili, Forma (H, W)
-    mask_cutoff = 0.2
-
-    # Aggiungi una dimensione per i canali
-    mask = mask.unsqueeze(0)  # Forma (1, H, W)
-
-    # Espandi la maschera per coprire tutti i canali
-    source_mask = mask.expand(source_image.shape[0], -1, -1)  # Espande a (C, H, W)
-    target_mask = mask.expand(target_image.shape[0], -1, -1)  # Espande a (C, H, W)
-
-    # Converti da RGB a LAB (richiede un formato specifico)
-    source = rgb_to_lab(source_image, False)  # Converti in LAB direttamente su (C, H, W)
-    target = rgb_to_lab(target_image, False)  # Converti in LAB direttamente su (C, H, W)
-
-    # Applica la maschera
-    source_input = source.clone()
-    if source_mask is not None:
-        # Usa la maschera espansa per coprire tutte le dimensioni
-        source_input[source_mask < mask_cutoff] = 0.0
-
-    target_input = target.clone()
-    if target_mask is not None:
-        target_input[target_mask < mask_cutoff] = 0.0
-
-    # Calcola media e deviazione standard per canali L, a, b direttamente su (C, H, W)
-    target_l_mean, target_l_std = target_input[0].mean(), target_input[0].std()
-    target_a_mean, target_a_std = target_input[1].mean(), target_input[1].std()
-    target_b_mean, target_b_std = target_input[2].mean(), target_input[2].std()
-
-    source_l_mean, source_l_std = source_input[0].mean(), source_input[0].std()
-    source_a_mean, source_a_std = source_input[1].mean(), source_input[1].std()
-    source_b_mean, source_b_std = source_input[2].mean(), source_input[2].std()
-
-    # Scala con le deviazioni standard reciproche del fattore proposto dal paper
-    target_l = (target[0] - target_l_mean) * (source_l_std / target_l_std) + source_l_mean
-    target_a = (target[1] - target_a_mean) * (source_a_std / target_a_std) + source_a_mean
-    target_b = (target[2] - target_b_mean) * (source_b_std / target_b_std) + source_b_mean
-
-    # Clamping dei valori
-    target_l = torch.clamp(target_l, 0, 100)
-    target_a = torch.clamp(target_a, -127, 127)
-    target_b = torch.clamp(target_b, -127, 127)
-
-    matched_target_image = torch.stack([target_l, target_a, target_b], 0)  # Forma (C, H, W)
-
-    # Converti da LAB a RGB direttamente su (C, H, W)
-    matched_target_image = lab_to_rgb(matched_target_image, False)  # Converti in RGB direttamente
-
-    # Calcolo dell'immagine finale
-    final_image = (1 - diffslider / 100) * target_image + (diffslider / 100) * matched_target_image
-    final_image = torch.clamp(final_image * 255, 0, 255)  # Converti in intervallo [0, 255]
-
-    return final_image
+    """
+    DFL color transfer in LAB space with the statistics of the masked pixels, on [C,H,W] images with a [H,W] or [1,H,W]
+    mask or [N,C,H,W] batches with a [N,1,H,W] mask, in [0, 255]. The pixels outside of the mask count as 0.
+    """
+    return color_transfer('DFL_Orig', source_image, target_image, diffslider, mask)
 
 def transform_t(img, center, output_size, scale, rotation):
     device = img.device
@@ -0,0 +1,59 @@
+import torch
+from torchvision.transforms import v2
+
+class LetterboxSpec:
+    def __init__(self, input_size, mean=0.0, std=1.0, swap_rb=False, antialias=True):
+        # input_size is (width, height)
+        self.input_size = input_size
+        self.mean = mean
+        self.std = std
+        # Feed the channels in BGR order
+        self.swap_rb = swap_rb
+        self.antialias = antialias
+
+class LetterboxBuffers:
+    def __init__(self, spec: LetterboxSpec, device):
+        self.spec = spec
+        self.device = device
+        # Model input, kept normalized so it can be bound directly
+        self.input = torch.empty((1, 3, spec.input_size[1], spec.input_size[0]), dtype=torch.float32, device=device)
+        # normalized = pixel * scale + offset
+        self.scale = torch.tensor(1.0 / spec.std, dtype=torch.float32, device=device)
+        self.offset = torch.tensor(-spec.mean / spec.std, dtype=torch.float32, device=device)
+        self.filled_size = None
+
+def get_letterbox_size(img, input_size):
+    img_height, img_width = (img.size()[1], img.size()[2])
+    im_ratio = torch.div(img_height, img_width)
+
+    model_ratio = float(input_size[1]) / input_size[0]
+    if im_ratio > model_ratio:
+        new_height = input_size[1]
+        new_width = int(new_height / im_ratio)
+    else:
+        new_width = input_size[0]
+        new_height = int(new_width * im_ratio)
+    det_scale = torch.div(new_height, img_height)
+
+    return new_height, new_width, det_scale
+
+def letterbox(img, buffers: LetterboxBuffers):
+    # Resize the CxHxW uint8 frame to fit the model input, then write it normalized into the top left corner of the input buffer
+    # Returns the [1,3,H,W] input tensor and the scale from the frame to the input
+    spec = buffers.spec
+    new_height, new_width, det_scale = get_letterbox_size(img, spec.input_size)
+
+    resize = v2.Resize((new_height, new_width), antialias=spec.antialias)
+    img = resize(img)
+
+    # The padding is black (normalized value of 0), it only needs to be filled again when the size of the resized frame changes
+    if buffers.filled_size != (new_height, new_width):
+        buffers.input.copy_(buffers.offset.expand_as(buffers.input))
+        buffers.filled_size = (new_height, new_width)
+
+    # Channel swap and normalization are done in the same pass as the copy into the input buffer
+    channels = [2, 1, 0] if spec.swap_rb else [0, 1, 2]
+    for dst_channel, src_channel in enumerate(channels):
+        torch.addcmul(buffers.offset, img[src_channel], buffers.scale, out=buffers.input[0, dst_channel, :new_height, :new_width])
+
+    return buffers.input, det_scale
@@ -0,0 +1,30 @@
+import torch
+
+def dilate_mask(mask, radius):
+    """
+    Grows the white areas of a mask in [0, 1] by radius pixels with a (2*radius+1) square max filter, split in a
+    horizontal and a vertical max-pool. For binary masks this is the result of radius passes of a 3x3 dilation.
+    mask is [H,W], [C,H,W] or [N,C,H,W], the result has the same shape.
+    """
+    radius = int(radius)
+    if radius <= 0:
+        return mask
+    shape = mask.shape
+    dilated = mask.reshape(-1, 1, shape[-2], shape[-1])
+    if not dilated.is_floating_point():
+        dilated = dilated.to(torch.float32)
+    dilated = torch.nn.functional.max_pool2d(dilated, kernel_size=(1, 2*radius+1), stride=1, padding=(0, radius))
+    dilated = torch.nn.functional.max_pool2d(dilated, kernel_size=(2*radius+1, 1), stride=1, padding=(radius, 0))
+    return dilated.reshape(shape)
+
+def erode_mask(mask, radius):
+    # Shrinks the white areas of a mask in [0, 1] by radius pixels
+    return 1 - dilate_mask(1 - mask, radius)
+
+def grow_mask(mask, amount):
+    # Dilates the mask for a positive amount and erodes it for a negative one, like the size sliders of the masks
+    if amount > 0:
+        return dilate_mask(mask, amount)
+    if amount < 0:
+        return erode_mask(mask, -amount)
+    return mask
@@ -0,0 +1,69 @@
+import json
+
+import numpy as np
+
+class SceneDetector:
+    def __init__(self, bins=32, max_sample_size=256):
+        self.bins = bins
+        # Longest side of the subsampled frame used to build the histogram
+        self.max_sample_size = max_sample_size
+        self.reset()
+
+    def reset(self):
+        self.last_frame_number = None
+        self.last_histogram = None
+        self.current_shot_id = -1
+        # List of [shot_id, start_frame, end_frame]
+        self.shots = []
+
+    def get_luma_histogram(self, frame):
+        # Strided subsampling, only a few thousand pixels are read even for 4K frames
+        step = max(1, max(frame.shape[0], frame.shape[1]) // self.max_sample_size)
+        sample = frame[::step, ::step].astype(np.uint16)
+
+        # Rec. 601 luma of the RGB frame, in fixed point
+        luma = (sample[..., 0] * 77 + sample[..., 1] * 150 + sample[..., 2] * 29) >> 8
+        histogram = np.bincount((luma // (256 // self.bins)).ravel(), minlength=self.bins)
+
+        return histogram / luma.size
+
+    def start_new_shot(self, frame_number):
+        self.current_shot_id += 1
+        self.shots.append([self.current_shot_id, frame_number, frame_number])
+
+    def process_frame(self, frame_number, frame, threshold=0.35):
+        # Same frame read again (eg: after a seek the current frame is processed before the playback starts)
+        if frame_number == self.last_frame_number:
+            return self.current_shot_id
+
+        histogram = self.get_luma_histogram(frame)
+
+        # Frames are not contiguous after a seek, the content before is unknown so a new shot is started
+        if self.last_histogram is None or frame_number != self.last_frame_number + 1:
+            self.start_new_shot(frame_number)
+        else:
+            # Half of the L1 distance, 0 for identical and 1 for disjoint histograms
+            distance = 0.5 * np.abs(histogram - self.last_histogram).sum()
+            if distance > threshold:
+                self.start_new_shot(frame_number)
+            else:
+                self.shots[-1][2] = frame_number
+
+        self.last_frame_number = frame_number
+        self.last_histogram = histogram
+
+        return self.current_shot_id
+
+    def get_shot_list(self, fps=0.0):
+        shot_list = []
+        for shot_id, start_frame, end_frame in self.shots:
+            shot = {'shot_id': shot_id, 'start_frame': start_frame, 'end_frame': end_frame}
+            if fps > 0:
+                shot['start_time'] = round(start_frame / fps, 3)
+                shot['end_time'] = round((end_frame + 1) / fps, 3)
+            shot_list.append(shot)
+        return shot_list
+
+    def export_shot_list(self, file_path, fps=0.0):
+        with open(file_path, 'w') as shot_list_file:
+            json.dump(self.get_shot_list(fps), shot_list_file, indent=4)
@@ -0,0 +1,62 @@
+import math
+import threading
+
+import torch
+
+class TensorArena:
+    """
+    Reusable buffers of a frame worker, so that the tensors of the same shape that are needed for every face of every
+    frame are allocated once. Buffers are keyed by a name, dtype and device and grow to the largest shape requested
+    with that name, so that the buffers of varying batch sizes are not kept once per size: a buffer is only valid until
+    the next get() with the same name, two tensors that are alive at the same time need different names.
+    """
+    def __init__(self):
+        # Key: (name, dtype, device), Value: flat tensor
+        self.buffers = {}
+
+    def get(self, name, shape, dtype=torch.float32, device='cpu', fill=None) -> torch.Tensor:
+        key = (name, dtype, str(device))
+        shape = tuple(shape)
+        numel = math.prod(shape)
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.numel() < numel:
+            # The smaller buffer is released before the larger one is allocated
+            self.buffers.pop(key, None)
+            buffer = torch.empty(numel, dtype=dtype, device=device)
+            self.buffers[key] = buffer
+        buffer = buffer[:numel].view(shape)
+        if fill is not None:
+            buffer.fill_(fill)
+        return buffer
+
+    def copy(self, name, tensor: torch.Tensor) -> torch.Tensor:
+        # Contiguous copy of tensor in a buffer of the arena
+        return self.get(name, tensor.shape, tensor.dtype, tensor.device).copy_(tensor)
+
+    def clear(self):
+        self.buffers.clear()
+
+class TensorArenaPool:
+    """
+    Arenas of the frame workers. A worker takes an arena for the frame it processes and gives it back when it is done,
+    the arenas outlive the workers so that their buffers are reused across the frames.
+    """
+    def __init__(self, max_free_arenas=8):
+        self.lock = threading.Lock()
+        self.free_arenas = []
+        self.max_free_arenas = max_free_arenas
+
+    def acquire(self) -> TensorArena:
+        with self.lock:
+            if self.free_arenas:
+                return self.free_arenas.pop()
+        return TensorArena()
+
+    def release(self, arena: TensorArena):
+        with self.lock:
+            if len(self.free_arenas) < self.max_free_arenas:
+                self.free_arenas.append(arena)
+
+    def clear(self):
+        with self.lock:
+            self.free_arenas.clear()
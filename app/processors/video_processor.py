@@ -16,6 +16,9 @@ import pyvirtualcam
 from PySide6.QtCore import QObject, QTimer, Signal, Slot
 from PySide6.QtGui import QPixmap
 from app.processors.workers.frame_worker import FrameWorker
+from app.processors.utils.scene_detector import SceneDetector
+from app.processors.utils.embedding_cache import TrackEmbeddingCache
+from app.processors.utils.color_transfer_cache import TrackColorTransferCache
 from app.ui.widgets.actions import graphics_view_actions
 from app.ui.widgets.actions import common_actions as common_widget_actions
 
@@ -44,6 +47,13 @@ class VideoProcessor(QObject):
         self.num_threads = num_threads
         self.threads: Dict[int, threading.Thread] = {}
 
+        # Tags each decoded video frame with the ID of the shot it belongs to
+        self.scene_detector = SceneDetector()
+        # Recognition embeddings of the faces tracked across the frames
+        self.embedding_cache = TrackEmbeddingCache()
+        # Color transfer statistics of the faces tracked across the frames
+        self.color_transfer_cache = TrackColorTransferCache()
+
         self.current_frame: numpy.ndarray = []
         self.recording = False
 
@@ -181,6 +191,11 @@ class VideoProcessor(QObject):
                 self.threads.clear()
 
                 if self.recording:
+                    # The exported shot list only holds the shots of the recorded frames, not those of the previews and seeks before
+                    # The shot IDs start again from 0, so the tracks tagged with the previous IDs are dropped too
+                    self.scene_detector.reset()
+                    self.embedding_cache.reset()
+                    self.color_transfer_cache.reset()
                     self.create_ffmpeg_subprocess()
 
                 self.play_start_time = float(self.media_capture.get(cv2.CAP_PROP_POS_FRAMES) / float(self.fps))
@@ -239,18 +254,25 @@ class VideoProcessor(QObject):
             ret, frame = misc_helpers.read_frame(self.media_capture, preview_mode = not self.recording)
             if ret:
                 frame = frame[..., ::-1]  # Convert BGR to RGB
+                shot_id = self.detect_shot(self.current_frame_number, frame)
                 # print(f"Enqueuing frame {self.current_frame_number}")
                 self.frame_queue.put(self.current_frame_number)
-                self.start_frame_worker(self.current_frame_number, frame)
+                self.start_frame_worker(self.current_frame_number, frame, shot_id=shot_id)
                 self.current_frame_number += 1
             else:
                 print("Cannot read frame!", self.current_frame_number)
                 self.stop_processing()
                 self.main_window.display_messagebox_signal.emit('Error Reading Frame', f'Error Reading Frame {self.current_frame_number}.\n Stopped Processing...!', self.main_window)
 
-    def start_frame_worker(self, frame_number, frame, is_single_frame=False):
+    def detect_shot(self, frame_number, frame):
+        """Return the shot ID of the given video frame, or None if scene detection is disabled."""
+        if not self.main_window.control['SceneDetectEnableToggle']:
+            return None
+        return self.scene_detector.process_frame(frame_number, frame, threshold=self.main_window.control['SceneDetectThresholdSlider']/100.0)
+
+    def start_frame_worker(self, frame_number, frame, is_single_frame=False, shot_id=None):
         """Start a FrameWorker to process the given frame."""
-        worker = FrameWorker(frame, self.main_window, frame_number, self.frame_queue, is_single_frame)
+        worker = FrameWorker(frame, self.main_window, frame_number, self.frame_queue, is_single_frame, shot_id)
         self.threads[frame_number] = worker
         if is_single_frame:
             worker.run()
@@ -267,9 +289,10 @@ class VideoProcessor(QObject):
             ret, frame = misc_helpers.read_frame(self.media_capture, preview_mode=False)
             if ret:
                 frame = frame[..., ::-1]  # Convert BGR to RGB
+                shot_id = self.detect_shot(self.current_frame_number, frame)
                 # print(f"Enqueuing frame {self.current_frame_number}")
                 self.frame_queue.put(self.current_frame_number)
-                self.start_frame_worker(self.current_frame_number, frame, is_single_frame=True)
+                self.start_frame_worker(self.current_frame_number, frame, is_single_frame=True, shot_id=shot_id)
                 
                 self.media_capture.set(cv2.CAP_PROP_POS_FRAMES, self.current_frame_number)
             else:
@@ -370,11 +393,19 @@ class VideoProcessor(QObject):
                     subprocess.run(args, check=False) #Add Audio
                     os.remove(self.temp_file)
 
+                    if self.main_window.control['SceneDetectEnableToggle'] and self.main_window.control['SceneDetectExportShotListToggle']:
+                        shot_list_file_path = f'{os.path.splitext(final_file_path)[0]}_shots.json'
+                        self.scene_detector.export_shot_list(shot_list_file_path, fps=self.fps)
+                        print(f"Shot list saved to {shot_list_file_path}")
+
                 self.end_time = time.perf_counter()
                 processing_time = self.end_time - self.start_time
                 print(f"\nProcessing completed in {processing_time} seconds")
                 avg_fps = ((self.play_end_time - self.play_start_time) * self.fps) / processing_time
                 print(f'Average FPS: {avg_fps}\n')
+                cache_stats = self.embedding_cache.get_stats()
+                if cache_stats['hits'] or cache_stats['misses']:
+                    print(f"Recognition cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({cache_stats['hit_rate']:.1%} hit rate)\n")
 
                 if self.recording:
                     layout_actions.enable_all_parameters_and_control_widget(self.main_window)
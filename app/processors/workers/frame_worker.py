@@ -2,20 +2,22 @@ import traceback
 from typing import TYPE_CHECKING
 import threading
 from math import floor, ceil
+from functools import partial
 
 import torch
 from skimage import transform as trans
 
 from torchvision.transforms import v2
 import torchvision
-from torchvision import transforms
 
 import numpy as np
 
 from app.processors.utils import faceutil
+from app.processors.utils.face_pyramid import FacePyramid
+from app.processors.utils.tensor_arena import TensorArena
 import app.ui.widgets.actions.common_actions as common_widget_actions
 from app.ui.widgets.actions import video_control_actions
-from app.helpers.miscellaneous import t512,t384,t256,t128, ParametersDict
+from app.helpers.miscellaneous import t512,t128, ParametersDict
 
 if TYPE_CHECKING:
     from app.ui.main_ui import MainWindow
@@ -23,12 +25,14 @@ if TYPE_CHECKING:
 torchvision.disable_beta_transforms_warning()
 
 class FrameWorker(threading.Thread):
-    def __init__(self, frame, main_window: 'MainWindow', frame_number, frame_queue, is_single_frame=False):
+    def __init__(self, frame, main_window: 'MainWindow', frame_number, frame_queue, is_single_frame=False, shot_id=None):
         super().__init__()
         self.frame_queue = frame_queue
         self.frame = frame
         self.main_window = main_window
         self.frame_number = frame_number
+        # ID of the shot the frame belongs to (None when scene detection is disabled or for images and webcam)
+        self.shot_id = shot_id
         self.models_processor = main_window.models_processor
         self.video_processor = main_window.video_processor
         self.is_single_frame = is_single_frame
@@ -37,6 +41,8 @@ class FrameWorker(threading.Thread):
         self.compare_images = []
         self.is_view_face_compare: bool = False
         self.is_view_face_mask: bool = False
+        # Buffers reused across frames, taken from the pool of the models processor while the frame is processed
+        self.tensor_arena: TensorArena = None
 
     def run(self):
         try:
@@ -51,7 +57,12 @@ class FrameWorker(threading.Thread):
             # Process the frame with model inference
             # print(f"Processing frame {self.frame_number}")
             if self.main_window.swapfacesButton.isChecked() or self.main_window.editFacesButton.isChecked() or self.main_window.control['FrameEnhancerEnableToggle']:
-                self.frame = self.process_frame()
+                self.tensor_arena = self.models_processor.tensor_arena_pool.acquire()
+                try:
+                    self.frame = self.process_frame()
+                finally:
+                    self.models_processor.tensor_arena_pool.release(self.tensor_arena)
+                    self.tensor_arena = None
             else:
                 # Img must be in BGR format
                 self.frame = self.frame[..., ::-1]  # Swap the channels from RGB to BGR
@@ -141,46 +152,78 @@ class FrameWorker(threading.Thread):
             # force to use from_points in landmark detector when edit face is enabled.
             from_points = True
 
-        bboxes, kpss_5, kpss = self.models_processor.run_detect(img, control['DetectorModelSelection'], max_num=control['MaxFacesToDetectSlider'], score=control['DetectorScoreSlider']/100.0, input_size=(512, 512), use_landmark_detection=use_landmark_detection, landmark_detect_mode=landmark_detect_mode, landmark_score=control["LandmarkDetectScoreSlider"]/100.0, from_points=from_points, rotation_angles=[0] if not control["AutoRotationToggle"] else [0, 90, 180, 270])
+        bboxes, kpss_5, kpss = self.models_processor.run_detect(img, control['DetectorModelSelection'], max_num=control['MaxFacesToDetectSlider'], score=control['DetectorScoreSlider']/100.0, input_size=control['DetectorInputSizeSelection'], use_landmark_detection=use_landmark_detection, landmark_detect_mode=landmark_detect_mode, landmark_score=control["LandmarkDetectScoreSlider"]/100.0, from_points=from_points, rotation_angles=[0] if not control["AutoRotationToggle"] else [0, 90, 180, 270])
         
         det_faces_data = []
         if len(kpss_5)>0:
+            # Recognize all the detected faces at once
+            def recognize_faces(indexes):
+                return self.models_processor.run_recognize_direct_batch(img, kpss_5[indexes], control['SimilarityTypeSelection'], control['RecognitionModelSelection'])[0]
+
+            # The identity of a tracked face doesn't change within a shot, so video frames reuse the embeddings of the previous frames
+            if control['RecognitionCacheEnableToggle'] and self.video_processor.file_type == 'video':
+                model_key = (control['RecognitionModelSelection'], control['SimilarityTypeSelection'])
+                faces_emb = self.video_processor.embedding_cache.get_embeddings(self.frame_number, self.shot_id, model_key, bboxes, kpss_5, recognize_faces, refresh_interval=control['RecognitionCacheRefreshSlider'])
+            else:
+                faces_emb = recognize_faces(list(range(kpss_5.shape[0])))
             for i in range(kpss_5.shape[0]):
                 face_kps_5 = kpss_5[i]
                 face_kps_all = kpss[i]
-                face_emb, _ = self.models_processor.run_recognize_direct(img, face_kps_5, control['SimilarityTypeSelection'], control['RecognitionModelSelection'])
-                det_faces_data.append({'kps_5': face_kps_5, 'kps_all': face_kps_all, 'embedding': face_emb, 'bbox': bboxes[i]})
+                det_faces_data.append({'kps_5': face_kps_5, 'kps_all': face_kps_all, 'embedding': faces_emb[i], 'bbox': bboxes[i]})
 
         compare_mode = self.is_view_face_mask or self.is_view_face_compare
         
         if det_faces_data:
-            # Loop through target faces to see if they match our found face embeddings
-            for i, fface in enumerate(det_faces_data):
-                    for _, target_face in self.main_window.target_faces.items():
-                        parameters = ParametersDict(self.parameters[target_face.face_id], self.main_window.default_parameters) #Use the parameters of the target face
-
-                        if self.main_window.swapfacesButton.isChecked() or self.main_window.editFacesButton.isChecked():
-                            sim = self.models_processor.findCosineDistance(fface['embedding'], target_face.get_embedding(control['RecognitionModelSelection'])) # Recognition for comparing
-                            if sim>=parameters['SimilarityThresholdSlider']:
-                                s_e = None
-                                fface['kps_5'] = self.keypoints_adjustments(fface['kps_5'], parameters) #Make keypoints adjustments
-                                arcface_model = self.models_processor.get_arcface_model(parameters['SwapModelSelection'])
-                                dfm_model=parameters['DFMModelSelection']
-                                if self.main_window.swapfacesButton.isChecked():
-                                    if parameters['SwapModelSelection'] != 'DeepFaceLive (DFM)':
-                                        s_e = target_face.assigned_input_embedding.get(arcface_model, None)
-                                    if s_e is not None and np.isnan(s_e).any():
-                                        s_e = None
-                                else:
-                                    dfm_model = None
-                                    s_e = None
-
-                                # swap_core function is executed even if 'Swap Faces' button is disabled,
-                                # because it also returns the original face and face mask 
-                                img, fface['original_face'], fface['swap_mask'] = self.swap_core(img, fface['kps_5'], s_e=s_e, t_e=target_face.get_embedding(arcface_model), parameters=parameters, control=control, dfm_model=dfm_model)
-                                        # cv2.imwrite('temp_swap_face.png', swapped_face.permute(1,2,0).cpu().numpy())
-                                if self.main_window.editFacesButton.isChecked():
-                                    img = self.swap_edit_face_core(img, fface['kps_all'], parameters, control)
+            # Match all the detected faces against all the target faces at once
+            target_faces = list(self.main_window.target_faces.values())
+            thresholds = [ParametersDict(self.parameters[target_face.face_id], self.main_window.default_parameters)['SimilarityThresholdSlider'] for target_face in target_faces]
+            matches = self.models_processor.match_target_faces(faces_emb, target_faces, control['RecognitionModelSelection'], thresholds, one_to_one=control['OneToOneFaceMatchingToggle'])
+            for fface in det_faces_data:
+                fface['matched_target_faces'] = []
+            for i, target_face in matches:
+                det_faces_data[i]['matched_target_faces'].append(target_face)
+
+            if self.main_window.swapfacesButton.isChecked() or self.main_window.editFacesButton.isChecked():
+                # (detected face, parameters, swap_core arguments) of each face to swap
+                swap_faces = []
+                for i, target_face in matches:
+                    fface = det_faces_data[i]
+                    parameters = ParametersDict(self.parameters[target_face.face_id], self.main_window.default_parameters) #Use the parameters of the target face
+
+                    s_e = None
+                    fface['kps_5'] = self.keypoints_adjustments(fface['kps_5'], parameters) #Make keypoints adjustments
+                    arcface_model = self.models_processor.get_arcface_model(parameters['SwapModelSelection'])
+                    dfm_model=parameters['DFMModelSelection']
+                    if self.main_window.swapfacesButton.isChecked():
+                        if parameters['SwapModelSelection'] != 'DeepFaceLive (DFM)':
+                            s_e = target_face.assigned_input_embedding.get(arcface_model, None)
+                        if s_e is not None and np.isnan(s_e).any():
+                            s_e = None
+                    else:
+                        dfm_model = None
+                        s_e = None
+
+                    # The adjustments of the next matches of this face change its keypoints in place, so each swap keeps a copy of them
+                    swap_faces.append((fface, parameters, {'kps_5': fface['kps_5'].copy(), 's_e': s_e, 't_e': target_face.get_embedding(arcface_model), 'parameters': parameters, 'dfm_model': dfm_model}))
+
+                # swap_core function is executed even if 'Swap Faces' button is disabled,
+                # because it also returns the original face and face mask 
+                if self.main_window.editFacesButton.isChecked():
+                    # Face editing works on the frame with the previous faces already swapped, so the faces are done one by one
+                    for fface, parameters, swap_args in swap_faces:
+                        img, fface['original_face'], fface['swap_mask'] = self.swap_core(img, control=control, **swap_args)
+                        img = self.swap_edit_face_core(img, fface['kps_all'], parameters, control)
+                else:
+                    # A detected face matched by several target faces is swapped again on the result of its previous swap, so it starts a new batch
+                    batches = [[]]
+                    for swap_face in swap_faces:
+                        if any(swap_face[0] is batch_face[0] for batch_face in batches[-1]):
+                            batches.append([])
+                        batches[-1].append(swap_face)
+                    for batch in batches:
+                        img, results = self.swap_core_batch(img, [swap_args for _, _, swap_args in batch], control)
+                        for (fface, _, _), (original_face, swap_mask) in zip(batch, results):
+                            fface['original_face'], fface['swap_mask'] = original_face, swap_mask
 
         if control['ManualRotationEnableToggle']:
             img = v2.functional.rotate(img, angle=-control['ManualRotationAngleSlider'], interpolation=v2.InterpolationMode.BILINEAR, expand=True)
@@ -237,28 +280,26 @@ class FrameWorker(threading.Thread):
         #     p = 2
         p = 2 #Point thickness
         for i, fface in enumerate(det_faces_data):
-            for _, target_face in self.main_window.target_faces.items():
+            for target_face in fface['matched_target_faces']:
                 parameters = self.parameters[target_face.face_id] #Use the parameters of the target face
-                sim = self.models_processor.findCosineDistance(fface['embedding'], target_face.get_embedding(control['RecognitionModelSelection']))
-                if sim>=parameters['SimilarityThresholdSlider']:
-                    if parameters['LandmarksPositionAdjEnableToggle']:
-                        kcolor = tuple((255, 0, 0))
-                        keypoints = fface['kps_5']
-                    else:
-                        kcolor = tuple((0, 255, 255))
-                        keypoints = fface['kps_all']
-
-                    for kpoint in keypoints:
-                        for i in range(-1, p):
-                            for j in range(-1, p):
-                                try:
-                                    img[int(kpoint[1])+i][int(kpoint[0])+j][0] = kcolor[0]
-                                    img[int(kpoint[1])+i][int(kpoint[0])+j][1] = kcolor[1]
-                                    img[int(kpoint[1])+i][int(kpoint[0])+j][2] = kcolor[2]
-
-                                except ValueError:
-                                    #print("Key-points value {} exceed the image size {}.".format(kpoint, (img_x, img_y)))
-                                    continue
+                if parameters['LandmarksPositionAdjEnableToggle']:
+                    kcolor = tuple((255, 0, 0))
+                    keypoints = fface['kps_5']
+                else:
+                    kcolor = tuple((0, 255, 255))
+                    keypoints = fface['kps_all']
+
+                for kpoint in keypoints:
+                    for i in range(-1, p):
+                        for j in range(-1, p):
+                            try:
+                                img[int(kpoint[1])+i][int(kpoint[0])+j][0] = kcolor[0]
+                                img[int(kpoint[1])+i][int(kpoint[0])+j][1] = kcolor[1]
+                                img[int(kpoint[1])+i][int(kpoint[0])+j][2] = kcolor[2]
+
+                            except ValueError:
+                                #print("Key-points value {} exceed the image size {}.".format(kpoint, (img_x, img_y)))
+                                continue
         return img
     
     def draw_bounding_boxes_on_detected_faces(self, img: torch.Tensor, det_faces_data: list, control: dict):
@@ -288,44 +329,39 @@ class FrameWorker(threading.Thread):
     def get_compare_faces_image(self, img: torch.Tensor, det_faces_data: dict, control: dict) -> torch.Tensor:
         imgs_to_vstack = []  # Renamed for vertical stacking
         for _, fface in enumerate(det_faces_data):
-            for _, target_face in self.main_window.target_faces.items():
+            for target_face in fface['matched_target_faces']:
                 parameters = self.parameters[target_face.face_id]  # Use the parameters of the target face
-                sim = self.models_processor.findCosineDistance(
-                    fface['embedding'], 
-                    target_face.get_embedding(control['RecognitionModelSelection'])
-                )
-                if sim >= parameters['SimilarityThresholdSlider']:
-                    modified_face = self.get_cropped_face_using_kps(img, fface['kps_5'], parameters)
-                    # Apply frame enhancer
-                    if control['FrameEnhancerEnableToggle']:
-                        # Enhance the face and resize it to the original size for stacking
-                        modified_face_enhance = self.enhance_core(modified_face, control=control)
-                        modified_face_enhance = modified_face_enhance.float() / 255.0
-                        # Resize source_tensor to match the size of target_tensor
-                        modified_face = torch.functional.F.interpolate(
-                            modified_face_enhance.unsqueeze(0),  # Add batch dimension
-                            size=modified_face.shape[1:],  # Target size: [H, W]
-                            mode='bilinear',  # Interpolation mode
-                            align_corners=False  # Avoid alignment artifacts
-                        ).squeeze(0)  # Remove batch dimension
-                        
-                        modified_face = (modified_face * 255).clamp(0, 255).to(dtype=torch.uint8)
-                    imgs_to_cat = []
+                modified_face = self.get_cropped_face_using_kps(img, fface['kps_5'], parameters)
+                # Apply frame enhancer
+                if control['FrameEnhancerEnableToggle']:
+                    # Enhance the face and resize it to the original size for stacking
+                    modified_face_enhance = self.enhance_core(modified_face, control=control)
+                    modified_face_enhance = modified_face_enhance.float() / 255.0
+                    # Resize source_tensor to match the size of target_tensor
+                    modified_face = torch.functional.F.interpolate(
+                        modified_face_enhance.unsqueeze(0),  # Add batch dimension
+                        size=modified_face.shape[1:],  # Target size: [H, W]
+                        mode='bilinear',  # Interpolation mode
+                        align_corners=False  # Avoid alignment artifacts
+                    ).squeeze(0)  # Remove batch dimension
                     
-                    # Append tensors to imgs_to_cat
-                    if fface['original_face'] is not None:
-                        imgs_to_cat.append(fface['original_face'].permute(2, 0, 1))
-                    imgs_to_cat.append(modified_face)
-                    if fface['swap_mask'] is not None:
-                        fface['swap_mask'] = 255-fface['swap_mask']
-                        imgs_to_cat.append(fface['swap_mask'].permute(2, 0, 1))
-  
-                    # Concatenate horizontally for comparison
-                    img_compare = torch.cat(imgs_to_cat, dim=2)
-
-                    # Add horizontally concatenated image to vertical stack list
-                    imgs_to_vstack.append(img_compare)
-    
+                    modified_face = (modified_face * 255).clamp(0, 255).to(dtype=torch.uint8)
+                imgs_to_cat = []
+                
+                # Append tensors to imgs_to_cat
+                if fface['original_face'] is not None:
+                    imgs_to_cat.append(fface['original_face'].permute(2, 0, 1))
+                imgs_to_cat.append(modified_face)
+                if fface['swap_mask'] is not None:
+                    fface['swap_mask'] = 255-fface['swap_mask']
+                    imgs_to_cat.append(fface['swap_mask'].permute(2, 0, 1))
+
+                # Concatenate horizontally for comparison
+                img_compare = torch.cat(imgs_to_cat, dim=2)
+
+                # Add horizontally concatenated image to vertical stack list
+                imgs_to_vstack.append(img_compare)
+
         if imgs_to_vstack:
             # Find the maximum width
             max_width = max(img_to_stack.size(2) for img_to_stack in imgs_to_vstack)
@@ -343,8 +379,7 @@ class FrameWorker(threading.Thread):
     def get_cropped_face_using_kps(self, img: torch.Tensor, kps_5: np.ndarray, parameters: dict) -> torch.Tensor:
         tform = self.get_face_similarity_tform(parameters['SwapModelSelection'], kps_5)
         # Grab 512 face from image and create 256 and 128 copys
-        face_512 = v2.functional.affine(img, tform.rotation*57.2958, (tform.translation[0], tform.translation[1]) , tform.scale, 0, center = (0,0), interpolation=v2.InterpolationMode.BILINEAR )
-        face_512 = v2.functional.crop(face_512, 0,0, 512, 512)# 3, 512, 512
+        face_512 = faceutil.warp_affine_roi(img, tform.params[0:2], 0, 0, 512, 512, interpolation=v2.InterpolationMode.BILINEAR)# 3, 512, 512
         return face_512
 
     def get_face_similarity_tform(self, swapper_model: str, kps_5: np.ndarray) -> trans.SimilarityTransform:
@@ -362,144 +397,145 @@ class FrameWorker(threading.Thread):
             tform.params[0:2] = M
         return tform
       
-    def get_transformed_and_scaled_faces(self, tform, img):
-        # Grab 512 face from image and create 256 and 128 copys
-        original_face_512 = v2.functional.affine(img, tform.rotation*57.2958, (tform.translation[0], tform.translation[1]) , tform.scale, 0, center = (0,0), interpolation=v2.InterpolationMode.BILINEAR )
-        original_face_512 = v2.functional.crop(original_face_512, 0,0, 512, 512)# 3, 512, 512
-        original_face_384 = t384(original_face_512)
-        original_face_256 = t256(original_face_512)
-        original_face_128 = t128(original_face_256)
-        return original_face_512, original_face_384, original_face_256, original_face_128
+    def get_transformed_and_scaled_faces(self, tform, img) -> FacePyramid:
+        # 512, 384, 256 and 128 faces, each one is grabbed from the image when it is first used
+        return FacePyramid(img, tform, 512)
     
-    def get_affined_face_dim_and_swapping_latents(self, original_faces: tuple, swapper_model, dfm_model, s_e, t_e, parameters,):
-        original_face_512, original_face_384, original_face_256, original_face_128 = original_faces
+    def get_affined_face_dim_and_swapping_latents(self, original_faces: FacePyramid, swapper_model, dfm_model, s_e, t_e, parameters,):
         if swapper_model == 'Inswapper128':
             self.models_processor.load_inswapper_iss_emap('Inswapper128')
-            latent = torch.from_numpy(self.models_processor.calc_inswapper_latent(s_e)).float().to(self.models_processor.device)
+            latent = self.models_processor.get_swapper_latent(swapper_model, s_e)
             if parameters['FaceLikenessEnableToggle']:
                 factor = parameters['FaceLikenessFactorDecimalSlider']
-                dst_latent = torch.from_numpy(self.models_processor.calc_inswapper_latent(t_e)).float().to(self.models_processor.device)
+                dst_latent = self.models_processor.get_swapper_latent(swapper_model, t_e)
                 latent = latent - (factor * dst_latent)
 
             dim = 1
             if parameters['SwapperResSelection'] == '128':
                 dim = 1
-                input_face_affined = original_face_128
+                input_face_affined = original_faces[128]
             elif parameters['SwapperResSelection'] == '256':
                 dim = 2
-                input_face_affined = original_face_256
+                input_face_affined = original_faces[256]
             elif parameters['SwapperResSelection'] == '384':
                 dim = 3
-                input_face_affined = original_face_384
+                input_face_affined = original_faces[384]
             elif parameters['SwapperResSelection'] == '512':
                 dim = 4
-                input_face_affined = original_face_512
+                input_face_affined = original_faces[512]
 
         elif swapper_model in ('InStyleSwapper256 Version A', 'InStyleSwapper256 Version B', 'InStyleSwapper256 Version C'):
-            version = swapper_model[-1]
             self.models_processor.load_inswapper_iss_emap(swapper_model)
-            latent = torch.from_numpy(self.models_processor.calc_swapper_latent_iss(s_e, version)).float().to(self.models_processor.device)
+            latent = self.models_processor.get_swapper_latent(swapper_model, s_e)
             if parameters['FaceLikenessEnableToggle']:
                 factor = parameters['FaceLikenessFactorDecimalSlider']
-                dst_latent = torch.from_numpy(self.models_processor.calc_swapper_latent_iss(t_e, version)).float().to(self.models_processor.device)
+                dst_latent = self.models_processor.get_swapper_latent(swapper_model, t_e)
                 latent = latent - (factor * dst_latent)
 
             dim = 2
-            input_face_affined = original_face_256
+            input_face_affined = original_faces[256]
 
         elif swapper_model == 'SimSwap512':
-            latent = torch.from_numpy(self.models_processor.calc_swapper_latent_simswap512(s_e)).float().to(self.models_processor.device)
+            latent = self.models_processor.get_swapper_latent(swapper_model, s_e)
             if parameters['FaceLikenessEnableToggle']:
                 factor = parameters['FaceLikenessFactorDecimalSlider']
-                dst_latent = torch.from_numpy(self.models_processor.calc_swapper_latent_simswap512(t_e)).float().to(self.models_processor.device)
+                dst_latent = self.models_processor.get_swapper_latent(swapper_model, t_e)
                 latent = latent - (factor * dst_latent)
 
             dim = 4
-            input_face_affined = original_face_512
+            input_face_affined = original_faces[512]
 
         elif swapper_model == 'GhostFace-v1' or swapper_model == 'GhostFace-v2' or swapper_model == 'GhostFace-v3':
-            latent = torch.from_numpy(self.models_processor.calc_swapper_latent_ghost(s_e)).float().to(self.models_processor.device)
+            latent = self.models_processor.get_swapper_latent(swapper_model, s_e)
             if parameters['FaceLikenessEnableToggle']:
                 factor = parameters['FaceLikenessFactorDecimalSlider']
-                dst_latent = torch.from_numpy(self.models_processor.calc_swapper_latent_ghost(t_e)).float().to(self.models_processor.device)
+                dst_latent = self.models_processor.get_swapper_latent(swapper_model, t_e)
                 latent = latent - (factor * dst_latent)
 
             dim = 2
-            input_face_affined = original_face_256
+            input_face_affined = original_faces[256]
 
         elif swapper_model == 'CSCS':
-            latent = torch.from_numpy(self.models_processor.calc_swapper_latent_cscs(s_e)).float().to(self.models_processor.device)
+            latent = self.models_processor.get_swapper_latent(swapper_model, s_e)
             if parameters['FaceLikenessEnableToggle']:
                 factor = parameters['FaceLikenessFactorDecimalSlider']
-                dst_latent = torch.from_numpy(self.models_processor.calc_swapper_latent_cscs(t_e)).float().to(self.models_processor.device)
+                dst_latent = self.models_processor.get_swapper_latent(swapper_model, t_e)
                 latent = latent - (factor * dst_latent)
 
             dim = 2
-            input_face_affined = original_face_256
+            input_face_affined = original_faces[256]
 
         elif swapper_model == 'DeepFaceLive (DFM)' and dfm_model:
             dfm_model = self.models_processor.load_dfm_model(dfm_model)
             latent = []
-            input_face_affined = original_face_512
+            input_face_affined = original_faces[512]
             dim = 4
         return input_face_affined, dfm_model, dim, latent
     
-    def get_swapped_and_prev_face(self, output, input_face_affined, original_face_512, latent, itex, dim, swapper_model, dfm_model, parameters, ):
+    def get_inswapper_swapped_and_prev_faces(self, inputs_face_affined, latents, itex, dim):
+        # Swaps several faces of the same resolution at once, returns their [128*dim,128*dim,3] outputs (0-255) and previous faces (0-1)
+        # Each face is split in dim*dim sub-images, the sub-image (j, i) of the face f holds the pixels [j::dim, i::dim] and is the batch item (f*dim+j)*dim+i
+        num_faces = len(inputs_face_affined)
+        input_faces_affined = torch.stack(inputs_face_affined)
+        prev_faces = input_faces_affined
+        outputs = torch.zeros((num_faces, 128*dim, 128*dim, 3), dtype=torch.float32, device=self.models_processor.device)
+        latents = torch.cat([latent.reshape(1, 512) for latent in latents]).repeat_interleave(dim*dim, dim=0).contiguous()
+        # Output buffer of the sub-images, reused by every iteration and frame
+        swapper_output = self.tensor_arena.get('swapper_output', (num_faces*dim*dim,3,128,128), torch.float32, self.models_processor.device)
+        with torch.no_grad():  # Disabilita il calcolo del gradiente se è solo per inferenza
+            for _ in range(itex):
+                input_faces_disc = input_faces_affined.reshape(num_faces, 128, dim, 128, dim, 3).permute(0, 2, 4, 5, 1, 3)
+                input_faces_disc = self.tensor_arena.copy('swapper_input', input_faces_disc.reshape(num_faces*dim*dim, 3, 128, 128))
+
+                self.models_processor.run_inswapper_batch(input_faces_disc, latents, swapper_output)
+
+                # Interleave the swapped sub-images back into the full resolution faces
+                outputs = swapper_output.reshape(num_faces, dim, dim, 3, 128, 128).permute(0, 4, 1, 5, 2, 3).reshape(num_faces, 128*dim, 128*dim, 3)
+                prev_faces = input_faces_affined
+                # outputs can be a view of swapper_output, which is overwritten by the next iteration
+                input_faces_affined = outputs.clone()
+                outputs = torch.mul(outputs, 255)
+                outputs = torch.clamp(outputs, 0, 255)
+        return list(outputs), list(prev_faces)
+
+    def get_swapped_and_prev_face(self, output, input_face_affined, original_face_512, latent, itex, dim, swapper_model, dfm_model, parameters, kps_5=None):
         # original_face_512, original_face_384, original_face_256, original_face_128 = original_faces
-        prev_face = input_face_affined.clone()
+        # The swapper input and output buffers come from the arena, only the results that outlive an iteration are copied
+        prev_face = input_face_affined
         if swapper_model == 'Inswapper128':
-            with torch.no_grad():  # Disabilita il calcolo del gradiente se è solo per inferenza
-                for _ in range(itex):
-                    for j in range(dim):
-                        for i in range(dim):
-                            input_face_disc = input_face_affined[j::dim,i::dim]
-                            input_face_disc = input_face_disc.permute(2, 0, 1)
-                            input_face_disc = torch.unsqueeze(input_face_disc, 0).contiguous()
-
-                            swapper_output = torch.empty((1,3,128,128), dtype=torch.float32, device=self.models_processor.device).contiguous()
-                            self.models_processor.run_inswapper(input_face_disc, latent, swapper_output)
-
-                            swapper_output = torch.squeeze(swapper_output)
-                            swapper_output = swapper_output.permute(1, 2, 0)
-
-                            output[j::dim, i::dim] = swapper_output.clone()
-                    prev_face = input_face_affined.clone()
-                    input_face_affined = output.clone()
-                    output = torch.mul(output, 255)
-                    output = torch.clamp(output, 0, 255)
+            outputs, prev_faces = self.get_inswapper_swapped_and_prev_faces([input_face_affined], [latent], itex, dim)
+            output, prev_face = outputs[0], prev_faces[0]
 
         elif swapper_model in ('InStyleSwapper256 Version A', 'InStyleSwapper256 Version B', 'InStyleSwapper256 Version C'):
             version = swapper_model[-1] #Version Name
             with torch.no_grad():  # Disabilita il calcolo del gradiente se è solo per inferenza
                 for _ in range(itex):
                     input_face_disc = input_face_affined.permute(2, 0, 1)
-                    input_face_disc = torch.unsqueeze(input_face_disc, 0).contiguous()
+                    input_face_disc = self.tensor_arena.copy('swapper_input', torch.unsqueeze(input_face_disc, 0))
 
-                    swapper_output = torch.empty((1,3,256,256), dtype=torch.float32, device=self.models_processor.device).contiguous()
+                    swapper_output = self.tensor_arena.get('swapper_output', (1,3,256,256), torch.float32, self.models_processor.device)
                     self.models_processor.run_iss_swapper(input_face_disc, latent, swapper_output, version)
 
                     swapper_output = torch.squeeze(swapper_output)
                     swapper_output = swapper_output.permute(1, 2, 0)
 
-                    output = swapper_output.clone()
-                    prev_face = input_face_affined.clone()
-                    input_face_affined = output.clone()
-                    output = torch.mul(output, 255)
+                    prev_face = input_face_affined
+                    input_face_affined = swapper_output.clone()
+                    output = torch.mul(swapper_output, 255)
                     output = torch.clamp(output, 0, 255)
 
         elif swapper_model == 'SimSwap512':
             for k in range(itex):
                 input_face_disc = input_face_affined.permute(2, 0, 1)
-                input_face_disc = torch.unsqueeze(input_face_disc, 0).contiguous()
-                swapper_output = torch.empty((1,3,512,512), dtype=torch.float32, device=self.models_processor.device).contiguous()
+                input_face_disc = self.tensor_arena.copy('swapper_input', torch.unsqueeze(input_face_disc, 0))
+                swapper_output = self.tensor_arena.get('swapper_output', (1,3,512,512), torch.float32, self.models_processor.device)
                 self.models_processor.run_swapper_simswap512(input_face_disc, latent, swapper_output)
                 swapper_output = torch.squeeze(swapper_output)
                 swapper_output = swapper_output.permute(1, 2, 0)
-                prev_face = input_face_affined.clone()
+                prev_face = input_face_affined
                 input_face_affined = swapper_output.clone()
 
-                output = swapper_output.clone()
-                output = torch.mul(output, 255)
+                output = torch.mul(swapper_output, 255)
                 output = torch.clamp(output, 0, 255)
 
         elif swapper_model == 'GhostFace-v1' or swapper_model == 'GhostFace-v2' or swapper_model == 'GhostFace-v3':
@@ -508,82 +544,94 @@ class FrameWorker(threading.Thread):
                 input_face_disc = torch.div(input_face_disc.float(), 127.5)
                 input_face_disc = torch.sub(input_face_disc, 1)
                 #input_face_disc = input_face_disc[[2, 1, 0], :, :] # Inverte i canali da BGR a RGB (assumendo che l'input sia BGR)
-                input_face_disc = torch.unsqueeze(input_face_disc, 0).contiguous()
-                swapper_output = torch.empty((1,3,256,256), dtype=torch.float32, device=self.models_processor.device).contiguous()
+                input_face_disc = self.tensor_arena.copy('swapper_input', torch.unsqueeze(input_face_disc, 0))
+                swapper_output = self.tensor_arena.get('swapper_output', (1,3,256,256), torch.float32, self.models_processor.device)
                 self.models_processor.run_swapper_ghostface(input_face_disc, latent, swapper_output, swapper_model)
                 swapper_output = swapper_output[0]
                 swapper_output = swapper_output.permute(1, 2, 0)
                 swapper_output = torch.mul(swapper_output, 127.5)
                 swapper_output = torch.add(swapper_output, 127.5)
                 #swapper_output = swapper_output[:, :, [2, 1, 0]] # Inverte i canali da RGB a BGR (assumendo che l'input sia RGB)
-                prev_face = input_face_affined.clone()
-                input_face_affined = swapper_output.clone()
-                input_face_affined = torch.div(input_face_affined, 255)
+                prev_face = input_face_affined
+                input_face_affined = torch.div(swapper_output, 255)
 
-                output = swapper_output.clone()
-                output = torch.clamp(output, 0, 255)
+                output = torch.clamp(swapper_output, 0, 255)
 
         elif swapper_model == 'CSCS':
             for k in range(itex):
                 input_face_disc = input_face_affined.permute(2, 0, 1)
                 input_face_disc = v2.functional.normalize(input_face_disc, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=False)
-                input_face_disc = torch.unsqueeze(input_face_disc, 0).contiguous()
-                swapper_output = torch.empty((1,3,256,256), dtype=torch.float32, device=self.models_processor.device).contiguous()
+                input_face_disc = self.tensor_arena.copy('swapper_input', torch.unsqueeze(input_face_disc, 0))
+                swapper_output = self.tensor_arena.get('swapper_output', (1,3,256,256), torch.float32, self.models_processor.device)
                 self.models_processor.run_swapper_cscs(input_face_disc, latent, swapper_output)
                 swapper_output = torch.squeeze(swapper_output)
                 swapper_output = torch.add(torch.mul(swapper_output, 0.5), 0.5)
                 swapper_output = swapper_output.permute(1, 2, 0)
-                prev_face = input_face_affined.clone()
-                input_face_affined = swapper_output.clone()
+                prev_face = input_face_affined
+                input_face_affined = swapper_output
 
-                output = swapper_output.clone()
-                output = torch.mul(output, 255)
+                output = torch.mul(swapper_output, 255)
                 output = torch.clamp(output, 0, 255)
         
         elif swapper_model == 'DeepFaceLive (DFM)' and dfm_model:
-            out_celeb, _, _ = dfm_model.convert(original_face_512, parameters['DFMAmpMorphSlider']/100, rct=parameters['DFMRCTColorToggle'])
-            prev_face = input_face_affined.clone()
-            input_face_affined = out_celeb.clone()
+            get_rct_statistics = partial(self.get_color_transfer_statistics, ('DFM_RCT',), kps_5) if kps_5 is not None else None
+            out_celeb, _, _ = dfm_model.convert(original_face_512, parameters['DFMAmpMorphSlider']/100, rct=parameters['DFMRCTColorToggle'], get_rct_statistics=get_rct_statistics)
+            prev_face = input_face_affined
             output = out_celeb.clone()
 
         output = output.permute(2, 0, 1)
         swap = t512(output)   
         return swap, prev_face
     
+    def get_color_transfer_statistics(self, key, kps_5, compute):
+        # compute() returns the color transfer statistics of the face on this frame
+        # The lighting of a face tracked in a video changes slowly, so its statistics are reused and smoothed across frames
+        control = self.main_window.control
+        if control['ColorTransferCacheEnableToggle'] and self.video_processor.file_type == 'video':
+            return self.video_processor.color_transfer_cache.get_statistics(self.frame_number, self.shot_id, key, kps_5, compute, refresh_interval=control['ColorTransferCacheRefreshSlider'], smoothing=control['ColorTransferCacheSmoothingSlider']/100)
+        return compute()
+
     def get_border_mask(self, parameters):
-        # Create border mask
-        border_mask = torch.ones((128, 128), dtype=torch.float32, device=self.models_processor.device)
-        border_mask = torch.unsqueeze(border_mask,0)
-
-        # if parameters['BorderState']:
-        top = parameters['BorderTopSlider']
-        left = parameters['BorderLeftSlider']
-        right = 128 - parameters['BorderRightSlider']
-        bottom = 128 - parameters['BorderBottomSlider']
-
-        border_mask[:, :top, :] = 0
-        border_mask[:, bottom:, :] = 0
-        border_mask[:, :, :left] = 0
-        border_mask[:, :, right:] = 0
-
-        gauss = transforms.GaussianBlur(parameters['BorderBlurSlider']*2+1, (parameters['BorderBlurSlider']+1)*0.2)
-        border_mask = gauss(border_mask)
-        return border_mask
+        # Border mask, cached per slider values
+        return faceutil.get_border_mask(parameters['BorderTopSlider'], parameters['BorderLeftSlider'], parameters['BorderBottomSlider'], parameters['BorderRightSlider'], parameters['BorderBlurSlider'], str(self.models_processor.device))
             
     def swap_core(self, img, kps_5, kps=False, s_e=None, t_e=None, parameters=None, control=None, dfm_model=False): # img = RGB
-        s_e = s_e if isinstance(s_e, np.ndarray) else []
-        t_e = t_e if isinstance(t_e, np.ndarray) else []
         parameters = parameters or {}
         control = control or {}
+        face = self.prepare_swap_face(img, kps_5, s_e, t_e, parameters, dfm_model)
+        self.swap_prepared_faces([face])
+        return self.blend_swapped_face(img, face, control)
+
+    def swap_core_batch(self, img, faces_swap_args, control): # img = RGB
+        # faces_swap_args holds the swap_core arguments of each face, returns img and the (original face, swap mask) of each face
+        # The swapper and mask inputs of all the faces are grabbed before any of them is merged back, so that these models run once per batch
+        faces = [self.prepare_swap_face(img, **swap_args) for swap_args in faces_swap_args]
+        self.swap_prepared_faces(faces)
+        self.apply_mask_models_batch(faces)
+
+        # The crops of the faces are warped lazily from img, blend into a copy so that every crop comes from the frame
+        # before the swap, whether it was used by the swapper or only by the blend after an earlier face was pasted
+        if len(faces) > 1:
+            img = img.clone()
+
+        results = []
+        for face in faces:
+            img, original_face_512_clone, swap_mask_clone = self.blend_swapped_face(img, face, control)
+            results.append((original_face_512_clone, swap_mask_clone))
+        return img, results
+
+    def prepare_swap_face(self, img, kps_5, s_e=None, t_e=None, parameters=None, dfm_model=False):
+        # Crops the face and prepares the input and the latent of the swapper, returns the state of the face for the next steps of the swap
+        s_e = s_e if isinstance(s_e, np.ndarray) else []
+        t_e = t_e if isinstance(t_e, np.ndarray) else []
         # parameters = self.parameters.copy()
         swapper_model = parameters['SwapModelSelection']
 
         tform = self.get_face_similarity_tform(swapper_model, kps_5)
 
-        # Grab 512 face from image and create 256 and 128 copys
-        original_face_512, original_face_384, original_face_256, original_face_128 = self.get_transformed_and_scaled_faces(tform, img)
-        original_faces = (original_face_512, original_face_384, original_face_256, original_face_128)
-        dim=1
+        # Faces of the resolutions used by the swapper, masks and restorers, grabbed from the image on first use
+        original_faces = self.get_transformed_and_scaled_faces(tform, img)
+        face = {'kps_5': kps_5, 'parameters': parameters, 'swapper_model': swapper_model, 'tform': tform, 'original_faces': original_faces, 'dfm_model': dfm_model, 'input_face_affined': None, 'latent': None, 'dim': 1, 'itex': 1}
         if (s_e is not None and len(s_e) > 0) or (swapper_model == 'DeepFaceLive (DFM)' and dfm_model):
 
             input_face_affined, dfm_model, dim, latent = self.get_affined_face_dim_and_swapping_latents(original_faces, swapper_model, dfm_model, s_e, t_e, parameters)
@@ -596,24 +644,62 @@ class FrameWorker(threading.Thread):
             if parameters['StrengthEnableToggle']:
                 itex = ceil(parameters['StrengthAmountSlider'] / 100.)
 
-            # Create empty output image and preprocess it for swapping
-            output_size = int(128 * dim)
-            output = torch.zeros((output_size, output_size, 3), dtype=torch.float32, device=self.models_processor.device)
+            # Preprocess the input for swapping
             input_face_affined = input_face_affined.permute(1, 2, 0)
             input_face_affined = torch.div(input_face_affined, 255.0)
-
-            swap, prev_face = self.get_swapped_and_prev_face(output, input_face_affined, original_face_512, latent, itex, dim, swapper_model, dfm_model, parameters)
-        
-        else:
-            swap = original_face_512
-            if parameters['StrengthEnableToggle']:
-                itex = ceil(parameters['StrengthAmountSlider'] / 100.)
-                prev_face = torch.div(swap, 255.)
-                prev_face = prev_face.permute(1, 2, 0)
+            face.update({'input_face_affined': input_face_affined, 'dfm_model': dfm_model, 'dim': dim, 'latent': latent, 'itex': itex})
+
+        elif parameters['StrengthEnableToggle']:
+            face['itex'] = ceil(parameters['StrengthAmountSlider'] / 100.)
+        return face
+
+    def swap_prepared_faces(self, faces):
+        # Sets the swapped face and the previous face of each face
+        # Inswapper128 faces with the same resolution and strength are swapped in one batch, the other swappers run per face
+        inswapper_batches = {}
+        for face in faces:
+            if face['input_face_affined'] is None:
+                face['swap'] = face['original_faces'][512]
+                if face['parameters']['StrengthEnableToggle']:
+                    prev_face = torch.div(face['swap'], 255.)
+                    face['prev_face'] = prev_face.permute(1, 2, 0)
+            elif face['swapper_model'] == 'Inswapper128':
+                inswapper_batches.setdefault((face['dim'], face['itex']), []).append(face)
+            else:
+                # Create empty output image for swapping
+                output_size = int(128 * face['dim'])
+                output = self.tensor_arena.get('swap_output', (output_size, output_size, 3), torch.float32, self.models_processor.device, fill=0.0)
+                face['swap'], face['prev_face'] = self.get_swapped_and_prev_face(output, face['input_face_affined'], face['original_faces'][512], face['latent'], face['itex'], face['dim'], face['swapper_model'], face['dfm_model'], face['parameters'], face['kps_5'])
+
+        for (dim, itex), batch_faces in inswapper_batches.items():
+            outputs, prev_faces = self.get_inswapper_swapped_and_prev_faces([face['input_face_affined'] for face in batch_faces], [face['latent'] for face in batch_faces], itex, dim)
+            for face, output, prev_face in zip(batch_faces, outputs, prev_faces):
+                face['swap'] = t512(output.permute(2, 0, 1))
+                face['prev_face'] = prev_face
+
+    def apply_mask_models_batch(self, faces):
+        # The occluder and XSeg masks only depend on the original faces, they are computed for all the faces at once
+        occluder_faces = [face for face in faces if face['parameters']['OccluderEnableToggle']]
+        if occluder_faces:
+            masks = self.models_processor.apply_occlusion_batch(torch.stack([face['original_faces'][256] for face in occluder_faces]), [face['parameters']['OccluderSizeSlider'] for face in occluder_faces])
+            for face, mask in zip(occluder_faces, masks):
+                face['occlusion_mask'] = mask
+
+        xseg_faces = [face for face in faces if face['parameters']['DFLXSegEnableToggle']]
+        if xseg_faces:
+            masks = self.models_processor.apply_dfl_xseg_batch(torch.stack([face['original_faces'][256] for face in xseg_faces]), [-face['parameters']['DFLXSegSizeSlider'] for face in xseg_faces])
+            for face, mask in zip(xseg_faces, masks):
+                face['xseg_mask'] = mask
+
+    def blend_swapped_face(self, img, face, control):
+        # Restores, masks and color corrects the swapped face, then merges it back into img
+        kps_5, parameters, tform = face['kps_5'], face['parameters'], face['tform']
+        original_faces = face['original_faces']
+        swap, prev_face, itex = face['swap'], face.get('prev_face'), face['itex']
 
         if parameters['StrengthEnableToggle']:
             if itex == 0:
-                swap = original_face_512.clone()
+                swap = original_faces[512].clone()
             else:
                 alpha = np.mod(parameters['StrengthAmountSlider'], 100)*0.01
                 if alpha==0:
@@ -631,12 +717,11 @@ class FrameWorker(threading.Thread):
         border_mask = self.get_border_mask(parameters)
 
         # Create image mask
-        swap_mask = torch.ones((128, 128), dtype=torch.float32, device=self.models_processor.device)
-        swap_mask = torch.unsqueeze(swap_mask,0)
+        swap_mask = self.tensor_arena.get('swap_mask', (1, 128, 128), torch.float32, self.models_processor.device, fill=1.0)
         
         # Expression Restorer
         if parameters['FaceExpressionEnableToggle']:
-            swap = self.apply_face_expression_restorer(original_face_512, swap, parameters)
+            swap = self.apply_face_expression_restorer(original_faces[512], swap, parameters)
 
         # Restorer
         if parameters["FaceRestorerEnableToggle"]:
@@ -648,18 +733,20 @@ class FrameWorker(threading.Thread):
 
         # Occluder
         if parameters["OccluderEnableToggle"]:
-            mask = self.models_processor.apply_occlusion(original_face_256, parameters["OccluderSizeSlider"])
+            mask = face.get('occlusion_mask')
+            if mask is None:
+                mask = self.models_processor.apply_occlusion(original_faces[256], parameters["OccluderSizeSlider"])
             mask = t128(mask)
             swap_mask = torch.mul(swap_mask, mask)
-            gauss = transforms.GaussianBlur(parameters['OccluderXSegBlurSlider']*2+1, (parameters['OccluderXSegBlurSlider']+1)*0.2)
-            swap_mask = gauss(swap_mask)
+            swap_mask = faceutil.gaussian_blur(swap_mask, parameters['OccluderXSegBlurSlider']*2+1, (parameters['OccluderXSegBlurSlider']+1)*0.2)
 
         if parameters["DFLXSegEnableToggle"]:
-            img_mask = self.models_processor.apply_dfl_xseg(original_face_256, -parameters["DFLXSegSizeSlider"])
+            img_mask = face.get('xseg_mask')
+            if img_mask is None:
+                img_mask = self.models_processor.apply_dfl_xseg(original_faces[256], -parameters["DFLXSegSizeSlider"])
             img_mask = t128(img_mask)
             swap_mask = torch.mul(swap_mask, 1 - img_mask)
-            gauss = transforms.GaussianBlur(parameters['OccluderXSegBlurSlider']*2+1, (parameters['OccluderXSegBlurSlider']+1)*0.2)
-            swap_mask = gauss(swap_mask)
+            swap_mask = faceutil.gaussian_blur(swap_mask, parameters['OccluderXSegBlurSlider']*2+1, (parameters['OccluderXSegBlurSlider']+1)*0.2)
 
         if parameters["FaceParserEnableToggle"]:
             #cv2.imwrite('swap.png', cv2.cvtColor(swap.permute(1, 2, 0).cpu().numpy(), cv2.COLOR_RGB2BGR))
@@ -669,7 +756,7 @@ class FrameWorker(threading.Thread):
 
         # CLIPs
         if parameters["ClipEnableToggle"]:
-            mask = self.models_processor.run_CLIPs(original_face_512, parameters["ClipText"], parameters["ClipAmountSlider"])
+            mask = self.models_processor.run_CLIPs(original_faces[512], parameters["ClipText"], parameters["ClipAmountSlider"])
             mask = t128(mask)
             swap_mask *= mask
 
@@ -679,8 +766,8 @@ class FrameWorker(threading.Thread):
             homogeneous_kps = np.hstack([kps_5, ones_column])
             dst_kps_5 = np.dot(homogeneous_kps, M.T)
 
-            img_swap_mask = torch.ones((1, 512, 512), dtype=torch.float32, device=self.models_processor.device).contiguous()
-            img_orig_mask = torch.zeros((1, 512, 512), dtype=torch.float32, device=self.models_processor.device).contiguous()
+            img_swap_mask = self.tensor_arena.get('img_swap_mask', (1, 512, 512), torch.float32, self.models_processor.device, fill=1.0)
+            img_orig_mask = self.tensor_arena.get('img_orig_mask', (1, 512, 512), torch.float32, self.models_processor.device, fill=0.0)
 
             if parameters['RestoreMouthEnableToggle']:
                 img_swap_mask = self.models_processor.restore_mouth(img_orig_mask, img_swap_mask, dst_kps_5, parameters['RestoreMouthBlendAmountSlider']/100, parameters['RestoreMouthFeatherBlendSlider'], parameters['RestoreMouthSizeFactorSlider']/100, parameters['RestoreXMouthRadiusFactorDecimalSlider'], parameters['RestoreYMouthRadiusFactorDecimalSlider'], parameters['RestoreXMouthOffsetSlider'], parameters['RestoreYMouthOffsetSlider'])
@@ -690,50 +777,28 @@ class FrameWorker(threading.Thread):
                 img_swap_mask = self.models_processor.restore_eyes(img_orig_mask, img_swap_mask, dst_kps_5, parameters['RestoreEyesBlendAmountSlider']/100, parameters['RestoreEyesFeatherBlendSlider'], parameters['RestoreEyesSizeFactorDecimalSlider'],  parameters['RestoreXEyesRadiusFactorDecimalSlider'], parameters['RestoreYEyesRadiusFactorDecimalSlider'], parameters['RestoreXEyesOffsetSlider'], parameters['RestoreYEyesOffsetSlider'], parameters['RestoreEyesSpacingOffsetSlider'])
                 img_swap_mask = torch.clamp(img_swap_mask, 0, 1)
 
-            gauss = transforms.GaussianBlur(parameters['RestoreEyesMouthBlurSlider']*2+1, (parameters['RestoreEyesMouthBlurSlider']+1)*0.2)
-            img_swap_mask = gauss(img_swap_mask)
+            img_swap_mask = faceutil.gaussian_blur(img_swap_mask, parameters['RestoreEyesMouthBlurSlider']*2+1, (parameters['RestoreEyesMouthBlurSlider']+1)*0.2)
 
             img_swap_mask = t128(img_swap_mask)
             swap_mask = torch.mul(swap_mask, img_swap_mask)
 
         # Face Diffing
         if parameters["DifferencingEnableToggle"]:
-            mask = self.models_processor.apply_fake_diff(swap, original_face_512, parameters["DifferencingAmountSlider"])
-            gauss = transforms.GaussianBlur(parameters['DifferencingBlendAmountSlider']*2+1, (parameters['DifferencingBlendAmountSlider']+1)*0.2)
-            mask = gauss(mask.type(torch.float32))
-            swap = swap * mask + original_face_512*(1-mask)
+            mask = self.models_processor.apply_fake_diff(swap, original_faces[512], parameters["DifferencingAmountSlider"])
+            mask = faceutil.gaussian_blur(mask.type(torch.float32), parameters['DifferencingBlendAmountSlider']*2+1, (parameters['DifferencingBlendAmountSlider']+1)*0.2)
+            swap = swap * mask + original_faces[512]*(1-mask)
 
         if parameters["AutoColorEnableToggle"]:
             # Histogram color matching original face on swapped face
-            if parameters['AutoColorTransferTypeSelection'] == 'Test':
-                swap = faceutil.histogram_matching(original_face_512, swap, parameters["AutoColorBlendAmountSlider"])
-
-            elif parameters['AutoColorTransferTypeSelection'] == 'Test_Mask':
-                swap = faceutil.histogram_matching_withmask(original_face_512, swap, t512(swap_mask), parameters["AutoColorBlendAmountSlider"])
-
-            elif parameters['AutoColorTransferTypeSelection'] == 'DFL_Test':
-                swap = faceutil.histogram_matching_DFL_test(original_face_512, swap, parameters["AutoColorBlendAmountSlider"])
-
-            elif parameters['AutoColorTransferTypeSelection'] == 'DFL_Orig':
-                swap = faceutil.histogram_matching_DFL_Orig(original_face_512, swap, t512(swap_mask), parameters["AutoColorBlendAmountSlider"])
+            transfer_type = parameters['AutoColorTransferTypeSelection']
+            mask = t512(swap_mask) if transfer_type in ('Test_Mask', 'DFL_Orig') else None
+            get_statistics = partial(self.get_color_transfer_statistics, ('AutoColor', transfer_type), kps_5)
+            swap = faceutil.color_transfer(transfer_type, original_faces[512], swap, parameters["AutoColorBlendAmountSlider"], mask, get_statistics=get_statistics)
 
         # Apply color corrections
         if parameters['ColorEnableToggle']:
-            swap = torch.unsqueeze(swap,0).contiguous()
-            swap = v2.functional.adjust_gamma(swap, parameters['ColorGammaDecimalSlider'], 1.0)
-            swap = torch.squeeze(swap)
-            swap = swap.permute(1, 2, 0).type(torch.float32)
-
-            del_color = torch.tensor([parameters['ColorRedSlider'], parameters['ColorGreenSlider'], parameters['ColorBlueSlider']], device=self.models_processor.device)
-            swap += del_color
-            swap = torch.clamp(swap, min=0., max=255.)
-            swap = swap.permute(2, 0, 1).type(torch.uint8)
-
-            swap = v2.functional.adjust_brightness(swap, parameters['ColorBrightnessDecimalSlider'])
-            swap = v2.functional.adjust_contrast(swap, parameters['ColorContrastDecimalSlider'])
-            swap = v2.functional.adjust_saturation(swap, parameters['ColorSaturationDecimalSlider'])
-            swap = v2.functional.adjust_sharpness(swap, parameters['ColorSharpnessDecimalSlider'])
-            swap = v2.functional.adjust_hue(swap, parameters['ColorHueDecimalSlider'])
+            # Gamma, RGB offsets and brightness are a single lookup table, then contrast, saturation, sharpness and hue
+            swap = faceutil.color_correct(swap, parameters['ColorGammaDecimalSlider'], parameters['ColorRedSlider'], parameters['ColorGreenSlider'], parameters['ColorBlueSlider'], parameters['ColorBrightnessDecimalSlider'], parameters['ColorContrastDecimalSlider'], parameters['ColorSaturationDecimalSlider'], parameters['ColorSharpnessDecimalSlider'], parameters['ColorHueDecimalSlider'])
 
             if parameters['ColorNoiseDecimalSlider'] > 0:
                 swap = swap.permute(1, 2, 0).type(torch.float32)
@@ -752,12 +817,10 @@ class FrameWorker(threading.Thread):
             kernel_size = 2 * final_blur_strength + 1  # Ungerade Zahl, z.B. 3, 5, 7, ...
             sigma = final_blur_strength * 0.1  # Sigma proportional zur Stärke
             # Gaussian Blur anwenden
-            gaussian_blur = transforms.GaussianBlur(kernel_size=kernel_size, sigma=sigma)
-            swap = gaussian_blur(swap)
+            swap = faceutil.gaussian_blur(swap, kernel_size, sigma)
 
         # Add blur to swap_mask results
-        gauss = transforms.GaussianBlur(parameters['OverallMaskBlendAmountSlider'] * 2 + 1, (parameters['OverallMaskBlendAmountSlider'] + 1) * 0.2)
-        swap_mask = gauss(swap_mask)
+        swap_mask = faceutil.gaussian_blur(swap_mask, parameters['OverallMaskBlendAmountSlider'] * 2 + 1, (parameters['OverallMaskBlendAmountSlider'] + 1) * 0.2)
 
         # Combine border and swap mask, scale, and apply to swap
         swap_mask = torch.mul(swap_mask, border_mask)
@@ -768,7 +831,7 @@ class FrameWorker(threading.Thread):
         # For face comparing
         original_face_512_clone = None
         if self.is_view_face_compare:
-            original_face_512_clone = original_face_512.clone()
+            original_face_512_clone = original_faces[512].clone()
             original_face_512_clone = original_face_512_clone.type(torch.uint8)
             original_face_512_clone = original_face_512_clone.permute(1, 2, 0)
         swap_mask_clone = None
@@ -800,16 +863,14 @@ class FrameWorker(threading.Thread):
         if bottom>img.shape[1]:
             bottom=img.shape[1]
 
-        # Untransform the swap
-        swap = v2.functional.pad(swap, (0,0,img.shape[2]-512, img.shape[1]-512))
-        swap = v2.functional.affine(swap, tform.inverse.rotation*57.2958, (tform.inverse.translation[0], tform.inverse.translation[1]), tform.inverse.scale, 0,interpolation=v2.InterpolationMode.BILINEAR, center = (0,0) )
-        swap = swap[0:3, top:bottom, left:right]
+        # Untransform the swap, only over the area to be merged
+        swap = faceutil.warp_affine_roi(swap, IM512, left, top, right-left, bottom-top, interpolation=v2.InterpolationMode.BILINEAR)
+        swap = swap[0:3]
         swap = swap.permute(1, 2, 0)
 
         # Untransform the swap mask
-        swap_mask = v2.functional.pad(swap_mask, (0,0,img.shape[2]-512, img.shape[1]-512))
-        swap_mask = v2.functional.affine(swap_mask, tform.inverse.rotation*57.2958, (tform.inverse.translation[0], tform.inverse.translation[1]), tform.inverse.scale, 0, interpolation=v2.InterpolationMode.BILINEAR, center = (0,0) )
-        swap_mask = swap_mask[0:1, top:bottom, left:right]
+        swap_mask = faceutil.warp_affine_roi(swap_mask, IM512, left, top, right-left, bottom-top, interpolation=v2.InterpolationMode.BILINEAR)
+        swap_mask = swap_mask[0:1]
         swap_mask = swap_mask.permute(1, 2, 0)
         swap_mask = torch.sub(1, swap_mask)
 
@@ -1288,8 +1349,7 @@ class FrameWorker(threading.Thread):
 
             flag_do_crop_input_retargeting_image = kwargs.get('flag_do_crop_input_retargeting_image', True)
             if flag_do_crop_input_retargeting_image:
-                gauss = transforms.GaussianBlur(parameters['FaceEditorBlurAmountSlider']*2+1, (parameters['FaceEditorBlurAmountSlider']+1)*0.2)
-                mask_crop = gauss(self.models_processor.lp_mask_crop)
+                mask_crop = faceutil.gaussian_blur(self.models_processor.lp_mask_crop, parameters['FaceEditorBlurAmountSlider']*2+1, (parameters['FaceEditorBlurAmountSlider']+1)*0.2)
                 img = faceutil.paste_back_adv(out, M_c2o, img, mask_crop)
             else:
                 img = out                
@@ -1304,9 +1364,8 @@ class FrameWorker(threading.Thread):
 
             out, mask_out = self.models_processor.apply_face_makeup(original_face_512, parameters)
             if 1:
-                gauss = transforms.GaussianBlur(5*2+1, (5+1)*0.2)
                 out = torch.clamp(torch.div(out, 255.0), 0, 1).type(torch.float32)
-                mask_crop = gauss(self.models_processor.lp_mask_crop)
+                mask_crop = faceutil.gaussian_blur(self.models_processor.lp_mask_crop, 5*2+1, (5+1)*0.2)
                 img = faceutil.paste_back_adv(out, M_c2o, img, mask_crop)
 
         return img
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, List, Set
 from pathlib import Path
 from functools import partial
 import copy
@@ -19,6 +19,7 @@ from app.ui.widgets.actions import graphics_view_actions
 
 from app.processors.video_processor import VideoProcessor
 from app.processors.models_processor import ModelsProcessor
+from app.processors.utils.embedding_index import EmbeddingLibrary
 from app.ui.widgets import widget_components
 from app.ui.widgets.event_filters import GraphicsViewEventFilter, VideoSeekSliderEventFilter, videoSeekSliderLineEditEventFilter, ListWidgetEventFilter
 from app.ui.widgets import ui_workers
@@ -44,6 +45,9 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         try:
             self.video_loader_worker: ui_workers.TargetMediaLoaderWorker|bool = False
             self.input_faces_loader_worker: ui_workers.InputFacesLoaderWorker|bool = False
+            # Workers computing the missing embeddings of input faces, and the ids of the faces they compute
+            self.input_face_embeddings_workers: List[ui_workers.InputFaceEmbeddingsWorker] = []
+            self.pending_input_face_embeddings: Set[str] = set()
             self.target_videos_filter_worker = ui_workers.FilterWorker(main_window=self, search_text='', filter_list='target_videos')
             self.input_faces_filter_worker = ui_workers.FilterWorker(main_window=self, search_text='', filter_list='input_faces')
             self.merged_embeddings_filter_worker = ui_workers.FilterWorker(main_window=self, search_text='', filter_list='merged_embeddings')
@@ -55,6 +59,9 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             self.target_faces: Dict[int, widget_components.TargetFaceCardButton] = {}
             self.input_faces: Dict[int, widget_components.InputFaceCardButton] = {}
             self.merged_embeddings: Dict[int, widget_components.EmbeddingCardButton] = {}
+            # Similarity search indexes over the embeddings of the input faces and of the merged embeddings
+            self.input_faces_library = EmbeddingLibrary()
+            self.merged_embeddings_library = EmbeddingLibrary()
             logger.debug("已初始化媒体字典")
             
             self.cur_selected_target_face_button: widget_components.TargetFaceCardButton = False
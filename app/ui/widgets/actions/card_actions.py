@@ -1,6 +1,7 @@
 
 from typing import TYPE_CHECKING, Dict
 import uuid
+from functools import partial
 
 import numpy
 import cv2
@@ -8,7 +9,9 @@ import torch
 from torchvision.transforms import v2
 
 import app.ui.widgets.actions.common_actions as common_widget_actions
+from app.ui.widgets import ui_workers
 from app.ui.widgets.actions import list_view_actions
+from app.ui.widgets.actions import filter_actions
 import app.helpers.miscellaneous as misc_helpers
 from app.ui.widgets.settings_layout_data import SETTINGS_LAYOUT_DATA
 
@@ -62,6 +65,91 @@ def uncheck_all_merged_embeddings(main_window: 'MainWindow'):
     for _, embed_button in  main_window.merged_embeddings.items():
         embed_button.setChecked(False)
 
+def detect_input_face(main_window: 'MainWindow', img, control):
+    # Returns the 5 keypoints of the main face of an input face image, or None if no face is found
+    # Input faces are unrelated stills, the recent face sizes tracked by 'Auto' belong to the target media
+    input_size = (512, 512) if control['DetectorInputSizeSelection'] == 'Auto' else control['DetectorInputSizeSelection']
+    _, kpss_5, _ = main_window.models_processor.run_detect(img, control['DetectorModelSelection'], max_num=1, score=control['DetectorScoreSlider']/100.0, input_size=input_size, use_landmark_detection=control['LandmarkDetectToggle'], landmark_detect_mode=control['LandmarkDetectModelSelection'], landmark_score=control["LandmarkDetectScoreSlider"]/100.0, from_points=control["DetectFromPointsToggle"], rotation_angles=[0] if not control["AutoRotationToggle"] else [0, 90, 180, 270])
+    if len(kpss_5) == 0 or not kpss_5[0].any():
+        return None
+    return kpss_5[0]
+
+def compute_missing_input_face_embeddings(main_window: 'MainWindow', input_faces: list, on_finished=None):
+    # Input faces loaded with lazy embeddings only have the embedding of the recognition model selected when they were loaded,
+    # the embeddings of the other models are computed on a worker thread the first time the face is used
+    # Returns True when a worker was started, on_finished is then called once its embeddings are merged
+    options = SETTINGS_LAYOUT_DATA['Face Recognition']['RecognitionModelSelection']['options']
+    jobs = []
+    for input_face in input_faces:
+        # Faces already handled by another worker are skipped
+        if input_face.face_kps is None or input_face.face_id in main_window.pending_input_face_embeddings:
+            continue
+        missing_models = [option for option in options if option not in input_face.embedding_store]
+        if missing_models:
+            jobs.append((input_face.face_id, input_face.media_path, input_face.face_kps, input_face.similarity_type, missing_models))
+    if not jobs:
+        return False
+
+    face_ids = [job[0] for job in jobs]
+    main_window.pending_input_face_embeddings.update(face_ids)
+    worker = ui_workers.InputFaceEmbeddingsWorker(main_window, jobs)
+    worker.embeddings_ready.connect(partial(set_input_face_embeddings, main_window))
+    worker.finished.connect(partial(finish_input_face_embeddings, main_window, worker, face_ids, on_finished))
+    # The worker is kept referenced until it is finished
+    main_window.input_face_embeddings_workers.append(worker)
+    worker.start()
+    return True
+
+def set_input_face_embeddings(main_window: 'MainWindow', face_id, embeddings: dict):
+    input_face = main_window.input_faces.get(face_id)
+    # The face may have been removed while its embeddings were computed
+    if input_face is None:
+        return
+    for recognition_model, embedding in embeddings.items():
+        input_face.set_embedding(recognition_model, embedding)
+
+def finish_input_face_embeddings(main_window: 'MainWindow', worker, face_ids: list, on_finished=None):
+    main_window.pending_input_face_embeddings.difference_update(face_ids)
+    main_window.input_face_embeddings_workers.remove(worker)
+    # The target faces assigned to these faces merge their new embeddings, without computing the ones that could not be computed again
+    for target_face in main_window.target_faces.values():
+        if any(face_id in target_face.assigned_input_faces for face_id in face_ids):
+            target_face.calculate_assigned_input_embedding(compute_missing_embeddings=False)
+    if on_finished:
+        on_finished()
+    common_widget_actions.refresh_frame(main_window)
+
+def rank_embedding_library(main_window: 'MainWindow', library, embedding_buttons: dict, target_face, top_k=None, min_similarity=None, duplicates_threshold=None):
+    # Returns the (button, similarity) pairs of the embedding buttons most similar to the target face, most similar first
+    # With duplicates_threshold, only the first of each group of near identical embeddings is returned
+    recognition_model = main_window.control['RecognitionModelSelection']
+    query = target_face.get_embedding(recognition_model)
+    if query.size == 0:
+        return []
+    index = library.get_index({button_id: button.embedding_store for button_id, button in embedding_buttons.items()}, recognition_model)
+    duplicates = index.find_duplicates(duplicates_threshold) if duplicates_threshold else {}
+    ranked = index.search(query, top_k=top_k + len(duplicates) if top_k else None, min_similarity=min_similarity)
+    ranked = [(embedding_buttons[button_id], similarity) for button_id, similarity in ranked if button_id not in duplicates]
+    return ranked[:top_k] if top_k else ranked
+
+def rank_input_faces(main_window: 'MainWindow', target_face, top_k=None, min_similarity=None, duplicates_threshold=None):
+    return rank_embedding_library(main_window, main_window.input_faces_library, main_window.input_faces, target_face, top_k, min_similarity, duplicates_threshold)
+
+def rank_merged_embeddings(main_window: 'MainWindow', target_face, top_k=None, min_similarity=None, duplicates_threshold=None):
+    return rank_embedding_library(main_window, main_window.merged_embeddings_library, main_window.merged_embeddings, target_face, top_k, min_similarity, duplicates_threshold)
+
+def show_most_similar_input_faces(main_window: 'MainWindow', target_face, top_k=20, duplicates_threshold=95.0):
+    # Only shows the input faces closest to the target face, the search box filter shows them all again
+    ranked = rank_input_faces(main_window, target_face, top_k=top_k, duplicates_threshold=duplicates_threshold)
+    filter_actions.update_filtered_list(main_window, main_window.inputFacesList, [input_face.get_item_position() for input_face, _ in ranked])
+
+def hide_duplicate_input_faces(main_window: 'MainWindow', duplicates_threshold=95.0):
+    recognition_model = main_window.control['RecognitionModelSelection']
+    index = main_window.input_faces_library.get_index({face_id: input_face.embedding_store for face_id, input_face in main_window.input_faces.items()}, recognition_model)
+    duplicates = index.find_duplicates(duplicates_threshold)
+    for face_id in duplicates:
+        main_window.input_faces[face_id].list_item.setHidden(True)
+
 def find_target_faces(main_window: 'MainWindow'):
     control = main_window.control.copy()
     video_processor = main_window.video_processor
@@ -88,7 +176,7 @@ def find_target_faces(main_window: 'MainWindow'):
             if control['ManualRotationEnableToggle']:
                 img = v2.functional.rotate(img, angle=control['ManualRotationAngleSlider'], interpolation=v2.InterpolationMode.BILINEAR, expand=True)
 
-            _, kpss_5, _ = main_window.models_processor.run_detect(img, control['DetectorModelSelection'], max_num=control['MaxFacesToDetectSlider'], score=control['DetectorScoreSlider']/100.0, input_size=(512, 512), use_landmark_detection=control['LandmarkDetectToggle'], landmark_detect_mode=control['LandmarkDetectModelSelection'], landmark_score=control["LandmarkDetectScoreSlider"]/100.0, from_points=control["DetectFromPointsToggle"], rotation_angles=[0] if not control["AutoRotationToggle"] else [0, 90, 180, 270])
+            _, kpss_5, _ = main_window.models_processor.run_detect(img, control['DetectorModelSelection'], max_num=control['MaxFacesToDetectSlider'], score=control['DetectorScoreSlider']/100.0, input_size=control['DetectorInputSizeSelection'], use_landmark_detection=control['LandmarkDetectToggle'], landmark_detect_mode=control['LandmarkDetectModelSelection'], landmark_score=control["LandmarkDetectScoreSlider"]/100.0, from_points=control["DetectFromPointsToggle"], rotation_angles=[0] if not control["AutoRotationToggle"] else [0, 90, 180, 270])
 
             ret = []
             for face_kps in kpss_5:
@@ -27,8 +27,8 @@ def add_media_thumbnail_to_target_faces_list(main_window: 'MainWindow', cropped_
     add_media_thumbnail_button(main_window, widget_components.TargetFaceCardButton, main_window.targetFacesList, main_window.target_faces, pixmap, cropped_face=cropped_face, embedding_store=embedding_store, face_id=face_id )
 
 @QtCore.Slot()
-def add_media_thumbnail_to_source_faces_list(main_window: 'MainWindow', media_path, cropped_face, embedding_store, pixmap, face_id):
-    add_media_thumbnail_button(main_window, widget_components.InputFaceCardButton, main_window.inputFacesList, main_window.input_faces, pixmap, media_path=media_path, cropped_face=cropped_face, embedding_store=embedding_store, face_id=face_id )
+def add_media_thumbnail_to_source_faces_list(main_window: 'MainWindow', media_path, cropped_face, embedding_store, pixmap, face_id, face_kps=None, similarity_type=None):
+    add_media_thumbnail_button(main_window, widget_components.InputFaceCardButton, main_window.inputFacesList, main_window.input_faces, pixmap, media_path=media_path, cropped_face=cropped_face, embedding_store=embedding_store, face_id=face_id, face_kps=face_kps, similarity_type=similarity_type)
 
 
 def add_media_thumbnail_button(main_window: 'MainWindow', buttonClass: 'widget_components.CardButton', listWidget:QtWidgets.QListWidget, buttons_list:list, pixmap, **kwargs):
@@ -38,6 +38,8 @@ def add_media_thumbnail_button(main_window: 'MainWindow', buttonClass: 'widget_c
             constructor_args+=(kwargs.get('is_webcam'), kwargs.get('webcam_index'), kwargs.get('webcam_backend'))
     elif buttonClass in (widget_components.TargetFaceCardButton, widget_components.InputFaceCardButton):
         constructor_args = (kwargs.get('media_path',''), kwargs.get('cropped_face'), kwargs.get('embedding_store'), kwargs.get('face_id'))
+        if buttonClass==widget_components.InputFaceCardButton:
+            constructor_args+=(kwargs.get('face_kps'), kwargs.get('similarity_type'))
     if buttonClass==widget_components.TargetMediaCardButton:
         button_size = QtCore.QSize(90, 90)  # Set a fixed size for the buttons
     else:
@@ -16,37 +16,32 @@ from app.ui.widgets.actions import layout_actions
 from app.ui.widgets import ui_workers
 from app.helpers.typing_helper import ParametersTypes, MarkerTypes
 import app.helpers.miscellaneous as misc_helpers
+from app.helpers.embeddings_file import EMBEDDINGS_FILE_EXTENSION, load_embeddings_file, save_embeddings_file
 
 if TYPE_CHECKING:
     from app.ui.main_ui import MainWindow
 
 def open_embeddings_from_file(main_window: 'MainWindow'):
     
-    embedding_filename, _ = QtWidgets.QFileDialog.getOpenFileName(main_window, filter='JSON (*.json)', dir=misc_helpers.get_dir_of_file(main_window.loaded_embedding_filename))
+    embedding_filename, _ = QtWidgets.QFileDialog.getOpenFileName(main_window, filter=f'Embeddings (*{EMBEDDINGS_FILE_EXTENSION} *.json)', dir=misc_helpers.get_dir_of_file(main_window.loaded_embedding_filename))
     if embedding_filename:
-        with open(embedding_filename, 'r') as embed_file: #pylint: disable=unspecified-encoding
-            embeddings_list = json.load(embed_file)
-            card_actions.clear_merged_embeddings(main_window)
-
-            # Reset per ogni target face
-            for _, target_face in main_window.target_faces.items():
-                target_face.assigned_merged_embeddings = {}
-                target_face.assigned_input_embedding = {}
-
-            # Carica gli embedding dal file e crea il dizionario embedding_store
-            for embed_data in embeddings_list:
-                embedding_store = embed_data.get('embedding_store', {})
-                # Converte ogni embedding in numpy array
-                for recogn_model, embed in embedding_store.items():
-                    embedding_store[recogn_model] = np.array(embed)
-
-                # Passa l'intero embedding_store alla funzione
-                list_view_actions.create_and_add_embed_button_to_list(
-                    main_window, 
-                    embed_data['name'], 
-                    embedding_store,  # Passa l'intero embedding_store
-                    embedding_id=str(uuid.uuid1().int)
-                )
+        # Binary files are memory-mapped, JSON files of previous versions are still supported
+        embeddings_list = load_embeddings_file(embedding_filename)
+        card_actions.clear_merged_embeddings(main_window)
+
+        # Reset per ogni target face
+        for _, target_face in main_window.target_faces.items():
+            target_face.assigned_merged_embeddings = {}
+            target_face.assigned_input_embedding = {}
+
+        for embed_data in embeddings_list:
+            # Passa l'intero embedding_store alla funzione
+            list_view_actions.create_and_add_embed_button_to_list(
+                main_window, 
+                embed_data['name'], 
+                embed_data['embedding_store'],  # Passa l'intero embedding_store
+                embedding_id=str(uuid.uuid1().int)
+            )
 
     main_window.loaded_embedding_filename = embedding_filename or main_window.loaded_embedding_filename
 
@@ -58,25 +53,26 @@ def save_embeddings_to_file(main_window: 'MainWindow', save_as=False):
     # Definisce il nome del file di salvataggio
     embedding_filename = main_window.loaded_embedding_filename
     if not embedding_filename or not misc_helpers.is_file_exists(embedding_filename) or save_as:
-        embedding_filename, _ = QtWidgets.QFileDialog.getSaveFileName(main_window, filter='JSON (*.json)')
+        embedding_filename, _ = QtWidgets.QFileDialog.getSaveFileName(main_window, filter=f'Embeddings (*{EMBEDDINGS_FILE_EXTENSION});;JSON (*.json)')
+        if embedding_filename and not Path(embedding_filename).suffix:
+            embedding_filename += EMBEDDINGS_FILE_EXTENSION
 
     # Crea una lista di dizionari, ciascuno con il nome dell'embedding e il relativo embedding_store
     embeddings_list = [
         {
             'name': embed_button.embedding_name,
-            'embedding_store': {k: v.tolist() for k, v in embed_button.embedding_store.items()}  # Converti gli embedding in liste
+            'embedding_store': embed_button.embedding_store
         }
         for embedding_id, embed_button in main_window.merged_embeddings.items()
     ]
 
     # Salva su file
     if embedding_filename:
-        with open(embedding_filename, 'w') as embed_file: #pylint: disable=unspecified-encoding
-            embeddings_as_json = json.dumps(embeddings_list, indent=4)  # Salva con indentazione per leggibilità
-            embed_file.write(embeddings_as_json)
+        # The format is chosen from the extension, .json files are still written as JSON
+        save_embeddings_file(embedding_filename, embeddings_list)
 
-            # Mostra un messaggio di conferma
-            common_widget_actions.create_and_show_toast_message(main_window, 'Embeddings Saved', f'Saved Embeddings to file: {embedding_filename}')
+        # Mostra un messaggio di conferma
+        common_widget_actions.create_and_show_toast_message(main_window, 'Embeddings Saved', f'Saved Embeddings to file: {embedding_filename}')
 
         main_window.loaded_embedding_filename = embedding_filename
 
@@ -55,6 +55,59 @@ SETTINGS_LAYOUT_DATA: LayoutDictTypes = {
             'step': 1,
             'help': 'Set the maximum FPS of the video when playing'
         },
+        'SceneDetectEnableToggle': {
+            'level': 1,
+            'label': 'Scene Change Detection',
+            'default': True,
+            'help': 'Detect shot changes while reading the video frames, using a downsampled luminance histogram. Each frame is tagged with the ID of its shot.'
+        },
+        'SceneDetectThresholdSlider': {
+            'level': 2,
+            'label': 'Scene Change Threshold',
+            'min_value': '1',
+            'max_value': '100',
+            'default': '35',
+            'step': 1,
+            'parentToggle': 'SceneDetectEnableToggle',
+            'requiredToggleValue': True,
+            'help': 'Set how different consecutive frames must be to start a new shot. Lower values detect more shot changes.'
+        },
+        'SceneDetectExportShotListToggle': {
+            'level': 2,
+            'label': 'Export Shot List',
+            'default': False,
+            'parentToggle': 'SceneDetectEnableToggle',
+            'requiredToggleValue': True,
+            'help': 'Save the list of detected shots as a JSON file next to the recorded video.'
+        },
+        'ColorTransferCacheEnableToggle': {
+            'level': 1,
+            'label': 'Reuse Color Transfer Statistics',
+            'default': False,
+            'help': 'When playing or recording videos, reuse the AutoColor and DFM RCT color statistics of a face tracked across frames instead of computing them on every frame. They are computed again after a number of frames or on a scene change, and smoothed with the previous ones to reduce color flicker.'
+        },
+        'ColorTransferCacheRefreshSlider': {
+            'level': 2,
+            'label': 'Color Statistics Refresh Interval',
+            'min_value': '1',
+            'max_value': '60',
+            'default': '5',
+            'step': 1,
+            'parentToggle': 'ColorTransferCacheEnableToggle',
+            'requiredToggleValue': True,
+            'help': 'Maximum number of frames the color statistics of a tracked face are reused for before they are computed again.'
+        },
+        'ColorTransferCacheSmoothingSlider': {
+            'level': 2,
+            'label': 'Color Statistics Smoothing',
+            'min_value': '0',
+            'max_value': '95',
+            'default': '50',
+            'step': 5,
+            'parentToggle': 'ColorTransferCacheEnableToggle',
+            'requiredToggleValue': True,
+            'help': 'Weight of the previous color statistics when they are computed again. Higher values change the colors more slowly, 0 disables the smoothing.'
+        },
     },
     'Auto Swap':{
         'AutoSwapToggle': {
@@ -72,6 +125,13 @@ SETTINGS_LAYOUT_DATA: LayoutDictTypes = {
             'default': 'RetinaFace',
             'help': 'Select the face detection model to use for detecting faces in the input image or video.'
         },
+        'DetectorInputSizeSelection': {
+            'level': 1,
+            'label': 'Detector Input Size',
+            'options': ['Auto', '256', '320', '512', '640', '1024'],
+            'default': '512',
+            'help': 'Set the resolution the frame is resized to before face detection. Smaller sizes are faster but can miss small faces. Auto picks the size from the media resolution and the size of the faces found in the recent frames. Yolov8 and Yunet models with a fixed input shape always use their own size.'
+        },
         'DetectorScoreSlider': {
             'level': 1,
             'label': 'Detect Score',
@@ -266,14 +326,37 @@ SETTINGS_LAYOUT_DATA: LayoutDictTypes = {
             'default': 'Opal',
             'help': 'Choose the type of similarity calculation for face detection and matching during the face swapping process.'
         },
+        'RecognitionCacheEnableToggle': {
+            'level': 1,
+            'label': 'Reuse Tracked Face Embeddings',
+            'default': True,
+            'help': 'When playing or recording videos, reuse the recognition embedding of a face tracked across frames instead of computing it on every frame. It is computed again after a number of frames, when the face size or pose changes, or on a scene change.'
+        },
+        'RecognitionCacheRefreshSlider': {
+            'level': 2,
+            'label': 'Embedding Refresh Interval',
+            'min_value': '1',
+            'max_value': '60',
+            'default': '10',
+            'step': 1,
+            'parentToggle': 'RecognitionCacheEnableToggle',
+            'requiredToggleValue': True,
+            'help': 'Maximum number of frames a tracked face embedding is reused for before it is computed again.'
+        },
+        'OneToOneFaceMatchingToggle': {
+            'level': 1,
+            'label': 'One-to-One Face Matching',
+            'default': False,
+            'help': 'Assign each target face to at most one detected face and each detected face to at most one target face, keeping the pairs with the highest total similarity. When disabled, a face is swapped with every target face it matches.'
+        },
     },
     'Embedding Merge Method':{
         'EmbMergeMethodSelection':{
             'level': 1,
             'label': 'Embedding Merge Method',
-            'options': ['Mean','Median'],
+            'options': ['Mean', 'Median', 'Weighted Mean', 'Trimmed Mean'],
             'default': 'Mean',
-            'help': 'Select the method to merge facial embeddings. "Mean" averages the embeddings, while "Median" selects the middle value, providing more robustness to outliers.'
+            'help': 'Select the method to merge facial embeddings. "Mean" averages the embeddings, while "Median" selects the middle value, providing more robustness to outliers. "Weighted Mean" gives more weight to the embeddings of better quality faces, and "Trimmed Mean" leaves out the 20% of embeddings furthest away from the others before averaging.'
         }
     },
     'Media Selection':{
@@ -288,6 +371,18 @@ SETTINGS_LAYOUT_DATA: LayoutDictTypes = {
             'label': 'Input Faces Include Subfolders',
             'default': False,
             'help': 'Include all files from Subfolders when choosing Input Faces Folder'
+        },
+        'InputFacesLazyEmbeddingsToggle':{
+            'level': 1,
+            'label': 'Lazy Input Face Embeddings',
+            'default': False,
+            'help': 'Only compute the embedding of the selected recognition model when loading Input Faces. The embeddings of the other models are computed the first time a face is assigned or merged, which makes loading large folders faster.'
+        },
+        'InputFacesCacheToggle':{
+            'level': 1,
+            'label': 'Cache Input Faces',
+            'default': True,
+            'help': 'Keep the detected faces and embeddings of the Input Faces on disk (in the .input_faces_cache folder), so that reloading the same images with the same detection settings skips the detection and recognition.'
         }
     }
 }
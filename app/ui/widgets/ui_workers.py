@@ -3,6 +3,7 @@ from functools import partial
 from typing import TYPE_CHECKING, Dict
 import traceback
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import torch
@@ -12,7 +13,9 @@ from PySide6.QtGui import QPixmap
 
 from app.processors.models_data import detection_model_mapping, landmark_model_mapping
 from app.helpers import miscellaneous as misc_helpers
+from app.helpers.input_faces_cache import InputFacesCache, get_input_faces_cache
 from app.ui.widgets.actions import common_actions as common_widget_actions
+from app.ui.widgets.actions import card_actions
 from app.ui.widgets.actions import filter_actions
 from app.ui.widgets.settings_layout_data import SETTINGS_LAYOUT_DATA, CAMERA_BACKENDS
 
@@ -112,7 +115,8 @@ class TargetMediaLoaderWorker(qtc.QThread):
 
 class InputFacesLoaderWorker(qtc.QThread):
     # Define signals to emit when loading is done or if there are updates
-    thumbnail_ready = qtc.Signal(str, numpy.ndarray, object, QPixmap, str)
+    # Also sends the keypoints and the similarity type the face was recognized with, to compute its other embeddings later
+    thumbnail_ready = qtc.Signal(str, numpy.ndarray, object, QPixmap, str, object, str)
     finished = qtc.Signal()  # Signal to indicate completion
     def __init__(self, main_window: 'MainWindow', media_path=False, folder_name=False, files_list=None, face_ids=None,  parent=None):
         super().__init__(parent)
@@ -122,6 +126,9 @@ class InputFacesLoaderWorker(qtc.QThread):
         self.face_ids = face_ids or []
         self._running = True  # Flag to control the running state
         self.was_playing = True
+        # Number of images decoded in parallel and recognized together
+        self.decode_threads = min(8, os.cpu_count() or 1)
+        self.batch_size = 8
         self.pre_load_detection_recognition_models()
         
     def pre_load_detection_recognition_models(self):
@@ -138,7 +145,11 @@ class InputFacesLoaderWorker(qtc.QThread):
             models_processor.models[detect_model] = models_processor.load_model(detect_model)
         if not models_processor.models[landmark_detect_model] and control['LandmarkDetectToggle']:
             models_processor.models[landmark_detect_model] = models_processor.load_model(landmark_detect_model)
-        for recognition_model in ['Inswapper128ArcFace', 'SimSwapArcFace', 'GhostArcFace', 'CSCSArcFace', 'CSCSIDArcFace']:
+        if control['InputFacesLazyEmbeddingsToggle']:
+            recognition_models = [control['RecognitionModelSelection']]
+        else:
+            recognition_models = ['Inswapper128ArcFace', 'SimSwapArcFace', 'GhostArcFace', 'CSCSArcFace', 'CSCSIDArcFace']
+        for recognition_model in recognition_models:
             if not models_processor.models[recognition_model]:
                 models_processor.models[recognition_model] = models_processor.load_model(recognition_model)
         if was_playing:
@@ -159,63 +170,138 @@ class InputFacesLoaderWorker(qtc.QThread):
         elif files_list:
             image_files = files_list
 
-        i=0
         image_files.sort()
-        for image_file_path in image_files:
-            if not self._running:  # Check if the thread is still running
-                break
-            if not misc_helpers.is_image_file(image_file_path):
-                return
-            if folder_name:
-                image_file_path = os.path.join(folder_name, image_file_path)
-            frame = misc_helpers.read_image_file(image_file_path)
-            if frame is None:
-                continue
-            # Frame must be in RGB format
-            frame = frame[..., ::-1]  # Swap the channels from BGR to RGB
+        image_files = [image_file_path for image_file_path in image_files if misc_helpers.is_image_file(image_file_path)]
+        if folder_name:
+            image_files = [os.path.join(folder_name, image_file_path) for image_file_path in image_files]
+        batches = [image_files[i:i+self.batch_size] for i in range(0, len(image_files), self.batch_size)]
 
-            img = torch.from_numpy(frame.astype('uint8')).to(self.main_window.models_processor.device)
-            img = img.permute(2,0,1)
-            _, kpss_5, _ = self.main_window.models_processor.run_detect(img, control['DetectorModelSelection'], max_num=1, score=control['DetectorScoreSlider']/100.0, input_size=(512, 512), use_landmark_detection=control['LandmarkDetectToggle'], landmark_detect_mode=control['LandmarkDetectModelSelection'], landmark_score=control["LandmarkDetectScoreSlider"]/100.0, from_points=control["DetectFromPointsToggle"], rotation_angles=[0] if not control["AutoRotationToggle"] else [0, 90, 180, 270])
+        # Embeddings of the other recognition models are computed the first time the face is used
+        if control['InputFacesLazyEmbeddingsToggle']:
+            recognition_models = [control['RecognitionModelSelection']]
+        else:
+            recognition_models = SETTINGS_LAYOUT_DATA['Face Recognition']['RecognitionModelSelection']['options']
 
-            # If atleast one face is found
-            # found_face = []
-            face_kps = False
-            try:
-                face_kps = kpss_5[0]
-            except IndexError:
-                continue
-            if face_kps.any():
-                face_emb, cropped_img = self.main_window.models_processor.run_recognize_direct(img, face_kps, control['SimilarityTypeSelection'], control['RecognitionModelSelection'])
-                cropped_img = cropped_img.cpu().numpy()
-                cropped_img = cropped_img[..., ::-1]  # Swap the channels from RGB to BGR
-                face_img = numpy.ascontiguousarray(cropped_img)
-                # crop = cv2.resize(face[2].cpu().numpy(), (82, 82))
-                pixmap = common_widget_actions.get_pixmap_from_frame(self.main_window, face_img)
-
-                embedding_store: Dict[str, numpy.ndarray] = {}
-                # Ottenere i valori di 'options'
-                options = SETTINGS_LAYOUT_DATA['Face Recognition']['RecognitionModelSelection']['options']
-                for option in options:
-                    if option != control['RecognitionModelSelection']:
-                        target_emb, _ = self.main_window.models_processor.run_recognize_direct(img, face_kps, control['SimilarityTypeSelection'], option)
-                        embedding_store[option] = target_emb
+        # Faces already loaded with the same detection settings are read back from the cache instead of being detected and recognized again
+        input_faces_cache = get_input_faces_cache() if control['InputFacesCacheToggle'] else None
+        input_size = (512, 512) if control['DetectorInputSizeSelection'] == 'Auto' else control['DetectorInputSizeSelection']
+        settings_key = InputFacesCache.get_settings_key(control, input_size)
+        read_input_face = partial(self.read_input_face, input_faces_cache=input_faces_cache, settings_key=settings_key, recognition_models=recognition_models)
+
+        i=0
+        with ThreadPoolExecutor(max_workers=self.decode_threads) as executor:
+            next_input_faces = [executor.submit(read_input_face, image_file_path) for image_file_path in batches[0]] if batches else []
+            for batch_index, batch_files in enumerate(batches):
+                if not self._running:  # Check if the thread is still running
+                    break
+                input_faces = next_input_faces
+                # The next batch is decoded while the faces of this one are detected and recognized
+                if batch_index + 1 < len(batches):
+                    next_input_faces = [executor.submit(read_input_face, image_file_path) for image_file_path in batches[batch_index + 1]]
+
+                faces = []
+                for image_file_path, input_face in zip(batch_files, input_faces):
+                    file_hash, cached_face, frame = input_face.result()
+                    if not self._running:
+                        break
+                    if cached_face is not None:
+                        face_kps, face_img, embedding_store = cached_face
+                        faces.append({'path': image_file_path, 'kps': face_kps, 'face_img': face_img, 'embedding_store': embedding_store})
+                        continue
+                    if frame is None:
+                        continue
+                    img = torch.from_numpy(frame).to(self.main_window.models_processor.device)
+                    img = img.permute(2,0,1)
+                    face_kps = card_actions.detect_input_face(self.main_window, img, control)
+                    if face_kps is not None:
+                        faces.append({'path': image_file_path, 'file_hash': file_hash, 'img': img, 'kps': face_kps})
+                if not self._running:
+                    continue
+
+                # Faces of the whole batch are recognized together, with one model run per recognition model
+                faces_to_recognize = [face for face in faces if 'embedding_store' not in face]
+                if faces_to_recognize:
+                    faces_imgs = [face['img'] for face in faces_to_recognize]
+                    faces_kps = [face['kps'] for face in faces_to_recognize]
+                    faces_embeddings = {}
+                    for recognition_model in recognition_models:
+                        faces_embeddings[recognition_model], cropped_imgs = self.main_window.models_processor.run_recognize_direct_batch(faces_imgs, faces_kps, control['SimilarityTypeSelection'], recognition_model)
+                        if recognition_model == control['RecognitionModelSelection']:
+                            faces_cropped_imgs = cropped_imgs
+
+                    for j, face in enumerate(faces_to_recognize):
+                        cropped_img = faces_cropped_imgs[j].cpu().numpy()
+                        cropped_img = cropped_img[..., ::-1]  # Swap the channels from RGB to BGR
+                        face['face_img'] = numpy.ascontiguousarray(cropped_img)
+                        face['embedding_store'] = {recognition_model: embeddings[j] for recognition_model, embeddings in faces_embeddings.items()}
+                        del face['img']
+                        if input_faces_cache is not None and face['file_hash']:
+                            input_faces_cache.put(face['file_hash'], settings_key, face['kps'], face['face_img'], face['embedding_store'])
+
+                for face in faces:
+                    face_img = face['face_img']
+                    # crop = cv2.resize(face[2].cpu().numpy(), (82, 82))
+                    pixmap = common_widget_actions.get_pixmap_from_frame(self.main_window, face_img)
+
+                    embedding_store: Dict[str, numpy.ndarray] = face['embedding_store']
+                    if not self.face_ids:
+                        face_id = str(uuid.uuid1().int)
                     else:
-                        embedding_store[control['RecognitionModelSelection']] = face_emb
-                if not self.face_ids:
-                    face_id = str(uuid.uuid1().int)
-                else:
-                    face_id = self.face_ids[i]
-                self.thumbnail_ready.emit(image_file_path, face_img, embedding_store, pixmap, face_id)
-                i+=1
+                        face_id = self.face_ids[i]
+                    self.thumbnail_ready.emit(face['path'], face_img, embedding_store, pixmap, face_id, face['kps'], control['SimilarityTypeSelection'])
+                    i+=1
+        if input_faces_cache is not None:
+            input_faces_cache.save()
         torch.cuda.empty_cache()
         self.finished.emit()
 
+    @staticmethod
+    def read_input_face(image_file_path, input_faces_cache: InputFacesCache=None, settings_key='', recognition_models=None):
+        # Runs on the decode thread pool, OpenCV releases the GIL while decoding
+        # Returns the hash of the file, the cached face or None, and the decoded frame when the face is not cached
+        file_hash = None
+        if input_faces_cache is not None:
+            file_hash = input_faces_cache.get_file_hash(image_file_path)
+            cached_face = input_faces_cache.get(file_hash, settings_key, recognition_models) if file_hash else None
+            if cached_face is not None:
+                return file_hash, cached_face, None
+
+        frame = misc_helpers.read_image_file(image_file_path)
+        if frame is None:
+            return file_hash, None, None
+        # Frame must be in RGB format
+        return file_hash, None, numpy.ascontiguousarray(frame[..., ::-1])  # Swap the channels from BGR to RGB
+
     def stop(self):
         """Stop the thread by setting the running flag to False."""
         self._running = False
         self.wait()
 
+class InputFaceEmbeddingsWorker(qtc.QThread):
+    # Computes the embeddings of the recognition models missing from input faces loaded with lazy embeddings
+    embeddings_ready = qtc.Signal(str, object)  # Signal with the face_id and the Dict of its new embeddings
+    def __init__(self, main_window: 'MainWindow', input_faces: list, parent=None):
+        super().__init__(parent)
+        self.main_window = main_window
+        # (face_id, media_path, face_kps, similarity_type, missing_models) of each face
+        self.input_faces = input_faces
+
+    def run(self):
+        models_processor = self.main_window.models_processor
+        for face_id, media_path, face_kps, similarity_type, missing_models in self.input_faces:
+            frame = misc_helpers.read_image_file(media_path)
+            if frame is None:
+                continue
+            # Frame must be in RGB format
+            frame = numpy.ascontiguousarray(frame[..., ::-1])  # Swap the channels from BGR to RGB
+            img = torch.from_numpy(frame).to(models_processor.device)
+            img = img.permute(2,0,1)
+            # The face is not detected again, the keypoints found when it was loaded are used
+            embeddings = {}
+            for recognition_model in missing_models:
+                embeddings[recognition_model], _ = models_processor.run_recognize_direct(img, face_kps, similarity_type, recognition_model)
+            self.embeddings_ready.emit(face_id, embeddings)
+
 class FilterWorker(qtc.QThread):
     filtered_results = qtc.Signal(list)
 
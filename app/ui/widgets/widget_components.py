@@ -17,6 +17,7 @@ from app.ui.widgets.actions import card_actions
 from app.ui.widgets.actions import list_view_actions
 from app.ui.widgets.actions import save_load_actions
 import app.helpers.miscellaneous as misc_helpers
+from app.processors.utils.embedding_merger import EmbeddingMerger, EMBEDDING_MERGE_METHODS
 
 if TYPE_CHECKING:
     from app.ui.main_ui import MainWindow
@@ -168,6 +169,9 @@ class TargetMediaCardButton(CardButton):
         # Reset the frame counter
         main_window.video_processor.current_frame_number = 0
         main_window.video_processor.media_path = self.media_path
+        main_window.video_processor.scene_detector.reset()
+        main_window.video_processor.embedding_cache.reset()
+        main_window.video_processor.color_transfer_cache.reset()
         main_window.parameters = {}
         main_window.selected_target_face_id = False
         main_window.video_processor.current_frame = []
@@ -336,6 +340,7 @@ class TargetFaceCardButton(CardButton):
         self.assigned_input_faces: Dict[str, Dict[str, np.ndarray]] = {}  # Inside Dict (key - input face_id): {Key: embedding_swap_model, Value: InputFaceCardButton.embedding_store}
         self.assigned_merged_embeddings: Dict[str, Dict[str, np.ndarray]] = {}  # Key: embedding_swap_model, Value: EmbeddingCardButton.embedding_store
         self.assigned_input_embedding = {}  # Key: embedding_swap_model, Value: np.ndarray
+        self.embedding_merger = EmbeddingMerger()  # Keeps the assigned embeddings of each model in a matrix, to merge them incrementally
         
         self.setCheckable(True)
         self.clicked.connect(self.load_target_face)
@@ -389,39 +394,23 @@ class TargetFaceCardButton(CardButton):
 
         main_window.current_widget_parameters = main_window.parameters[self.face_id].copy()
 
-    def calculate_assigned_input_embedding(self):
+    def calculate_assigned_input_embedding(self, compute_missing_embeddings=True):
         control = self.main_window.control.copy()
+        if compute_missing_embeddings:
+            # The missing embeddings are computed in the background, they are merged once they are ready
+            card_actions.compute_missing_input_face_embeddings(self.main_window, [self.main_window.input_faces[input_face_id] for input_face_id in self.assigned_input_faces.keys() if input_face_id in self.main_window.input_faces])
 
-        all_input_embeddings = []
-        all_embedding_swap_models = set()
+        # Only the input faces and merged embeddings that were added or removed since the last call are updated in the merger
+        sources = {('input_face', input_face_id): embedding_store for input_face_id, embedding_store in self.assigned_input_faces.items() if embedding_store}
+        sources.update({('merged_embedding', embedding_id): embedding_store for embedding_id, embedding_store in self.assigned_merged_embeddings.items() if embedding_store})
+        self.embedding_merger.set_sources(sources)
 
-        # Itera su `assigned_input_faces` e raccogli gli embedding e i modelli
-        for _, embedding_store in self.assigned_input_faces.items():
-            if embedding_store:  # Verifica se l'embedding_store non è vuoto
-                all_embedding_swap_models.update(embedding_store.keys())
-                all_input_embeddings.append(embedding_store)  # Aggiungi l'intero store
-        
-        # Itera su `assigned_merged_embeddings` e raccogli gli embedding e i modelli
-        for _, embedding_store in self.assigned_merged_embeddings.items():
-            if embedding_store:  # Verifica se l'embedding_store non è vuoto
-                all_embedding_swap_models.update(embedding_store.keys())
-                all_input_embeddings.append(embedding_store)  # Aggiungi l'intero store
-
-        # Calcolo degli embedding se presenti
-        if len(all_input_embeddings) > 0:
-            if control['EmbMergeMethodSelection'] == 'Mean':
-                self.assigned_input_embedding = {
-                    model: np.mean([store[model] for store in all_input_embeddings if model in store], axis=0)
-                    for model in all_embedding_swap_models
-                }
-            elif control['EmbMergeMethodSelection'] == 'Median':
-                self.assigned_input_embedding = {
-                    model: np.median([store[model] for store in all_input_embeddings if model in store], axis=0)
-                    for model in all_embedding_swap_models
-                }
+        previous_assigned_input_embedding = self.assigned_input_embedding
+        self.assigned_input_embedding = self.embedding_merger.merge(control['EmbMergeMethodSelection'])
 
-        else:
-            self.assigned_input_embedding = {}
+        # The swapper latents of the embeddings that are not assigned anymore are not used anymore
+        assigned_embeddings_ids = {id(embedding) for embedding in self.assigned_input_embedding.values()}
+        self.main_window.models_processor.invalidate_swapper_latents([embedding for embedding in previous_assigned_input_embedding.values() if id(embedding) not in assigned_embeddings_ids])
 
     def create_context_menu(self):
         # create context menu
@@ -436,6 +425,8 @@ class TargetFaceCardButton(CardButton):
         load_parameters_action.triggered.connect(partial(save_load_actions.load_parameters_and_settings, self.main_window, self.face_id))
         load_parameters_and_settings_action = QtGui.QAction('Load Parameters and Settings', self)
         load_parameters_and_settings_action.triggered.connect(partial(save_load_actions.load_parameters_and_settings, self.main_window, self.face_id, True))
+        show_similar_input_faces_action = QtGui.QAction('Show Most Similar Input Faces', self)
+        show_similar_input_faces_action.triggered.connect(self.show_most_similar_input_faces)
         remove_action = QtGui.QAction('Remove from List', self)
         remove_action.triggered.connect(self.remove_target_face_from_list)
         self.popMenu.addAction(parameters_copy_action)
@@ -443,12 +434,16 @@ class TargetFaceCardButton(CardButton):
         self.popMenu.addAction(save_parameters_action)
         self.popMenu.addAction(load_parameters_action)
         self.popMenu.addAction(load_parameters_and_settings_action)
+        self.popMenu.addAction(show_similar_input_faces_action)
         self.popMenu.addAction(remove_action)
 
     def on_context_menu(self, point):
         # show context menu
         self.popMenu.exec_(self.mapToGlobal(point))
 
+    def show_most_similar_input_faces(self):
+        card_actions.show_most_similar_input_faces(self.main_window, self)
+
     def remove_target_face_from_list(self):
         main_window = self.main_window
 
@@ -497,12 +492,15 @@ class TargetFaceCardButton(CardButton):
             common_widget_actions.refresh_frame(main_window=self.main_window)
 
 class InputFaceCardButton(CardButton):
-    def __init__(self, media_path, cropped_face, embedding_store: Dict[str, np.ndarray], face_id: str, *args, **kwargs):
+    def __init__(self, media_path, cropped_face, embedding_store: Dict[str, np.ndarray], face_id: str, face_kps=None, similarity_type=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.face_id = face_id
         self.cropped_face = cropped_face
         self.embedding_store = embedding_store  # Key: embedding_swap_model, Value: embedding
         self.media_path = media_path
+        # Keypoints and similarity type the face was recognized with when it was loaded, its missing embeddings are computed with them
+        self.face_kps = face_kps
+        self.similarity_type = similarity_type
 
         self.setCheckable(True)
         self.setToolTip(media_path)
@@ -583,6 +581,9 @@ class InputFaceCardButton(CardButton):
 
         common_widget_actions.refresh_frame(main_window)
         
+    def hide_duplicate_input_faces(self):
+        card_actions.hide_duplicate_input_faces(self.main_window)
+
     def remove_input_face_from_list(self):
         main_window = self.main_window
         i = self.get_item_position()
@@ -604,6 +605,10 @@ class InputFaceCardButton(CardButton):
         create_embed_action.triggered.connect(self.create_embedding_from_selected_faces)
         self.popMenu.addAction(create_embed_action)
 
+        hide_duplicates_action = QtGui.QAction('Hide Duplicate Faces', self)
+        hide_duplicates_action.triggered.connect(self.hide_duplicate_input_faces)
+        self.popMenu.addAction(hide_duplicates_action)
+
         remove_action = QtGui.QAction('Remove from list', self)
         remove_action.triggered.connect(self.remove_input_face_from_list)
         self.popMenu.addAction(remove_action)
@@ -612,6 +617,12 @@ class InputFaceCardButton(CardButton):
         self.popMenu.exec_(self.mapToGlobal(point))
 
     def create_embedding_from_selected_faces(self):
+        # The dialog is opened once the missing embeddings of the selected faces are computed
+        selected_input_faces = [input_face for _, input_face in self.main_window.input_faces.items() if input_face.isChecked()]
+        if not card_actions.compute_missing_input_face_embeddings(self.main_window, selected_input_faces, on_finished=self.open_create_embedding_dialog):
+            self.open_create_embedding_dialog()
+
+    def open_create_embedding_dialog(self):
         # Raccogli l'intero embedding_store dalle facce selezionate
         selected_faces_embeddings_store = [
             input_face.embedding_store 
@@ -728,7 +739,7 @@ class CreateEmbeddingDialog(QtWidgets.QDialog):
         self.embed_name_edit.setPlaceholderText("Enter embedding name")
 
         self.merge_type_selection = QtWidgets.QComboBox(self)
-        self.merge_type_selection.addItems(['Mean', 'Median'])
+        self.merge_type_selection.addItems(EMBEDDING_MERGE_METHODS)
         self.merge_type_selection.setCurrentText(main_window.control['EmbMergeMethodSelection'])
 
         # Create button box
@@ -755,22 +766,10 @@ class CreateEmbeddingDialog(QtWidgets.QDialog):
         if self.embedding_name == '':
             common_widget_actions.create_and_show_messagebox(self.main_window, 'Empty Embedding Name!', 'Embedding Name cannot be empty!', self)
         else:
-            # Estrai tutti gli embedding per ogni embedding_swap_model
-            merged_embedding_store = {}
-            
-            for embedding_store in self.embedding_stores:
-                for embedding_swap_model, embedding in embedding_store.items():
-                    if embedding_swap_model not in merged_embedding_store:
-                        merged_embedding_store[embedding_swap_model] = []
-                    merged_embedding_store[embedding_swap_model].append(embedding)
-
             # Calcola l'embedding unito per ciascun embedding_swap_model
-            final_embedding_store = {}
-            for swap_model, embeddings in merged_embedding_store.items():
-                if self.merge_type == 'Mean':
-                    final_embedding_store[swap_model] = np.mean(embeddings, axis=0)
-                elif self.merge_type == 'Median':
-                    final_embedding_store[swap_model] = np.median(embeddings, axis=0)
+            embedding_merger = EmbeddingMerger()
+            embedding_merger.set_sources(dict(enumerate(self.embedding_stores)))
+            final_embedding_store = embedding_merger.merge(self.merge_type)
 
             # Crea e aggiungi il nuovo embedding_store con tutti i modelli di swap
             list_view_actions.create_and_add_embed_button_to_list(
@@ -0,0 +1,23 @@
+# Script Usage Example
+# 'python3 tools/convert_embeddings_file.py merged_embeddings.json --output_embeddings_file merged_embeddings.vme'
+# Converts the JSON embeddings files (including the ones made by convert_old_rope_embeddings.py) to the binary format, and back
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.helpers.embeddings_file import EMBEDDINGS_FILE_EXTENSION, is_binary_embeddings_file, load_embeddings_file, save_embeddings_file # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser("Embeddings File Converter")
+parser.add_argument("embeddings_file", help="Embeddings File (JSON or binary)", type=str)
+parser.add_argument("--output_embeddings_file", help="Converted Embeddings File, the format is chosen from the extension", type=str)
+args = parser.parse_args()
+input_filename = args.embeddings_file
+
+output_extension = '.json' if is_binary_embeddings_file(input_filename) else EMBEDDINGS_FILE_EXTENSION
+output_filename = args.output_embeddings_file or f'{os.path.splitext(input_filename)[0]}{output_extension}'
+
+embeddings_list = load_embeddings_file(input_filename)
+save_embeddings_file(output_filename, embeddings_list)
+print(f'Converted {len(embeddings_list)} embeddings to {output_filename}')